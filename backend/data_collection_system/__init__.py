@@ -31,16 +31,11 @@ logger.addHandler(consoleHandler)
 
 
 # Create database engine
-DATABASE_URL = os.getenv(
-    "DATABASE_URL", "sqlite:///./backend/data_collection_system/tests/.test.db"
-)
+TEST_DATABASE_URL = "sqlite:///./backend/data_collection_system/tests/.test.db"
+DATABASE_URL = os.getenv("DATABASE_URL", TEST_DATABASE_URL)
 db = create_engine(
     DATABASE_URL,
     echo=False,
-    **(
-        {"executemany_mode": "batch"}
-        if DATABASE_URL != "sqlite:///./backend/data_collection_system/tests/.test.db"
-        else {}
-    )
+    **({"executemany_mode": "batch"} if DATABASE_URL != TEST_DATABASE_URL else {})
 )
 Session = sessionmaker(db)
@@ -0,0 +1,161 @@
+"""
+Benchmark the per-message cost of serializing requests and parsing responses with the
+slot-based messages of x55_protocol and x30_protocol, against the pydantic models they
+replaced, which are reproduced here as they were.
+
+Run from the repository root with:
+    PYTHONPATH=backend python -m data_collection_system.benchmarks.protocol_codec
+"""
+import argparse
+import timeit
+from datetime import datetime
+from struct import pack, unpack
+from typing import List, Tuple
+
+from pydantic import BaseModel
+
+from ..x30 import x30_protocol
+from ..x55 import x55_protocol
+
+
+class x55Request(BaseModel):
+    _serializers = {
+        datetime: lambda x: x.strftime("%Y %m %d %H %M %S").encode("ascii"),
+        bool: lambda x: str(int(x)).encode("ascii"),
+    }
+    _default_serializer = lambda self, x: str(x).encode("ascii")
+
+    def serialize(self):
+        command = b"#%b" % (self.__class__.__name__).encode("ascii")
+        arguments = b" ".join(
+            [
+                self._serializers.get(
+                    self.__fields__[k].type_, self._default_serializer
+                )(v)
+                for k, v in self.dict().items()
+            ]
+        )
+        return b"".join(
+            (
+                pack("<B", 0),
+                pack("<x"),
+                pack("<H", len(command)),
+                pack("<I", len(arguments)),
+                command,
+                arguments,
+            )
+        )
+
+
+class GetPeaks(x55Request):
+    pass
+
+
+class SetPeakDataStreamingDivider(x55Request):
+    divider: int
+
+
+class x55Response(BaseModel):
+    status: bool
+    message: str
+    content: bytes
+
+    def __init__(self, response: Tuple[bool, bytes, bytes]):
+        status, message, content = response
+        try:
+            super().__init__(status=status, message=message, **self.parse(content))
+        except Exception:
+            raise ValueError("Could not parse response")
+
+
+class PeakDataStreamingDivider(x55Response):
+    content: int
+
+    def parse(self, content: bytes):
+        return {"content": unpack("<I", content)[0]}
+
+
+class x30Request(BaseModel):
+    _serializers = {bool: lambda x: str(int(x)).encode("ascii")}
+
+    def serialize(self):
+        command = b"#%b" % (self.__class__.__name__).encode("ascii")
+        arguments = [self._serializers[bool](v) for v in self.dict().values()]
+        return (b" ".join((command, *arguments))) + b"\n"
+
+
+class SET_STREAMING_DATA(x30Request):
+    val: bool
+
+
+class DATA(BaseModel):
+    granularity: int
+    channel_1_peaks: List[int]
+    channel_2_peaks: List[int]
+    channel_3_peaks: List[int]
+    channel_4_peaks: List[int]
+
+    def __init__(self, response: bytes):
+        super().__init__(**x30_protocol.DATA.parse(None, response))
+
+
+def cases():
+    divider = (True, b"Divider is 10.", pack("<I", 10))
+    data = (
+        bytes(16)
+        + pack("<4H", 5, 5, 5, 5)
+        + bytes(48)
+        + pack("<I", 20000)
+        + bytes(12)
+        + pack("<20I", *range(20))
+        + b"XXXXXXXX"
+    )
+    return [
+        (
+            "x55 GetPeaks request",
+            lambda: GetPeaks().serialize(),
+            lambda: x55_protocol.GetPeaks().serialize(),
+        ),
+        (
+            "x55 SetPeakDataStreamingDivider request",
+            lambda: SetPeakDataStreamingDivider(divider=10).serialize(),
+            lambda: x55_protocol.SetPeakDataStreamingDivider(divider=10).serialize(),
+        ),
+        (
+            "x55 PeakDataStreamingDivider response",
+            lambda: PeakDataStreamingDivider(divider).content,
+            lambda: x55_protocol.PeakDataStreamingDivider(divider).content,
+        ),
+        (
+            "x30 SET_STREAMING_DATA request",
+            lambda: SET_STREAMING_DATA(val=True).serialize(),
+            lambda: x30_protocol.SET_STREAMING_DATA(val=True).serialize(),
+        ),
+        (
+            "x30 DATA response, 20 peaks",
+            lambda: DATA(data).channel_1_peaks,
+            lambda: x30_protocol.DATA(data).channel_1_peaks,
+        ),
+    ]
+
+
+def main(number: int, repeats: int):
+    for name, before, after in cases():
+        assert before() == after()
+        costs = [
+            min(timeit.repeat(message, number=number, repeat=repeats)) / number * 1e9
+            for message in (before, after)
+        ]
+        print(
+            f"{name:>40}: {costs[0]:>8.0f} ns with pydantic, "
+            f"{costs[1]:>8.0f} ns with slots ({costs[0] / costs[1]:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--number", type=int, default=100000)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    main(args.number, args.repeats)
@@ -0,0 +1,102 @@
+"""
+Benchmark framing the sm130 stream: reading each response's length and then the rest of
+it a byte at a time until its delimiter, as x30Client used to, against the Framer.
+A Mockx30Instrument floods the port with streamed responses as fast as it can, with
+the delimiter either counted in each response's length or following it.
+
+Run from the repository root with:
+    PYTHONPATH=backend python -m data_collection_system.benchmarks.x30_framing
+"""
+import argparse
+import asyncio
+import threading
+import time
+
+from ..tests.utils import Mockx30Instrument
+from ..x30.x30_framer import Framer
+from ..x30.x30_protocol import (
+    DELIMITER,
+    SET_STREAMING_DATA,
+    STATUS_HEADER_LENGTH,
+    STOP_DELIMITER,
+)
+
+CHUNK = 100  # Responses per write from the mock instrument
+PEAKS = 80  # Peaks in every response, across the four channels
+
+
+def streamed_response(counted: bool) -> bytes:
+    data = bytes(STATUS_HEADER_LENGTH + 4 * PEAKS)
+    if counted:
+        return b"%010d" % (len(data) + len(DELIMITER)) + data + DELIMITER
+    return b"%010d" % len(data) + data + DELIMITER
+
+
+class FloodingMockx30Instrument(Mockx30Instrument):
+    def __init__(self, frames: int, counted: bool):
+        super().__init__()
+        self.frames = frames
+        self.counted = counted
+
+    def start(self):
+        conn, _ = self.socket.accept()
+        with conn:
+            conn.recv(1024)  # Enable streaming
+            chunk = CHUNK * streamed_response(self.counted)
+            for _ in range(self.frames // CHUNK):
+                conn.sendall(chunk)
+            conn.recv(1024)  # Disable streaming
+            data = b"Streaming data disabled.\n" + STOP_DELIMITER
+            conn.sendall(b"%010d" % len(data) + data)
+
+
+async def read_bytewise(reader: asyncio.StreamReader, frames: int):
+    for _ in range(frames):
+        length = int(await reader.read(10))
+        response = await reader.read(length)
+        while response[-8:] != DELIMITER:
+            response += await reader.read(1)
+
+
+async def read_framed(reader: asyncio.StreamReader, frames: int):
+    framer = Framer(reader)
+    for _ in range(frames):
+        await framer.read_streamed()
+
+
+async def run(read, frames: int, counted: bool) -> float:
+    with FloodingMockx30Instrument(frames, counted) as instrument:
+        thread = threading.Thread(target=instrument.start, daemon=True)
+        thread.start()
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", 9500)
+        writer.write(SET_STREAMING_DATA(val=True).serialize())
+        start = time.perf_counter()
+        await read(reader, frames)
+        elapsed = time.perf_counter() - start
+
+        writer.write(SET_STREAMING_DATA(val=False).serialize())
+        await Framer(reader).discard_until(STOP_DELIMITER)
+        writer.close()
+        thread.join()
+
+    return frames / elapsed
+
+
+async def main(frames: int, repeats: int):
+    for counted in (True, False):
+        for read in (read_bytewise, read_framed):
+            rates = [await run(read, frames, counted) for _ in range(repeats)]
+            print(
+                f"{'counted' if counted else 'trailing':>8} delimiter "
+                f"{read.__name__:>14}: {max(rates):>10.0f} frames/s"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--frames", type=int, default=100000)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(main(args.frames, args.repeats))
@@ -0,0 +1,71 @@
+"""
+Benchmark reading from the peak streaming port: the StreamReader based Connection
+against the FrameProtocol based StreamingConnection, per frame and in batches.
+A Mockx55Instrument floods the port with #GetPeaks responses as fast as it can.
+
+Run from the repository root with:
+    PYTHONPATH=backend python -m data_collection_system.benchmarks.x55_framing
+"""
+import argparse
+import asyncio
+import time
+
+from ..tests.utils import Mockx55Instrument
+from ..x55.x55_client import Connection, StreamingConnection, PEAK_STREAMING_PORT
+from ..x55.x55_protocol import PeakFrame
+
+CHUNK = 100  # Responses per write from the mock instrument
+
+
+class FloodingMockx55Instrument(Mockx55Instrument):
+    def __init__(self, frames: int):
+        super().__init__()
+        self.frames = frames
+        self.streaming = True
+
+    async def start_peaks(self, _, writer):
+        chunk = CHUNK * self.respond("#GetPeaks")
+        for _ in range(self.frames // CHUNK):
+            writer.write(chunk)
+            await writer.drain()
+
+
+async def read_frames(connection: Connection, frames: int):
+    for _ in range(frames):
+        PeakFrame(await connection.read())
+
+
+async def read_batches(connection: Connection, frames: int):
+    while frames > 0:
+        frames -= len(await connection.read_batch())
+
+
+async def run(connection_type, reader, frames: int) -> float:
+    async with FloodingMockx55Instrument(frames):
+        connection = connection_type("Benchmark", "127.0.0.1", PEAK_STREAMING_PORT)
+        await connection.connect()
+        start = time.perf_counter()
+        await reader(connection, frames)
+        elapsed = time.perf_counter() - start
+        await connection.disconnect()
+
+    return frames / elapsed
+
+
+async def main(frames: int, repeats: int):
+    for connection_type in (Connection, StreamingConnection):
+        for reader in (read_frames, read_batches):
+            rates = [await run(connection_type, reader, frames) for _ in range(repeats)]
+            print(
+                f"{connection_type.__name__:>20} {reader.__name__:>12}: "
+                f"{max(rates):>10.0f} frames/s"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--frames", type=int, default=100000)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(main(args.frames, args.repeats))
@@ -0,0 +1,241 @@
+"""
+Benchmark the whole of x55Client.record: streaming, decoding, mapping and writing to the
+database. A mock instrument streams #GetPeaks responses at a fixed rate, with a peak for
+every sensor in the metadata of the setup, for each combination of effective sampling
+rate, peaks per channel and setup option.
+Results are written as JSON, so that runs can be compared for regressions.
+
+The database is the one in DATABASE_URL, and with --postgres the same runs are repeated
+against a PostgreSQL database too. As every sensor is set recording for the runs, any
+database but the test one must be named a scratch database with --scratch (as --postgres
+is). The mock's timestamps start in 1980, long before any real rows, and only rows in
+the span of those timestamps are deleted again after each run.
+
+Run from the repository root with:
+    PYTHONPATH=backend python -m data_collection_system.benchmarks.x55_ingest
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from database_models import Packages
+from .. import db, Session, ROOT_DIR, DATABASE_URL, TEST_DATABASE_URL
+from ..configuration import Configuration, SetupOptions
+from ..tests.utils import Mockx55Instrument, PeakGenerator
+from ..x55.x55_client import x55Client
+from ..x55.x55_protocol import PeakBatch
+
+MAPPING_FRAMES = 1000  # Frames mapped to time Configuration.map
+MOCK_START = datetime(1980, 1, 1, tzinfo=timezone.utc)  # Of the mock's timestamps
+MOCK_SPAN = timedelta(days=1)  # Longer than the timestamps of any run span
+
+
+def mapping_time(configuration: Configuration, generator: PeakGenerator):
+    """Microseconds taken to map a frame to every table in the configuration."""
+    frames = b"".join(generator.response(i) for i in range(MAPPING_FRAMES))
+    batch, _ = PeakBatch.decode(frames)
+    start = time.perf_counter()
+    for table in configuration.sensors:
+        configuration.map(batch.peaks, table)
+    return (time.perf_counter() - start) / MAPPING_FRAMES * 10 ** 6
+
+
+def percentiles(latencies) -> dict:
+    if not latencies:
+        return {}
+    values = np.percentile(np.array(latencies) * 1000, [50, 90, 99, 100])
+    return dict(zip(["p50", "p90", "p99", "max"], values.tolist()))
+
+
+async def run(setup: SetupOptions, rate: int, peaks_per_channel: int, duration: float):
+    client = x55Client()
+    client.host = "127.0.0.1"
+    await client.update_setup(setup)
+    generator = PeakGenerator(
+        [table.__tablename__ for table in client.configuration.sensors],
+        peaks_per_channel,
+    )
+    mapping = mapping_time(client.configuration, generator)
+
+    with db.begin() as connection:
+        for table in client.configuration.sensors:
+            existing = connection.execute(
+                table.__table__.select()
+                .where(table.timestamp.between(MOCK_START, MOCK_START + MOCK_SPAN))
+                .limit(1)
+            ).fetchall()
+            if existing:
+                raise RuntimeError(
+                    "%s already has rows from %s, which the benchmark would delete"
+                    % (table.__tablename__, MOCK_START.date())
+                )
+
+    instrument = Mockx55Instrument(
+        generator,
+        scan_speed=rate,
+        start=int(MOCK_START.timestamp()) * 10 ** 9,
+    )
+    try:
+        async with instrument:
+            await client.connect()
+            start = time.monotonic()
+            recording = asyncio.ensure_future(client.record(batch=True))
+            await asyncio.sleep(duration)
+            client.streaming = False
+            await recording
+            elapsed = time.monotonic() - start
+            await client.disconnect()
+    finally:
+        # Don't leave the benchmark rows in the database, nor touch any others
+        end = MOCK_START + timedelta(
+            microseconds=instrument.sent * instrument.period // 1000
+        )
+        with db.begin() as connection:
+            for table in client.configuration.sensors:
+                connection.execute(
+                    table.__table__.delete().where(
+                        table.timestamp.between(MOCK_START, end)
+                    )
+                )
+
+    written = min(writer.written_rows for writer in client.writers)
+    return {
+        "setup": str(setup),
+        "rate": rate,
+        "peaks_per_channel": peaks_per_channel,
+        "duration": elapsed,
+        "frames_sent": instrument.sent,
+        "frames_written": written,
+        "frames_per_second": written / elapsed,
+        "dropped_frames": instrument.sent - written,
+        "mapping_us_per_frame": mapping,
+        "tables": {
+            writer.name: {
+                "rows_written": writer.written_rows,
+                "commit_latency_ms": percentiles(writer.latencies),
+                "queue_high_water_mark": writer.queue.high_water_mark,
+                "queue_dropped_rows": writer.queue.dropped,
+            }
+            for writer in client.writers
+        },
+    }
+
+
+async def main(args) -> list:
+    os.makedirs(os.path.join(ROOT_DIR, "var"), exist_ok=True)
+
+    # Record every sensor, then put the metadata back as it was
+    session = Session()
+    packages = (Packages.basement, Packages.strong_floor, Packages.steel_frame)
+    recording = {
+        package: [
+            row.uid
+            for row in session.query(package.metadata_table).filter_by(recording=True)
+        ]
+        for package in packages
+    }
+    for package in packages:
+        session.query(package.metadata_table).update({"recording": True})
+    session.commit()
+
+    results = []
+    try:
+        for setup in args.setups:
+            for peaks_per_channel in args.peaks:
+                for rate in args.rates:
+                    result = await run(setup, rate, peaks_per_channel, args.duration)
+                    result["database"] = db.dialect.name
+                    print(
+                        f"{db.dialect.name:>10} {str(setup):>18} {rate:>5} Hz "
+                        f"{peaks_per_channel:>3} peaks: "
+                        f"{result['frames_per_second']:>8.0f} frames/s, "
+                        f"{result['dropped_frames']:>6} dropped, "
+                        f"{result['mapping_us_per_frame']:>6.1f} µs/frame mapping",
+                        file=sys.stderr,
+                    )
+                    results.append(result)
+    finally:
+        for package in packages:
+            session.query(package.metadata_table).update(
+                {"recording": package.metadata_table.uid.in_(recording[package])},
+                synchronize_session=False,
+            )
+        session.commit()
+        session.close()
+
+    return results
+
+
+def run_against(database_url: str, argv: list) -> list:
+    """Repeat the benchmark in a subprocess connected to another database."""
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, "results.json")
+        subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                __spec__.name,
+                *argv,
+                "--scratch",
+                "--output",
+                output,
+            ],
+            env=dict(os.environ, DATABASE_URL=database_url),
+            check=True,
+        )
+        with open(output) as f:
+            return json.load(f)["results"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--rates", type=int, nargs="+", default=[10, 100, 1000, 2500, 5000]
+    )
+    parser.add_argument("--peaks", type=int, nargs="+", default=[4, 20])
+    parser.add_argument(
+        "--setups",
+        type=lambda name: SetupOptions[name],
+        nargs="+",
+        default=list(SetupOptions),
+        help="Names of SetupOptions",
+    )
+    parser.add_argument("--duration", type=float, default=5, help="Seconds per run")
+    parser.add_argument("--postgres", help="URL of a PostgreSQL database to also run")
+    parser.add_argument(
+        "--scratch",
+        action="store_true",
+        help="Allow DATABASE_URL to be other than the test database",
+    )
+    parser.add_argument("--output", help="JSON file to write, instead of stdout")
+    args, argv = parser.parse_args(), sys.argv[1:]
+    if DATABASE_URL != TEST_DATABASE_URL and not args.scratch:
+        parser.error(
+            "DATABASE_URL is not the test database, so add --scratch if it is one"
+        )
+
+    started = datetime.now(timezone.utc)
+    results = asyncio.get_event_loop().run_until_complete(main(args))
+    if args.postgres:
+        i = argv.index("--postgres")
+        results += run_against(args.postgres, argv[:i] + argv[i + 2 :])
+
+    report = {
+        "started": started.isoformat(),
+        "python": platform.python_version(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
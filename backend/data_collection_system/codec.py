@@ -0,0 +1,89 @@
+from datetime import datetime
+from enum import Enum
+from typing import Callable, Dict, Tuple
+
+
+class MessageMeta(type):
+    """
+    Give every message class __slots__ for the fields it annotates, so that messages are
+    as small and quick to construct as plain tuples, and record the names of all its
+    fields, including those inherited, in _fields.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        inherited = tuple(
+            field for base in bases for field in getattr(base, "_fields", ())
+        )
+        annotations = namespace.get("__annotations__", {})
+        new = tuple(
+            field
+            for field in annotations
+            if not field.startswith("_") and field not in inherited
+        )
+        namespace["__slots__"] = new
+        namespace["_fields"] = inherited + new
+        return super().__new__(mcs, name, bases, namespace)
+
+
+class Message(metaclass=MessageMeta):
+    """
+    Base of the requests and responses of both protocols: a fixed set of fields given as
+    keywords, without any validation or coercion, so that building one costs no more than
+    setting its attributes. As with the pydantic models these replaced, any other
+    keywords are ignored.
+    """
+
+    _fields: Tuple[str, ...] = ()
+
+    def __init__(self, **values):
+        for field in self._fields:
+            try:
+                setattr(self, field, values[field])
+            except KeyError:
+                raise TypeError(f"{type(self).__name__} is missing {field}") from None
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, field) == getattr(other, field) for field in self._fields
+        )
+
+    def __repr__(self):
+        fields = ", ".join(
+            f"{field}={getattr(self, field, None)!r}" for field in self._fields
+        )
+        return f"{type(self).__name__}({fields})"
+
+    def dict(self) -> dict:
+        return {field: getattr(self, field) for field in self._fields}
+
+
+def ascii_serializer(value) -> bytes:
+    # By value, as str of an enum member is its name, or from 3.11 for IntEnum its value
+    if isinstance(value, Enum):
+        value = value.value
+    return str(value).encode("ascii")
+
+
+def bool_serializer(value) -> bytes:
+    return b"1" if value else b"0"
+
+
+def serializers(
+    cls, by_type: Dict[type, Callable], exclude: Tuple[str, ...] = ()
+) -> Tuple[Tuple[str, Callable], ...]:
+    """
+    Choose the serializer of every field of a request class once, when the class is
+    defined, by its annotated type, rather than looking each one up on every request.
+    """
+    annotations = {}
+    for klass in reversed(cls.__mro__):
+        annotations.update(getattr(klass, "__annotations__", {}))
+    return tuple(
+        (field, by_type.get(annotations[field], ascii_serializer))
+        for field in cls._fields
+        if field not in exclude
+    )
+
+
+def datetime_serializer(format: str) -> Callable[[datetime], bytes]:
+    return lambda value: value.strftime(format).encode("ascii")
@@ -0,0 +1,187 @@
+import asyncio
+import os
+import pickle
+import time
+from typing import Dict, List
+
+from . import logger, ROOT_DIR
+from .configuration import SetupOptions
+from .x55.x55_client import x55Client
+
+
+class Collector:
+    """
+    Record from several si255s at once in one event loop, each through its own x55Client
+    with its own Configuration, queues and database writers.
+    Every instrument is connected to and recorded from independently, so one failing,
+    whether to connect or part way through recording, is logged and leaves the others
+    running. A full queue holds up only its own client's task, and a failed database
+    writer ends only its own client's recording. Each table can only be recorded by
+    one instrument, and the status file for the web server covers the packages of them
+    all.
+    """
+
+    def __init__(self):
+        self.clients: List[x55Client] = []
+        self.errors: Dict[str, Exception] = {}  # Of every client that has failed
+        self.recording = False
+        self.stopping = False
+        self.started = None  # When recording started
+        self.counts = {}  # Responses received by every client when recording started
+
+    def add(self, host: str, setup: SetupOptions, **options) -> x55Client:
+        """
+        Add an instrument at host recording the sensors of setup, with any other
+        x55Client attributes (ports, spool, pipeline_workers, ...) set from options.
+        """
+        client = x55Client()
+        client.host = host
+        client.live_status = False
+        client.configuration.load(setup)
+        for name, value in options.items():
+            if not hasattr(client, name):
+                raise AttributeError(f"x55Client has no option {name}")
+            setattr(client, name, value)
+
+        self._check_tables(client)
+        self.clients.append(client)
+        return client
+
+    def update_setup(self, client: x55Client, setup: SetupOptions):
+        """Change the setup of an instrument, which must not be recording."""
+        if client.recording:
+            raise RuntimeError(f"{client.name} is recording")
+        previous = client.configuration.setup
+        client.configuration.load(setup)
+        try:
+            self._check_tables(client)
+        except ValueError:
+            client.configuration.load(previous)
+            raise
+        return client.configuration.setup
+
+    @property
+    def connected(self) -> List[x55Client]:
+        return [client for client in self.clients if client.connected]
+
+    @property
+    def throughput(self) -> dict:
+        """Responses received and rows written by every instrument and in total."""
+        elapsed = time.monotonic() - self.started if self.started else None
+        instruments = {}
+        for client in self.clients:
+            received = client.peaks.received if client.peaks is not None else 0
+            received -= self.counts.get(client.name, 0)
+            written = client.written_rows
+            instruments[client.name] = {
+                "host": client.host,
+                "setup": str(client.configuration.setup),
+                "connected": client.connected,
+                "recording": client.recording,
+                "error": repr(self.errors[client.name])
+                if client.name in self.errors
+                else None,
+                "received": received,
+                "written": written,
+                "received_rate": received / elapsed if elapsed else None,
+                "written_rate": written / elapsed if elapsed else None,
+            }
+
+        total = {
+            key: sum(instrument[key] or 0 for instrument in instruments.values())
+            for key in ("received", "written", "received_rate", "written_rate")
+        }
+        return {"instruments": instruments, "total": total}
+
+    async def connect(self):
+        results = await asyncio.gather(
+            *(client.connect() for client in self.clients), return_exceptions=True
+        )
+        for client, result in zip(self.clients, results):
+            if isinstance(result, Exception):
+                self.errors[client.name] = result
+                logger.error(
+                    "%s failed to connect to %s: %r", client.name, client.host, result
+                )
+
+    async def disconnect(self):
+        await asyncio.gather(
+            *(client.disconnect() for client in self.connected), return_exceptions=True
+        )
+
+    async def record(self, batch: bool = True):
+        """Record from every connected instrument until stopped or they all fail."""
+        self.recording = True
+        self.stopping = False
+        self.started = time.monotonic()
+        self.counts = {client.name: client.peaks.received for client in self.connected}
+
+        await asyncio.gather(
+            *(self._record(client, batch) for client in self.connected)
+        )
+
+        self.recording = False
+        self.set_live_status(False)
+
+        throughput = self.throughput["total"]
+        logger.info(
+            "Collector received %d responses and wrote %d rows per table in total",
+            throughput["received"],
+            throughput["written"],
+        )
+
+    def stop(self):
+        self.stopping = True
+        for client in self.clients:
+            client.streaming = False
+
+    async def _record(self, client: x55Client, batch: bool):
+        try:
+            await client.update_status()
+            if self.stopping:
+                return
+            self.set_live_status(True)
+            await client.record(batch)
+        except Exception as e:
+            client.streaming = False
+            self.errors[client.name] = e
+            logger.exception(
+                "%s failed while recording from %s", client.name, client.host
+            )
+            try:
+                await client.disconnect()
+            except (OSError, asyncio.IncompleteReadError):
+                client.connected = False  # The connection is already gone
+
+    def _check_tables(self, client: x55Client):
+        """Raise ValueError if another instrument records to any of client's tables."""
+        tables = set(client.configuration.sensors)
+        for other in self.clients:
+            shared = tables & set(other.configuration.sensors)
+            if other is not client and shared:
+                raise ValueError(
+                    "%s and %s would both record to %s"
+                    % (
+                        client.host,
+                        other.host,
+                        ", ".join(table.__tablename__ for table in shared),
+                    )
+                )
+
+    def set_live_status(self, live: bool):
+        recording = [client for client in self.clients if client.recording]
+        recording = recording or self.connected
+        rates = [client.effective_sampling_rate for client in recording]
+        status = {
+            "live": live,
+            "packages": [
+                package
+                for client in recording
+                for package in client.configuration.packages
+            ],
+            "sampling_rate": max(
+                (rate for rate in rates if rate is not None), default=None
+            ),
+        }
+        with open(os.path.join(ROOT_DIR, "var/status.pickle"), "wb") as f:
+            pickle.dump(status, f)
@@ -0,0 +1,242 @@
+import re
+import string
+import xml.etree.ElementTree as ET
+from enum import IntEnum
+from collections import Counter
+
+import numpy as np
+
+from . import logger, Session, Base, Packages
+
+
+class SetupOptions(IntEnum):
+    BASEMENT_AND_FRAME = 0
+    STRONG_FLOOR = 1
+    BASEMENT = 2
+    FRAME = 3
+
+    def __str__(self):
+        return self._name_.replace("_", " ")
+
+
+class SensorTable:
+    """
+    The metadata of the recording sensors in one table, compiled into NumPy arrays so that
+    mapping a frame, or a batch of frames, is a few array operations.
+    Sensors are sorted by channel and then by wavelength window, and channels holds the
+    (channel, start, stop) slice of the sensors on each channel.
+    """
+
+    def __init__(self, rows):
+        rows = sorted(
+            (
+                row
+                for row in rows
+                if row.recording
+                and row.channel is not None
+                and row.minimum_wavelength is not None
+                and row.maximum_wavelength is not None
+            ),
+            key=lambda row: (row.channel, row.minimum_wavelength),
+        )
+        self.uids = [row.uid for row in rows]
+        self.channel = np.array([row.channel for row in rows], dtype=np.intp)
+        self.minimum_wavelength = np.array(
+            [row.minimum_wavelength for row in rows], dtype=np.float64
+        )
+        self.maximum_wavelength = np.array(
+            [row.maximum_wavelength for row in rows], dtype=np.float64
+        )
+
+        channels, starts = np.unique(self.channel, return_index=True)
+        stops = np.append(starts[1:], len(rows))
+        self.channels = list(zip(channels.tolist(), starts.tolist(), stops.tolist()))
+
+        # Each peak is matched to at most one window, so windows must not overlap
+        overlapping = (self.maximum_wavelength[:-1] > self.minimum_wavelength[1:]) & (
+            self.channel[:-1] == self.channel[1:]
+        )
+        for i in np.nonzero(overlapping)[0]:
+            logger.warning(
+                "Wavelength windows of %s and %s overlap",
+                self.uids[i],
+                self.uids[i + 1],
+            )
+
+    def __len__(self):
+        return len(self.uids)
+
+
+class Configuration:
+    def __init__(self):
+        self.mapping = None  # For every table, for every channel, map an index to an ID
+        self.sensors = None  # For every table, the recording sensors as arrays
+        self.unmatched_peaks = Counter()  # For every table, count peaks left unmapped
+        self.setup = None  # Store the current sensor setup
+        self.load(SetupOptions.BASEMENT_AND_FRAME)
+
+    @property
+    def packages(self):
+        """
+        Return the packages associated with the current sensor setup.
+        """
+        if self.setup == SetupOptions.BASEMENT_AND_FRAME:
+            return (
+                Packages.basement,
+                Packages.steel_frame,
+            )
+        if self.setup == SetupOptions.STRONG_FLOOR:
+            return (Packages.strong_floor,)
+        if self.setup == SetupOptions.BASEMENT:
+            return (Packages.basement,)
+        if self.setup == SetupOptions.FRAME:
+            return (Packages.steel_frame,)
+
+    def map(self, peaks: np.ndarray, table: Base) -> np.ndarray:
+        """
+        Map a padded (16, max_peaks) peaks array, or an (N, 16, max_peaks) batch of them, to
+        an array of values for the given database table, with a column for every UID in
+        self.sensors[table].uids and NaN wherever a sensor was not found.
+        Each sensor takes the first peak inside its wavelength window, so dropped readings
+        leave a gap and extra readings, such as from a noisy grating or a reflection, are
+        skipped and added to self.unmatched_peaks[table] rather than shifting other sensors.
+        To turn off the recording of individual sensors set recording to false in its metadata.
+        If a sensor can no longer be read at all by the optical instrument, remove its row from the metadata table entirely.
+        """
+        sensors = self.sensors[table]
+        frames = peaks.reshape((-1,) + peaks.shape[-2:])
+        values = np.full((len(frames), len(sensors)), np.nan)
+
+        for channel, start, stop in sensors.channels:
+            if channel >= frames.shape[1]:  # Channel not present on this instrument
+                continue
+            channel_peaks = frames[:, channel]
+            minimum_wavelength = sensors.minimum_wavelength[start:stop]
+            maximum_wavelength = sensors.maximum_wavelength[start:stop]
+
+            # Merge the peaks into the sorted windows: find the last window starting
+            # below each peak and check that the peak is also below its end
+            window = np.searchsorted(minimum_wavelength, channel_peaks, side="left") - 1
+            inside = (window >= 0) & (
+                channel_peaks < maximum_wavelength[np.maximum(window, 0)]
+            )  # Comparisons with the NaN padding are always false
+
+            # Keep the first peak inside each window of each frame
+            count = stop - start
+            frame = np.nonzero(inside)[0]
+            keys, first = np.unique(frame * count + window[inside], return_index=True)
+            rows, columns = np.divmod(keys, count)
+            values[rows, start + columns] = channel_peaks[inside][first]
+
+            # Every other peak is either out-of-band or an extra reading
+            self.unmatched_peaks[table] += int(
+                np.count_nonzero(~np.isnan(channel_peaks)) - len(keys)
+            )
+
+        return values.reshape(peaks.shape[:-2] + (len(sensors),))
+
+    def load(self, setup: SetupOptions):
+        """
+        Load a new configuration from database metadata tables.
+        """
+        self.setup = setup
+        self.mapping = {}  # {Basement: {"A1": row, ...}, ... }
+        self.sensors = {}  # {Basement: SensorTable, ... }
+
+        # Load in metadata from tables to mapping
+        session = Session()
+        for package in self.packages:
+            self.mapping[package.values_table] = {
+                row.uid: row for row in session.query(package.metadata_table).all()
+            }
+            self.sensors[package.values_table] = SensorTable(
+                self.mapping[package.values_table].values()
+            )
+        session.close()
+
+        logger.info("Loaded configuration from database")
+
+        return self.setup
+
+    def parse(self, config_file):
+        """
+        Parse and save a configuration to the database metadata tables.
+        Any sensor UIDs or names referenced in the file that exist will be updated,
+        but additional UIDs or names in the file will be ignored. It is therefore
+        safe to update just Basement metadata table from a combined config file, whilst
+        it is also safe to update both the Basement and Steel Frame metadata tables simultaneously.
+        """
+        session = Session()
+
+        root = ET.parse(config_file).getroot()
+
+        for package in self.packages:
+            # Data associated with a UID
+            for sensor in root.iter("SensorConfiguration"):
+                uid = re.search("[^_]{1,3}$", sensor.find("Name").text)[0]
+                reference_wavelength = sensor.find("Reference").text
+                minimum_wavelength = sensor.find("WavelengthMinimum").text
+                maximum_wavelength = sensor.find("WavelengthMaximum").text
+
+                channel = string.ascii_uppercase.index(uid[0])
+                index = int(uid[1:]) - 1
+
+                data = {
+                    "channel": channel,
+                    "index": index,
+                    "reference_wavelength": reference_wavelength,
+                    "minimum_wavelength": minimum_wavelength,
+                    "maximum_wavelength": maximum_wavelength,
+                }
+                if data:
+                    session.query(package.metadata_table).filter(
+                        package.metadata_table.uid == uid
+                    ).update(data)
+
+            # Data associated with a sensor name
+            for transducer in root.iter("Transducer"):
+                name = transducer.find("ID").text
+                coeffs = {}
+                for constant in transducer.iter("TransducerConstant"):
+                    constant_name = constant.find("Name").text
+                    constant_value = float(constant.find("Value").text)
+
+                    if constant_name.startswith("FBG") and constant_name.endswith("0"):
+                        uid = re.search("_([^;]*)_", constant_name)[1]
+                        session.query(package.metadata_table).filter(
+                            package.metadata_table.uid == uid
+                        ).update({"initial_wavelength": constant_value})
+
+                    else:
+                        # Handle edge cases caused by lack of formulas and differently named coefficients in Enlight
+                        if constant_name == "K":  # beta is sometimes called K
+                            constant_name = "beta"
+                        elif (
+                            constant_name == "CTEt"
+                        ):  # CTEt is in units 10^-6/C in Enlight
+                            constant_value /= 1e6
+                        elif constant_name == "St":  # Also record St in tmp sensor row
+                            sensor = (
+                                session.query(package.metadata_table)
+                                .filter(package.metadata_table.name == name)
+                                .first()
+                            )
+                            if sensor and sensor.type == "str":
+                                tmp_uid = sensor.corresponding_sensor
+                                session.query(package.metadata_table).filter(
+                                    package.metadata_table.uid == tmp_uid
+                                ).update({"coeffs": {"St": constant_value}})
+
+                        coeffs[constant_name] = constant_value
+
+                if coeffs:
+                    session.query(package.metadata_table).filter(
+                        package.metadata_table.name == name
+                    ).update({"coeffs": coeffs})
+
+        session.commit()
+        session.close()
+
+        logger.info("Uploaded new configuration file to database")
+
+        self.load(self.setup)  # Load the newly parsed config file
@@ -0,0 +1,186 @@
+"""
+Run the data collection system headless, recording from the instruments in a JSON
+configuration file without the GUI, so that nothing but acquisition runs on the event
+loop. A small control and status API on a local TCP port lets the GUI or other tools
+start and stop recording, change the setup or divider and read metrics.
+
+Run from the repository root with:
+    PYTHONPATH=backend python -m data_collection_system.daemon config.json
+
+where config.json is, for example:
+    {
+        "instruments": [
+            {"host": "10.0.0.55", "setup": "BASEMENT_AND_FRAME", "options": {"spool": true}}
+        ],
+        "record": true
+    }
+
+Control requests and responses are single lines of JSON, for example
+{"command": "divider", "instrument": 0, "divider": 10}. Every response has "ok", and
+then either the result or an "error".
+"""
+import argparse
+import asyncio
+import json
+import signal
+
+from . import logger
+from .collector import Collector
+from .configuration import SetupOptions
+
+CONTROL_HOST = "127.0.0.1"
+CONTROL_PORT = 52000
+DEFAULTS = {
+    "instruments": [],
+    "record": True,  # Start recording straight away
+    "batch": True,  # Decode responses in batches
+    "control_host": CONTROL_HOST,
+    "control_port": CONTROL_PORT,
+}
+
+
+def load_config(path: str) -> dict:
+    with open(path) as f:
+        config = dict(DEFAULTS, **json.load(f))
+    if not config["instruments"]:
+        raise ValueError(f"No instruments in {path}")
+    return config
+
+
+class Daemon:
+    """Collector of the configured instruments, controlled over a local TCP port."""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.collector = Collector()
+        for instrument in config["instruments"]:
+            self.collector.add(
+                instrument["host"],
+                SetupOptions[instrument.get("setup", "BASEMENT_AND_FRAME")],
+                **instrument.get("options", {}),
+            )
+        self.server = None
+        self.recording = None  # Task recording from every instrument
+        self.shutdown = None  # Event set to shut down the daemon
+        self.commands = {
+            "status": self.status,
+            "start": self.start,
+            "stop": self.stop,
+            "setup": self.setup,
+            "divider": self.divider,
+            "shutdown": self.request_shutdown,
+        }
+
+    async def run(self):
+        """Connect, serve control requests and record until shut down."""
+        self.shutdown = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signal_number, self.shutdown.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # Not in the main thread, or not supported on this platform
+
+        await self.collector.connect()
+        self.server = await asyncio.start_server(
+            self.handle, self.config["control_host"], self.config["control_port"]
+        )
+        logger.info(
+            "Daemon listening for control requests on %s:%d",
+            self.config["control_host"],
+            self.config["control_port"],
+        )
+        if self.config["record"]:
+            await self.start()
+
+        await self.shutdown.wait()
+
+        logger.info("Daemon shutting down")
+        await self.stop()
+        self.server.close()
+        await self.server.wait_closed()
+        await self.collector.disconnect()
+
+    async def handle(self, reader, writer):
+        """Answer control requests on one connection until it closes."""
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                command = self.commands[request.pop("command")]
+                response = {"ok": True, **await command(**request)}
+            except Exception as e:
+                response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+        writer.close()
+
+    def client(self, instrument: int):
+        return self.collector.clients[instrument]
+
+    async def status(self) -> dict:
+        throughput = self.collector.throughput
+        for client in self.collector.clients:
+            throughput["instruments"][client.name].update(
+                {
+                    "laser_scan_speed": client.laser_scan_speed,
+                    "peak_data_streaming_divider": client.peak_data_streaming_divider,
+                    "effective_sampling_rate": client.effective_sampling_rate,
+                    "monitor": client.monitor_status,
+                    "spool": client.spool_status,
+                    "pipeline": client.pipeline_status,
+                }
+            )
+        return {"recording": self.collector.recording, **throughput}
+
+    async def start(self) -> dict:
+        if self.recording is None or self.recording.done():
+            self.recording = asyncio.ensure_future(
+                self.collector.record(self.config["batch"])
+            )
+        return {"recording": True}
+
+    async def stop(self) -> dict:
+        """Stop recording, once the remaining stream has been drained and written."""
+        if self.recording is not None:
+            self.collector.stop()
+            await self.recording
+            self.recording = None
+        return {"recording": False}
+
+    async def setup(self, setup: str, instrument: int = 0) -> dict:
+        setup = self.collector.update_setup(
+            self.client(instrument), SetupOptions[setup]
+        )
+        return {"setup": setup.name}
+
+    async def divider(self, divider: int, instrument: int = 0) -> dict:
+        client = self.client(instrument)
+        return {"divider": await client.update_peak_data_streaming_divider(divider)}
+
+    async def request_shutdown(self) -> dict:
+        self.shutdown.set()
+        return {}
+
+
+async def request(
+    command: str, host: str = CONTROL_HOST, port: int = CONTROL_PORT, **arguments
+) -> dict:
+    """Send one control request to a running daemon and return its response."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(json.dumps({"command": command, **arguments}).encode() + b"\n")
+        return json.loads(await reader.readline())
+    finally:
+        writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("config", help="JSON configuration file")
+    args = parser.parse_args()
+
+    daemon = Daemon(load_config(args.config))
+    asyncio.get_event_loop().run_until_complete(daemon.run())
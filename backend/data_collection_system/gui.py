@@ -1,7 +1,5 @@
 import logging
 from asyncio import sleep
-from socket import gethostbyname
-from ipaddress import ip_address
 
 import wx
 from wx.lib.mixins import listctrl
@@ -11,8 +9,11 @@ from . import logger, logFormatter
 from .x55.x55_client import (
     x55Client,
     SetupOptions,
+    resolve,
 )
 
+NTP_SERVER = "ntp0.cam.ac.uk"
+
 
 class CustomConsoleHandler(logging.StreamHandler):
     def __init__(self, ctrl):
@@ -115,6 +116,9 @@ class Gui(wx.Frame):
             "instrument_time": "Instrument time",
             "ntp_enabled": "NTP server enabled",
             "ntp_server": "NTP server address",
+            "pipeline_status": "Pipeline workers",
+            "spool_status": "Spool",
+            "monitor_status": "Streaming lag",
         }
         for status in self.statuses:
             setattr(self, status, wx.StaticText(self, wx.ID_ANY, "None"))
@@ -326,12 +330,12 @@ class Gui(wx.Frame):
 
     async def update_status(self):
         while self.client.connected:
-            if self.client.command.reading.locked():
+            if self.client.command.busy:
                 await sleep(0.1)
                 continue
 
             # Update NTP server address if it has changed
-            ntp_server = ip_address(gethostbyname("ntp0.cam.ac.uk"))
+            ntp_server = await resolve(NTP_SERVER)
             if self.client.ntp_server != ntp_server:
                 await self.client.update_ntp_server(ntp_server)
             await self.client.update_status()
@@ -0,0 +1,329 @@
+import asyncio
+import multiprocessing
+import queue
+import sys
+import time
+from struct import pack_into, unpack_from
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from . import logger, db
+from .configuration import Configuration, SetupOptions
+from .spool import Spool, spool_directory
+from .writers import (
+    TableInsert,
+    BoundedQueue,
+    OverflowPolicy,
+    BatchPolicy,
+    DatabaseWriter,
+)
+from .x55.x55_protocol import PeakBatch
+
+RING_SIZE = 2 ** 26  # bytes
+POLL_INTERVAL = 0.001  # Seconds between checks of the ring when it is empty or full
+STATUS_INTERVAL = 1  # Seconds between status reports from each worker
+LENGTH = 4  # bytes before each block in the ring
+WRAP = 0  # Length marking that the rest of the ring is unused until the next lap
+
+
+class FrameRing:
+    """
+    Single producer, broadcast ring buffer in shared memory.
+    The producer appends blocks of framed responses and every consumer reads every block.
+    Positions count bytes written or read since the start, so the offset into the ring
+    is the position modulo its size, and a block only ever overwrites space that every
+    consumer has already read. Blocks are never split across the end of the ring.
+    """
+
+    def __init__(self, size: int, consumers: int, context=multiprocessing):
+        self.size = size
+        self.consumers = consumers
+        self.data = context.RawArray("B", size)
+        # Write position, closed flag and then the read position of every consumer
+        self.positions = context.RawArray("q", 2 + consumers)
+        self.view = memoryview(np.frombuffer(self.data, np.uint8))
+
+    def __getstate__(self):
+        return self.size, self.consumers, self.data, self.positions
+
+    def __setstate__(self, state):
+        self.size, self.consumers, self.data, self.positions = state
+        self.view = memoryview(np.frombuffer(self.data, np.uint8))
+
+    @property
+    def closed(self) -> bool:
+        return bool(self.positions[1])
+
+    def close(self):
+        self.positions[1] = 1
+
+    def pending(self, consumer: int) -> int:
+        """Bytes written that a consumer has not yet read."""
+        return self.positions[0] - self.positions[2 + consumer]
+
+    def write(self, block) -> bool:
+        """
+        Append a block, or return False if there is not yet space for it.
+        An empty block is never appended, as its length would read as WRAP.
+        """
+        length = len(block)
+        if not length:
+            return True
+        if LENGTH + length > self.size // 2:
+            raise ValueError("Block of %d bytes is too large for the ring" % length)
+
+        position = self.positions[0]
+        offset = position % self.size
+        skip = self.size - offset if self.size - offset < LENGTH + length else 0
+        slowest = min(self.positions[2:])
+        if position + skip + LENGTH + length - slowest > self.size:
+            return False
+
+        if skip:
+            if skip >= LENGTH:
+                pack_into("<I", self.view, offset, WRAP)
+            position += skip
+            offset = 0
+
+        pack_into("<I", self.view, offset, length)
+        self.view[offset + LENGTH : offset + LENGTH + length] = block
+        self.positions[0] = position + LENGTH + length  # Publish once it is all written
+        return True
+
+    def read(self, consumer: int) -> Optional[Tuple[memoryview, int]]:
+        """
+        Return the next block for a consumer, if there is one, and the position after it.
+        The block stays valid until the consumer passes that position to advance.
+        """
+        position = self.positions[2 + consumer]
+        if position == self.positions[0]:
+            return None
+
+        offset = position % self.size
+        if (
+            self.size - offset < LENGTH
+            or unpack_from("<I", self.view, offset)[0] == WRAP
+        ):
+            position += self.size - offset
+            offset = 0
+
+        length = unpack_from("<I", self.view, offset)[0]
+        block = self.view[offset + LENGTH : offset + LENGTH + length]
+        return block, position + LENGTH + length
+
+    def advance(self, consumer: int, position: int):
+        self.positions[2 + consumer] = position
+
+
+def worker(
+    ring: FrameRing,
+    consumer: int,
+    setup: SetupOptions,
+    table_names: List[str],
+    status: multiprocessing.Queue,
+    queue_size: int,
+    overflow_policy: OverflowPolicy,
+    spool: bool,
+):
+    """
+    Decode, map and write to the database the tables named in table_names, from every
+    block of framed responses in the ring, reporting progress on the status queue.
+    Runs in its own process.
+    """
+    configuration = Configuration()
+    configuration.load(setup)
+    tables = [
+        table for table in configuration.sensors if table.__tablename__ in table_names
+    ]
+
+    queues = {
+        table: Spool(spool_directory(table), configuration.sensors[table].uids)
+        if spool
+        else BoundedQueue(queue_size, overflow_policy)
+        for table in tables
+    }
+    writers = [
+        DatabaseWriter(
+            db,
+            TableInsert(table, configuration.sensors[table].uids, db.dialect),
+            queues[table],
+            BatchPolicy(),
+        )
+        for table in tables
+    ]
+    for writer in writers:
+        writer.start()
+
+    frames = 0
+    last_status = time.monotonic()
+
+    def report(running: bool):
+        status.put(
+            {
+                "worker": consumer,
+                "running": running,
+                "tables": table_names,
+                "frames": frames,
+                "behind": ring.pending(consumer),
+                "queued": sum(len(q) for q in queues.values()),
+                "dropped": sum(q.dropped for q in queues.values()),
+                "written": sum(writer.written_rows for writer in writers),
+                "spooled": sum(q.depth for q in queues.values() if q.durable),
+                "replay_rate": sum(q.replay_rate for q in queues.values() if q.durable),
+                "unmatched_peaks": sum(configuration.unmatched_peaks.values()),
+            }
+        )
+
+    try:
+        while True:
+            block = ring.read(consumer)
+            if block is None:
+                if ring.closed and not ring.pending(consumer):
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            frames_view, position = block
+            batch, _ = PeakBatch.decode(frames_view)
+            frames_view.release()
+            ring.advance(consumer, position)
+
+            timestamps = batch.datetimes
+            for table, q in queues.items():
+                q.put((timestamps, configuration.map(batch.peaks, table)))
+            frames += len(batch)
+
+            if time.monotonic() - last_status > STATUS_INTERVAL:
+                last_status = time.monotonic()
+                report(True)
+    finally:
+        # Whatever ended the loop, as the process can't exit while a writer is running
+        for writer in writers:
+            writer.stop()
+            writer.queue.close()
+        report(False)
+
+    # A writer may have failed after the last put, which would not have raised
+    failed = [writer.name for writer in writers if writer.error is not None]
+    if failed:
+        logger.error(
+            "Pipeline worker %d failed writing %s", consumer, ", ".join(failed)
+        )
+        sys.exit(1)
+
+
+class Pipeline:
+    """
+    Decode, map and write peaks in worker processes, outside of the interpreter running
+    the asyncio reader and the GUI, so that they never contend for the GIL.
+    The reader only frames responses and copies them into a shared memory FrameRing,
+    the tables are shared out between the workers, and each worker sends its status
+    back on a queue which poll_status collects.
+    """
+
+    def __init__(
+        self,
+        setup: SetupOptions,
+        tables: list,
+        workers: int,
+        queue_size: int,
+        overflow_policy: OverflowPolicy,
+        spool: bool = False,
+        ring_size: int = RING_SIZE,
+    ):
+        # Spawn rather than fork, so workers don't inherit the GUI or database connections
+        context = multiprocessing.get_context("spawn")
+        workers = max(1, min(workers, len(tables)))
+
+        self.ring = FrameRing(ring_size, workers, context)
+        self.status_queue = context.Queue()
+        self.status = {}  # Latest status from each worker
+        self.processes = [
+            context.Process(
+                target=worker,
+                args=(
+                    self.ring,
+                    i,
+                    setup,
+                    [table.__tablename__ for table in tables[i::workers]],
+                    self.status_queue,
+                    queue_size,
+                    overflow_policy,
+                    spool,
+                ),
+                daemon=True,
+            )
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        logger.info("Started %d pipeline worker processes", len(self.processes))
+
+    async def put(self, frames):
+        """
+        Copy a block of framed responses into the ring, waiting for space if need be.
+        Raises RuntimeError if a worker has died while waiting, as it would never read
+        past the block holding up the ring.
+        """
+        if self.ring.write(frames):
+            return
+        frames = bytes(frames)  # The view may not outlive the next await
+        while not self.ring.write(frames):
+            self.check()
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def check(self):
+        """Raise RuntimeError if any worker has exited before the ring was closed."""
+        for i, process in enumerate(self.processes):
+            if not process.is_alive():
+                raise RuntimeError(
+                    "Pipeline worker %d exited with code %s" % (i, process.exitcode)
+                )
+
+    def poll_status(self) -> dict:
+        while True:
+            try:
+                status = self.status_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.status[status["worker"]] = status
+        # A worker that died never reported that it stopped
+        for i, status in self.status.items():
+            status["running"] = status["running"] and self.processes[i].is_alive()
+        return self.status
+
+    async def stop(self):
+        """
+        Let the workers finish everything in the ring and wait for them to exit, raising
+        RuntimeError if any of them failed.
+        """
+        self.ring.close()
+        loop = asyncio.get_event_loop()
+        for process in self.processes:
+            while process.is_alive():
+                self.poll_status()  # Keep the status queue drained so workers can exit
+                await loop.run_in_executor(None, process.join, 0.1)
+        self.poll_status()
+
+        for status in self.status.values():
+            logger.info(
+                "Pipeline worker %d wrote %d rows from %d frames to %s",
+                status["worker"],
+                status["written"],
+                status["frames"],
+                ", ".join(status["tables"]),
+            )
+
+        failed = [
+            (i, process.exitcode)
+            for i, process in enumerate(self.processes)
+            if process.exitcode != 0
+        ]
+        if failed:
+            raise RuntimeError(
+                "Pipeline workers failed: "
+                + ", ".join("%d with code %s" % worker for worker in failed)
+            )
@@ -0,0 +1,341 @@
+import asyncio
+import json
+import mmap
+import os
+import shutil
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from struct import pack_into, unpack_from
+from typing import List, Optional
+
+import numpy as np
+
+from . import logger, ROOT_DIR
+from .writers import Chunk
+
+SPOOL_DIR = os.path.join(ROOT_DIR, "var/spool")
+SEGMENT_SIZE = 2 ** 26  # bytes
+SYNC_INTERVAL = 0.1  # Seconds between flushing appended rows to disk
+RATE_WINDOW = 10  # Seconds over which the replay rate is measured
+RECORD_HEADER = "<II"  # Rows and columns of a record
+RECORD_HEADER_LENGTH = 8  # bytes
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class Segment:
+    """
+    One memory-mapped, preallocated spool file of back-to-back records, each of which is
+    a header of rows and columns, then the timestamps in microseconds and the values.
+    Unwritten space is zero, and a record's header is written after the rest of it,
+    so the first header with no rows marks the end of the segment.
+    """
+
+    def __init__(self, path: str, size: Optional[int] = None):
+        self.path = path
+        self.index = int(os.path.basename(path).split(".")[0])
+        with open(path, "a+b") as f:
+            if size is not None and os.path.getsize(path) < size:
+                f.truncate(size)
+            self.map = mmap.mmap(f.fileno(), 0)
+
+    def __len__(self):
+        return len(self.map)
+
+    def header(self, offset: int):
+        """Rows and columns of the record at offset, or (0, 0) at the end."""
+        if offset + RECORD_HEADER_LENGTH > len(self.map):
+            return 0, 0
+        return unpack_from(RECORD_HEADER, self.map, offset)
+
+    def write(self, offset: int, timestamps: np.ndarray, values: np.ndarray) -> int:
+        start = offset + RECORD_HEADER_LENGTH
+        middle = start + timestamps.nbytes
+        end = middle + values.nbytes
+        self.map[start:middle] = timestamps.tobytes()
+        self.map[middle:end] = values.tobytes()
+        pack_into(RECORD_HEADER, self.map, offset, *values.shape)
+        return end
+
+    def read(self, offset: int) -> Chunk:
+        rows, columns = self.header(offset)
+        start = offset + RECORD_HEADER_LENGTH
+        microseconds = np.frombuffer(self.map, "<i8", rows, start)
+        values = np.frombuffer(self.map, "<f8", rows * columns, start + 8 * rows)
+        timestamps = [
+            dt.replace(tzinfo=timezone.utc)
+            for dt in microseconds.astype("datetime64[us]").tolist()
+        ]
+        return timestamps, values.reshape(rows, columns).copy()
+
+    def close(self):
+        self.map.close()
+
+
+def record_length(rows: int, columns: int) -> int:
+    return RECORD_HEADER_LENGTH + 8 * rows * (1 + columns)
+
+
+def to_microseconds(timestamps: List[datetime]) -> np.ndarray:
+    """Microseconds since the epoch, taking naive datetimes to be in UTC."""
+    return np.array(
+        [
+            ((t if t.tzinfo else t.replace(tzinfo=timezone.utc)) - EPOCH)
+            // timedelta(microseconds=1)
+            for t in timestamps
+        ],
+        dtype="<i8",
+    )
+
+
+def spool_directory(table) -> str:
+    return os.path.join(SPOOL_DIR, table.__tablename__)
+
+
+class Spool:
+    """
+    Write-ahead spool of rows for one table, which a DatabaseWriter can use in place of a
+    BoundedQueue so that rows survive the database stalling, disconnecting, or the
+    program exiting before they were written.
+    Chunks are appended to memory-mapped segment files, which rotate once full, and are
+    read back in order by the writer. Only once the writer has committed them to the
+    database does the cursor file move past them, and fully committed segments are
+    deleted, so anything left over is replayed the next time the spool is opened.
+    Replay is at least once: rows committed just before a crash may be read again.
+    """
+
+    durable = True
+
+    def __init__(
+        self,
+        directory: str,
+        columns: List[str],
+        segment_size: int = SEGMENT_SIZE,
+        sync_interval: float = SYNC_INTERVAL,
+    ):
+        self.directory = directory
+        self.columns = list(columns)
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self.condition = threading.Condition()
+
+        self.rows = 0  # Rows appended but not yet read
+        self.uncommitted = 0  # Rows read but not yet committed
+        self.high_water_mark = 0  # Most rows ever spooled at once
+        self.dropped = 0  # Never anything, but matches a BoundedQueue
+        self.error = None  # That the writer failed with, if it has
+        self.commits = deque()  # (time, rows) of recent commits, for the replay rate
+        self.last_sync = time.monotonic()
+
+        self._open()
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def depth(self) -> int:
+        """Rows in the spool that are not yet in the database."""
+        return self.rows + self.uncommitted
+
+    @property
+    def depth_bytes(self) -> int:
+        segments = self.write_segment.index - self.cursor[0]
+        return segments * self.segment_size + self.write_offset - self.cursor[1]
+
+    @property
+    def replay_rate(self) -> float:
+        """Rows committed to the database per second, over the last few seconds."""
+        self._expire_commits()
+        return sum(rows for _, rows in self.commits) / RATE_WINDOW
+
+    def put(self, chunk: Chunk):
+        """Append a chunk, which is durable once this returns and the next sync is done."""
+        timestamps, values = chunk
+        values = np.ascontiguousarray(values, dtype="<f8")
+        rows, columns = values.shape
+        if columns != len(self.columns):
+            raise ValueError(
+                "Chunk has %d columns but the spool has %d"
+                % (columns, len(self.columns))
+            )
+
+        with self.condition:
+            if self.error is not None:
+                raise RuntimeError("The database writer has failed") from self.error
+            length = record_length(rows, columns)
+            if self.write_offset + length > len(self.write_segment):
+                self._rotate(length)
+            self.write_offset = self.write_segment.write(
+                self.write_offset, to_microseconds(timestamps), values
+            )
+
+            if time.monotonic() - self.last_sync > self.sync_interval:
+                self.sync()
+
+            self.rows += rows
+            self.high_water_mark = max(self.high_water_mark, self.depth)
+            self.condition.notify_all()
+
+    async def put_async(self, chunk: Chunk):
+        """
+        Append a chunk from the event loop. An append that is due to sync or to rotate
+        to a new segment waits on the disk, so it is made in the default executor rather
+        than on the loop, while any other is only a copy into the mapped segment.
+        """
+        timestamps, values = chunk
+        length = record_length(len(timestamps), len(self.columns))
+        if (
+            self.write_offset + length > len(self.write_segment)
+            or time.monotonic() - self.last_sync > self.sync_interval
+        ):
+            await asyncio.get_event_loop().run_in_executor(None, self.put, chunk)
+        else:
+            self.put(chunk)
+
+    def get(self, max_rows: int, timeout: float) -> List[Chunk]:
+        """
+        Read the next records totalling at most max_rows rows (but always at least one),
+        waiting up to timeout seconds for the first to arrive.
+        """
+        with self.condition:
+            if not self.rows:
+                self.condition.wait(timeout)
+
+            chunks = []
+            rows = 0
+            while self.rows:
+                record_rows, columns = self.read_segment.header(self.read_offset)
+                if not record_rows:
+                    self._next_read_segment()
+                    continue
+                if chunks and rows + record_rows > max_rows:
+                    break
+
+                chunks.append(self.read_segment.read(self.read_offset))
+                self.read_offset += record_length(record_rows, columns)
+                rows += record_rows
+                self.rows -= record_rows
+
+            self.uncommitted += rows
+            return chunks
+
+    def commit(self):
+        """Mark everything read so far as written to the database."""
+        with self.condition:
+            self.commits.append((time.monotonic(), self.uncommitted))
+            self.uncommitted = 0
+            self._expire_commits()
+
+            previous = self.cursor[0]
+            self.cursor = (self.read_segment.index, self.read_offset)
+            pack_into("<QQ", self.cursor_map, 0, *self.cursor)
+
+        # Only the writer commits, so touch the disk without holding up put
+        self.cursor_map.flush()
+        for index in range(previous, self.cursor[0]):
+            path = self._path(index)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def fail(self, error: Exception):
+        """Record that the writer has failed with error."""
+        with self.condition:
+            self.error = error
+
+    def sync(self):
+        """Flush appended rows to disk."""
+        self.write_segment.map.flush()
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        with self.condition:
+            self.sync()
+            for segment in {self.read_segment, self.write_segment}:
+                segment.close()
+            self.cursor_map.close()
+
+    def _path(self, index: int) -> str:
+        return os.path.join(self.directory, "%08d.spool" % index)
+
+    def _open(self):
+        """Open the spool, counting any rows left over from last time for replay."""
+        columns_path = os.path.join(self.directory, "columns.json")
+        if os.path.exists(columns_path):
+            with open(columns_path) as f:
+                columns = json.load(f)
+            if columns != self.columns:
+                # Rows with other columns can't be replayed into this table as it is now
+                moved = "%s.%d" % (self.directory, time.time())
+                logger.warning(
+                    "Recording columns have changed, so moved the spool %s to %s",
+                    self.directory,
+                    moved,
+                )
+                shutil.move(self.directory, moved)
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(columns_path, "w") as f:
+            json.dump(self.columns, f)
+
+        cursor_path = os.path.join(self.directory, "cursor")
+        with open(cursor_path, "a+b") as f:
+            f.truncate(16)
+            self.cursor_map = mmap.mmap(f.fileno(), 16)
+        indexes = sorted(
+            int(name.split(".")[0])
+            for name in os.listdir(self.directory)
+            if name.endswith(".spool")
+        )
+        self.cursor = unpack_from("<QQ", self.cursor_map)
+        if not indexes or self.cursor[0] < indexes[0]:
+            self.cursor = (indexes[0] if indexes else 0, 0)
+
+        # Count the rows in every record from the cursor onwards
+        index, offset = self.cursor
+        self.read_segment = Segment(self._path(index), self.segment_size)
+        self.read_offset = offset
+        self.write_segment = self.read_segment
+        while True:
+            rows, columns = self.write_segment.header(offset)
+            while rows:
+                self.rows += rows
+                offset += record_length(rows, columns)
+                rows, columns = self.write_segment.header(offset)
+            if index + 1 not in indexes:
+                break
+            index += 1
+            offset = 0
+            if self.write_segment is not self.read_segment:
+                self.write_segment.close()
+            self.write_segment = Segment(self._path(index))
+        self.write_offset = offset
+        self.high_water_mark = self.rows
+
+        if self.rows:
+            logger.info("Replaying %d spooled rows from %s", self.rows, self.directory)
+
+    def _rotate(self, length: int):
+        """Start a new segment, large enough for a record of length bytes."""
+        self.sync()
+        if self.write_segment is not self.read_segment:
+            self.write_segment.close()
+        self.write_segment = Segment(
+            self._path(self.write_segment.index + 1), max(self.segment_size, length)
+        )
+        self.write_offset = 0
+
+    def _next_read_segment(self):
+        """Move on from a segment that has been read to the end."""
+        if self.read_segment is not self.write_segment:
+            self.read_segment.close()
+        index = self.read_segment.index + 1
+        if index == self.write_segment.index:
+            self.read_segment = self.write_segment
+        else:
+            self.read_segment = Segment(self._path(index))
+        self.read_offset = 0
+
+    def _expire_commits(self):
+        while self.commits and self.commits[0][0] < time.monotonic() - RATE_WINDOW:
+            self.commits.popleft()
@@ -2,11 +2,13 @@ import threading
 
 import pytest
 
+from database_models import Packages
 from database_models.utils import make_test_db
 from .. import DATABASE_URL, db, Session
 from .utils import Mockx30Instrument, Mockx55Instrument
 from ..x30.x30_client import x30Client
 from ..x55.x55_client import x55Client
+from ..configuration import Configuration
 
 
 make_test_db(DATABASE_URL, db, Session)
@@ -44,3 +46,21 @@ async def x55_client():
     await test_client.connect()
     yield test_client
     await test_client.disconnect()
+
+
+@pytest.fixture
+def configuration():
+    """A configuration in which every sensor in the test metadata is recording."""
+    packages = (Packages.basement, Packages.strong_floor, Packages.steel_frame)
+
+    session = Session()
+    for package in packages:
+        session.query(package.metadata_table).update({"recording": True})
+    session.commit()
+
+    yield Configuration()
+
+    for package in packages:
+        session.query(package.metadata_table).update({"recording": False})
+    session.commit()
+    session.close()
@@ -0,0 +1,322 @@
+import inspect
+from datetime import datetime
+from ipaddress import IPv4Address
+
+import pytest
+
+from ..x30 import x30_protocol
+from ..x30.x30_protocol import (
+    Channel,
+    MultiplexerLevel,
+    NTPServer,
+    OperatingMode,
+    TrigMode,
+)
+from ..x55 import x55_protocol
+
+# Every request with sample arguments and its bytes as serialized by the pydantic models
+# that the slot-based messages replaced
+X55_REQUESTS = [
+    (
+        x55_protocol.DisablePeakDataStreaming,
+        {},
+        b"\x00\x00\x19\x00\x00\x00\x00\x00#DisablePeakDataStreaming",
+    ),
+    (
+        x55_protocol.EnablePeakDataStreaming,
+        {},
+        b"\x00\x00\x18\x00\x00\x00\x00\x00#EnablePeakDataStreaming",
+    ),
+    (
+        x55_protocol.GetAvailableLaserScanSpeeds,
+        {},
+        b"\x00\x00\x1c\x00\x00\x00\x00\x00#GetAvailableLaserScanSpeeds",
+    ),
+    (
+        x55_protocol.GetDutChannelCount,
+        {},
+        b"\x00\x00\x13\x00\x00\x00\x00\x00#GetDutChannelCount",
+    ),
+    (
+        x55_protocol.GetFirmwareVersion,
+        {},
+        b"\x00\x00\x13\x00\x00\x00\x00\x00#GetFirmwareVersion",
+    ),
+    (
+        x55_protocol.GetInstrumentName,
+        {},
+        b"\x00\x00\x12\x00\x00\x00\x00\x00#GetInstrumentName",
+    ),
+    (
+        x55_protocol.GetInstrumentUtcDateTime,
+        {},
+        b"\x00\x00\x19\x00\x00\x00\x00\x00#GetInstrumentUtcDateTime",
+    ),
+    (
+        x55_protocol.GetLaserScanSpeed,
+        {},
+        b"\x00\x00\x12\x00\x00\x00\x00\x00#GetLaserScanSpeed",
+    ),
+    (x55_protocol.GetNtpEnabled, {}, b"\x00\x00\x0e\x00\x00\x00\x00\x00#GetNtpEnabled"),
+    (x55_protocol.GetNtpServer, {}, b"\x00\x00\r\x00\x00\x00\x00\x00#GetNtpServer"),
+    (
+        x55_protocol.GetPeakDataStreamingAvailableBuffer,
+        {},
+        b"\x00\x00$\x00\x00\x00\x00\x00#GetPeakDataStreamingAvailableBuffer",
+    ),
+    (
+        x55_protocol.GetPeakDataStreamingDivider,
+        {},
+        b"\x00\x00\x1c\x00\x00\x00\x00\x00#GetPeakDataStreamingDivider",
+    ),
+    (
+        x55_protocol.GetPeakDataStreamingStatus,
+        {},
+        b"\x00\x00\x1b\x00\x00\x00\x00\x00#GetPeakDataStreamingStatus",
+    ),
+    (x55_protocol.GetPeaks, {}, b"\x00\x00\t\x00\x00\x00\x00\x00#GetPeaks"),
+    (x55_protocol.IsReady, {}, b"\x00\x00\x08\x00\x00\x00\x00\x00#IsReady"),
+    (
+        x55_protocol.SetInstrumentUtcDateTime,
+        {"dt": datetime(2020, 1, 2, 3, 4, 5)},
+        b"\x00\x00\x19\x00\x13\x00\x00\x00#SetInstrumentUtcDateTime2020 01 02 03 04 05",
+    ),
+    (
+        x55_protocol.SetLaserScanSpeed,
+        {"speed": 3},
+        b"\x00\x00\x12\x00\x01\x00\x00\x00#SetLaserScanSpeed3",
+    ),
+    (
+        x55_protocol.SetNtpEnabled,
+        {"enabled": True},
+        b"\x00\x00\x0e\x00\x01\x00\x00\x00#SetNtpEnabled1",
+    ),
+    (
+        x55_protocol.SetNtpServer,
+        {"address": IPv4Address("10.0.0.1")},
+        b"\x00\x00\r\x00\x08\x00\x00\x00#SetNtpServer10.0.0.1",
+    ),
+    (
+        x55_protocol.SetPeakDataStreamingDivider,
+        {"divider": 3},
+        b"\x00\x00\x1c\x00\x01\x00\x00\x00#SetPeakDataStreamingDivider3",
+    ),
+]
+X30_REQUESTS = [
+    (x30_protocol.FLUSH_BUFFER, {}, b"#FLUSH_BUFFER\n"),
+    (x30_protocol.GET_AMP_CH, {}, b"#GET_AMP_CH\n"),
+    (x30_protocol.GET_AUTO_RETRIG, {}, b"#GET_AUTO_RETRIG\n"),
+    (x30_protocol.GET_BUFFER_COUNT, {}, b"#GET_BUFFER_COUNT\n"),
+    (x30_protocol.GET_BUFFER_ENABLE, {}, b"#GET_BUFFER_ENABLE\n"),
+    (x30_protocol.GET_CAPABILITIES, {}, b"#GET_CAPABILITIES\n"),
+    (x30_protocol.GET_DATA, {}, b"#GET_DATA\n"),
+    (x30_protocol.GET_DATA_AND_LEVELS, {}, b"#GET_DATA_AND_LEVELS\n"),
+    (x30_protocol.GET_DATA_INTERLEAVE, {}, b"#GET_DATA_INTERLEAVE\n"),
+    (x30_protocol.GET_DATA_RATE_DIVIDER, {}, b"#GET_DATA_RATE_DIVIDER\n"),
+    (x30_protocol.GET_DEFAULT_GATEWAY, {}, b"#GET_DEFAULT_GATEWAY\n"),
+    (x30_protocol.GET_DHCP, {}, b"#GET_DHCP\n"),
+    (x30_protocol.GET_DNS_SERVER, {}, b"#GET_DNS_SERVER\n"),
+    (x30_protocol.GET_ENABLE_NTP, {}, b"#GET_ENABLE_NTP\n"),
+    (x30_protocol.GET_IP_ADDRESS, {}, b"#GET_IP_ADDRESS\n"),
+    (x30_protocol.GET_IP_NETMASK, {}, b"#GET_IP_NETMASK\n"),
+    (x30_protocol.GET_MUX_LEVEL, {}, b"#GET_MUX_LEVEL\n"),
+    (x30_protocol.GET_NUM_DUT_CHANNELS, {}, b"#GET_NUM_DUT_CHANNELS\n"),
+    (x30_protocol.GET_OPERATING_MODE, {}, b"#GET_OPERATING_MODE\n"),
+    (x30_protocol.GET_SN, {}, b"#GET_SN\n"),
+    (x30_protocol.GET_SPECTRUM, {}, b"#GET_SPECTRUM\n"),
+    (x30_protocol.GET_STREAMING_DATA, {}, b"#GET_STREAMING_DATA\n"),
+    (x30_protocol.GET_TRIG_MODE, {}, b"#GET_TRIG_MODE\n"),
+    (x30_protocol.GET_TRIG_NUM_ACQ, {}, b"#GET_TRIG_NUM_ACQ\n"),
+    (x30_protocol.GET_TRIG_START_EDGE, {}, b"#GET_TRIG_START_EDGE\n"),
+    (x30_protocol.GET_TRIG_STOP_EDGE, {}, b"#GET_TRIG_STOP_EDGE\n"),
+    (x30_protocol.GET_TRIG_STOP_TYPE, {}, b"#GET_TRIG_STOP_TYPE\n"),
+    (x30_protocol.GET_UNBUFFERED_DATA, {}, b"#GET_UNBUFFERED_DATA\n"),
+    (
+        x30_protocol.GET_UNBUFFERED_DATA_AND_LEVELS,
+        {},
+        b"#GET_UNBUFFERED_DATA_AND_LEVELS\n",
+    ),
+    (x30_protocol.GET_USE_REFERENCES, {}, b"#GET_USE_REFERENCES\n"),
+    (x30_protocol.HELP, {}, b"#HELP\n"),
+    (x30_protocol.IDN, {}, b"#IDN?\n"),
+    (x30_protocol.MEASURE_LOCATIONS, {}, b"#MEASURE_LOCATIONS\n"),
+    (x30_protocol.REBOOT, {}, b"#REBOOT\n"),
+    (x30_protocol.RESTART_NETWORK, {}, b"#RESTART_NETWORK\n"),
+    (x30_protocol.SAVE_SETTINGS, {}, b"#SAVE_SETTINGS\n"),
+    (x30_protocol.SET_AUTO_RETRIG, {"val": True}, b"#SET_AUTO_RETRIG 1\n"),
+    (x30_protocol.SET_BUFFER_ENABLE, {"val": True}, b"#SET_BUFFER_ENABLE 1\n"),
+    (
+        x30_protocol.SET_DATE,
+        {"date": datetime(2020, 1, 2, 3, 4, 5)},
+        b"#SET_DATE 01.02.03.04.20\n",
+    ),
+    (x30_protocol.SET_DHCP, {"val": True}, b"#SET_DHCP 1\n"),
+    (x30_protocol.SET_ENABLE_NTP, {"val": True}, b"#SET_ENABLE_NTP 1\n"),
+    (x30_protocol.SET_STREAMING_DATA, {"val": True}, b"#SET_STREAMING_DATA 1\n"),
+    (x30_protocol.SET_TRIG_NUM_ACQ, {"val": True}, b"#SET_TRIG_NUM_ACQ 1\n"),
+    (x30_protocol.SET_TRIG_START_EDGE, {"val": True}, b"#SET_TRIG_START_EDGE 1\n"),
+    (x30_protocol.SET_TRIG_STOP_EDGE, {"val": True}, b"#SET_TRIG_STOP_EDGE 1\n"),
+    (x30_protocol.SET_TRIG_STOP_TYPE, {"val": True}, b"#SET_TRIG_STOP_TYPE 1\n"),
+    (x30_protocol.SET_USE_REFERENCES, {"val": True}, b"#SET_USE_REFERENCES 1\n"),
+    (x30_protocol.SW_TRIG_START, {}, b"#SW_TRIG_START\n"),
+    (x30_protocol.SW_TRIG_STOP, {}, b"#SW_TRIG_STOP\n"),
+    (x30_protocol.WHO, {}, b"#WHO?\n"),
+    (x30_protocol.WHOAMI, {}, b"#WHOAMI?\n"),
+]
+# The pydantic x30 models could not serialize arguments other than bools and datetimes,
+# as their default serializer was an unbound lambda, so these are the bytes they were
+# meant to send: the command then the arguments, enums by value
+X30_REQUESTS_WITH_ARGUMENTS = [
+    (
+        x30_protocol.APPLY_MEASURED_LOCATIONS,
+        {"ch": Channel.CHANNEL_2, "sensor": 3},
+        b"#APPLY_MEASURED_LOCATIONS 2 3\n",
+    ),
+    (
+        x30_protocol.CLEAR_REFERENCE,
+        {"ch": Channel.CHANNEL_2, "sensor": 3},
+        b"#CLEAR_REFERENCE 2 3\n",
+    ),
+    (x30_protocol.GET_CH_GAIN_DB, {"ch": Channel.CHANNEL_2}, b"#GET_CH_GAIN_DB 2\n"),
+    (
+        x30_protocol.GET_CH_NOISE_THRESH,
+        {"ch": Channel.CHANNEL_2},
+        b"#GET_CH_NOISE_THRESH 2\n",
+    ),
+    (
+        x30_protocol.GET_INDEX_OF_REFRACTION,
+        {"ch": Channel.CHANNEL_2},
+        b"#GET_INDEX_OF_REFRACTION 2\n",
+    ),
+    (
+        x30_protocol.GET_MEASURED_LOCATION,
+        {"ch": Channel.CHANNEL_2, "sensor": 3},
+        b"#GET_MEASURED_LOCATION 2 3\n",
+    ),
+    (
+        x30_protocol.GET_NTP_SERVERX,
+        {"x": NTPServer.NTP_SERVER_1},
+        b"#GET_NTP_SERVERX1 1\n",
+    ),
+    (
+        x30_protocol.GET_NUM_AVERAGES,
+        {"ch": Channel.CHANNEL_2, "sensor": 3},
+        b"#GET_NUM_AVERAGES 2 3\n",
+    ),
+    (
+        x30_protocol.GET_REFERENCE,
+        {"ch": Channel.CHANNEL_2, "sensor": 3},
+        b"#GET_REFERENCE 2 3\n",
+    ),
+    (
+        x30_protocol.GET_SENSOR_LOCATION,
+        {"ch": Channel.CHANNEL_2, "sensor": 3},
+        b"#GET_SENSOR_LOCATION 2 3\n",
+    ),
+    (x30_protocol.SET_AMP_CH, {"ch": Channel.CHANNEL_2}, b"#SET_AMP_CH 2\n"),
+    (
+        x30_protocol.SET_CH_GAIN_DB,
+        {"ch": Channel.CHANNEL_2, "gain": 1.5},
+        b"#SET_CH_GAIN_DB 2 1.5\n",
+    ),
+    (
+        x30_protocol.SET_CH_NOISE_THRESH,
+        {"ch": Channel.CHANNEL_2, "val": 3},
+        b"#SET_CH_NOISE_THRESH 2 3\n",
+    ),
+    (x30_protocol.SET_DATA_INTERLEAVE, {"interleave": 3}, b"#SET_DATA_INTERLEAVE 3\n"),
+    (x30_protocol.SET_DATA_RATE_DIVIDER, {"div": 3}, b"#SET_DATA_RATE_DIVIDER 3\n"),
+    (
+        x30_protocol.SET_DEFAULT_GATEWAY,
+        {"gateway": IPv4Address("10.0.0.1")},
+        b"#SET_DEFAULT_GATEWAY 10.0.0.1\n",
+    ),
+    (
+        x30_protocol.SET_DNS_SERVER,
+        {"server": IPv4Address("10.0.0.1")},
+        b"#SET_DNS_SERVER 10.0.0.1\n",
+    ),
+    (
+        x30_protocol.SET_INDEX_OF_REFRACTION,
+        {"ch": Channel.CHANNEL_2, "val": 1.5},
+        b"#SET_INDEX_OF_REFRACTION 2 1.5\n",
+    ),
+    (
+        x30_protocol.SET_IP_ADDRESS,
+        {"address": IPv4Address("10.0.0.1")},
+        b"#SET_IP_ADDRESS 10.0.0.1\n",
+    ),
+    (
+        x30_protocol.SET_IP_NETMASK,
+        {"mask": IPv4Address("10.0.0.1")},
+        b"#SET_IP_NETMASK 10.0.0.1\n",
+    ),
+    (
+        x30_protocol.SET_LOC_MEAS_CH_OFFSET_METERS,
+        {"ch": Channel.CHANNEL_2, "val": 3},
+        b"#SET_LOC_MEAS_CH_OFFSET_METERS 2 3\n",
+    ),
+    (
+        x30_protocol.SET_MUX_LEVEL,
+        {"val": MultiplexerLevel.MUX_2},
+        b"#SET_MUX_LEVEL 2\n",
+    ),
+    (
+        x30_protocol.SET_NTP_SERVER,
+        {"x": NTPServer.NTP_SERVER_1, "server": IPv4Address("10.0.0.1")},
+        b"#SET_NTP_SERVER1 1 10.0.0.1\n",
+    ),
+    (
+        x30_protocol.SET_NUM_AVERAGES,
+        {"ch": Channel.CHANNEL_2, "sensor": 3, "avgs": 3},
+        b"#SET_NUM_AVERAGES 2 3 3\n",
+    ),
+    (
+        x30_protocol.SET_OPERATING_MODE,
+        {"mode": OperatingMode.MASTER},
+        b"#SET_OPERATING_MODE 1\n",
+    ),
+    (
+        x30_protocol.SET_REFERENCE,
+        {"ch": Channel.CHANNEL_2, "sensor": 3, "ref_wvl": 1.5},
+        b"#SET_REFERENCE 2 3 1.5\n",
+    ),
+    (
+        x30_protocol.SET_SENSOR_LOCATION,
+        {"ch": Channel.CHANNEL_2, "sensor": 3, "val": 3},
+        b"#SET_SENSOR_LOCATION 2 3 3\n",
+    ),
+    (
+        x30_protocol.SET_TRIG_MODE,
+        {"mode": TrigMode.SW_TRIGGERED},
+        b"#SET_TRIG_MODE 1\n",
+    ),
+]
+
+
+def request_classes(module):
+    return {
+        cls
+        for _, cls in inspect.getmembers(module, inspect.isclass)
+        if issubclass(cls, module.Request) and cls is not module.Request
+    }
+
+
+@pytest.mark.parametrize(
+    "module, requests",
+    [
+        (x55_protocol, X55_REQUESTS),
+        (x30_protocol, X30_REQUESTS + X30_REQUESTS_WITH_ARGUMENTS),
+    ],
+)
+def test_every_request_serialized(module, requests):
+    assert request_classes(module) == {request for request, _, _ in requests}
+
+
+@pytest.mark.parametrize(
+    "request_class, arguments, serialized",
+    X55_REQUESTS + X30_REQUESTS + X30_REQUESTS_WITH_ARGUMENTS,
+    ids=lambda value: value.__name__ if inspect.isclass(value) else "",
+)
+def test_serialize(request_class, arguments, serialized):
+    assert request_class(**arguments).serialize() == serialized
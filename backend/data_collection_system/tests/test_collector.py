@@ -0,0 +1,140 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+from .. import db
+from ..collector import Collector
+from ..configuration import SetupOptions
+from .utils import Mockx55Instrument, PeakGenerator
+
+
+pytestmark = [pytest.mark.asyncio, pytest.mark.usefixtures("configuration")]
+
+
+def mock(tables, port, start=None):
+    return Mockx55Instrument(
+        PeakGenerator(tables),
+        scan_speed=100,
+        start=start,
+        command_port=port,
+        peak_streaming_port=port + 1,
+    )
+
+
+async def test_collector_records_independently():
+    collector = Collector()
+    basement = collector.add(
+        "127.0.0.1",
+        SetupOptions.BASEMENT,
+        command_port=52001,
+        peak_streaming_port=52002,
+    )
+    frame = collector.add(
+        "127.0.0.1",
+        SetupOptions.FRAME,
+        command_port=52011,
+        peak_streaming_port=52012,
+    )
+    missing = collector.add(
+        "127.0.0.1",
+        SetupOptions.STRONG_FLOOR,
+        command_port=52021,
+        peak_streaming_port=52022,
+    )
+    with pytest.raises(ValueError):
+        collector.add("127.0.0.1", SetupOptions.BASEMENT_AND_FRAME)
+
+    started = datetime.now(timezone.utc)
+    async with mock(["basement_fbg"], 52001) as first, mock(
+        ["steel_frame_fbg"], 52011
+    ) as second:
+        await collector.connect()
+        assert collector.connected == [basement, frame]
+        assert missing.name in collector.errors
+
+        recording = asyncio.ensure_future(collector.record())
+        await asyncio.sleep(0.5)
+
+        # The first instrument going away leaves the second recording
+        first.transport.close()
+        await asyncio.sleep(0.3)
+        assert not basement.recording
+        assert frame.recording
+        received = collector.throughput["instruments"][frame.name]["received"]
+        await asyncio.sleep(0.3)
+        assert collector.throughput["instruments"][frame.name]["received"] > received
+
+        collector.stop()
+        await recording
+        await collector.disconnect()
+
+    throughput = collector.throughput
+    assert throughput["instruments"][basement.name]["written"] == first.sent
+    assert throughput["instruments"][frame.name]["written"] == second.sent
+    assert throughput["total"]["written"] == first.sent + second.sent
+
+    with db.begin() as connection:
+        for client in (basement, frame):
+            for table in client.configuration.sensors:
+                connection.execute(
+                    table.__table__.delete().where(table.timestamp >= started)
+                )
+
+
+async def test_collector_survives_failed_writer():
+    collector = Collector()
+    basement = collector.add(
+        "127.0.0.1",
+        SetupOptions.BASEMENT,
+        command_port=52031,
+        peak_streaming_port=52032,
+        queue_size=10,  # Full within 0.1 s of the writer failing
+    )
+    frame = collector.add(
+        "127.0.0.1",
+        SetupOptions.FRAME,
+        command_port=52041,
+        peak_streaming_port=52042,
+    )
+
+    # A row already at the first instrument's first timestamp fails its writer
+    started = datetime.now(timezone.utc)
+    start = (time.time_ns() // 10 ** 9 + 1) * 10 ** 9
+    (table,) = basement.configuration.sensors
+    with db.begin() as connection:
+        connection.execute(
+            table.__table__.insert().values(
+                timestamp=datetime.fromtimestamp(start // 10 ** 9, timezone.utc)
+            )
+        )
+
+    async with mock(["basement_fbg"], 52031, start) as first, mock(
+        ["steel_frame_fbg"], 52041
+    ) as second:
+        await collector.connect()
+        recording = asyncio.ensure_future(collector.record())
+        await asyncio.sleep(1)
+
+        # The first instrument stops with its writer, while the second carries on
+        assert isinstance(collector.errors[basement.name], RuntimeError)
+        assert not basement.recording
+        assert frame.recording
+        received = collector.throughput["instruments"][frame.name]["received"]
+        await asyncio.sleep(0.3)
+        assert collector.throughput["instruments"][frame.name]["received"] > received
+
+        collector.stop()
+        await asyncio.wait_for(recording, 5)
+        await collector.disconnect()
+
+    assert first.sent > 0
+    assert collector.throughput["instruments"][frame.name]["written"] == second.sent
+
+    with db.begin() as connection:
+        for client in (basement, frame):
+            for table in client.configuration.sensors:
+                connection.execute(
+                    table.__table__.delete().where(table.timestamp >= started)
+                )
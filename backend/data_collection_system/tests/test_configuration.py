@@ -0,0 +1,112 @@
+import numpy as np
+
+from database_models import Basement
+from ..configuration import Configuration, SetupOptions
+from ..x55.x55_protocol import PeakBatch
+from .utils import PeakGenerator
+
+
+def expected_peaks(configuration, table, max_peaks=40):
+    """Place every sensor's reference wavelength at its expected index."""
+    peaks = np.full((16, max_peaks), np.nan)
+    for row in configuration.mapping[table].values():
+        peaks[row.channel, row.index] = row.reference_wavelength
+    return peaks
+
+
+def test_load(configuration):
+    configuration.load(SetupOptions.BASEMENT)
+    sensors = configuration.sensors[Basement]
+
+    assert len(sensors) == len(configuration.mapping[Basement])
+    assert sensors.channel.dtype == np.intp
+    assert np.all(sensors.minimum_wavelength < sensors.maximum_wavelength)
+
+
+def test_map(configuration):
+    configuration.load(SetupOptions.BASEMENT)
+    peaks = expected_peaks(configuration, Basement)
+    values = configuration.map(peaks, Basement)
+
+    expected = [
+        configuration.mapping[Basement][uid].reference_wavelength
+        for uid in configuration.sensors[Basement].uids
+    ]
+    assert values.tolist() == expected
+
+
+def test_map_dropped_peak(configuration):
+    configuration.load(SetupOptions.BASEMENT)
+    peaks = expected_peaks(configuration, Basement)
+    first = configuration.mapping[Basement]["A8"]
+    second = configuration.mapping[Basement]["A9"]
+    channel = peaks[first.channel]
+    channel[first.index :] = np.append(channel[first.index + 1 :], np.nan)
+
+    values = dict(
+        zip(configuration.sensors[Basement].uids, configuration.map(peaks, Basement))
+    )
+
+    assert np.isnan(values["A8"])
+    assert values["A9"] == second.reference_wavelength
+
+
+def test_map_extra_peaks(configuration):
+    configuration.load(SetupOptions.BASEMENT)
+    first = configuration.mapping[Basement]["A8"]
+    second = configuration.mapping[Basement]["A9"]
+    peaks = expected_peaks(configuration, Basement)
+    channel = peaks[first.channel]
+
+    # A reflection inside A8's window and a spurious peak between A8 and A9's windows
+    extra = [first.reference_wavelength + 0.01, second.minimum_wavelength - 0.01]
+    channel[first.index + 1 :] = np.append(extra, channel[first.index + 1 : -2])
+
+    values = dict(
+        zip(configuration.sensors[Basement].uids, configuration.map(peaks, Basement))
+    )
+
+    assert values["A8"] == first.reference_wavelength
+    assert values["A9"] == second.reference_wavelength
+    assert configuration.unmatched_peaks[Basement] == 2
+
+
+def test_map_batch(configuration):
+    configuration.load(SetupOptions.BASEMENT)
+    peaks = expected_peaks(configuration, Basement)
+    batch = np.stack([peaks, np.full_like(peaks, np.nan), peaks])
+    values = configuration.map(batch, Basement)
+
+    assert values.shape == (3, len(configuration.sensors[Basement]))
+    assert np.all(np.isnan(values[1]))
+    assert np.array_equal(values[0], values[2])
+
+
+def test_map_generated_faults(configuration):
+    configuration.load(SetupOptions.BASEMENT)
+    generator = PeakGenerator(["basement_fbg"], drop=0.1, extra=0.2, out_of_band=0.5)
+    frames = b"".join(generator.response(i) for i in range(100))
+    batch, _ = PeakBatch.decode(frames)
+    values = configuration.map(batch.peaks, Basement)
+
+    # Each sensor reads its own peak unless it was dropped, whatever else was injected
+    found = ~np.isnan(values)
+    assert 0.8 < np.count_nonzero(found) / found.size < 0.99
+    assert np.allclose(
+        values[found],
+        np.broadcast_to(
+            configuration.sensors[Basement].minimum_wavelength, values.shape
+        )[found],
+        atol=5,
+    )
+    channels = [channel for channel, _, _ in configuration.sensors[Basement].channels]
+    assert configuration.unmatched_peaks[Basement] == (
+        np.count_nonzero(~np.isnan(batch.peaks[:, channels])) - np.count_nonzero(found)
+    )
+
+
+def test_map_no_recording_sensors():
+    configuration = Configuration()
+    values = configuration.map(np.full((2, 16, 20), 1550.0), Basement)
+
+    assert values.shape == (2, len(configuration.sensors[Basement]))
@@ -0,0 +1,72 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+from .. import db
+from ..daemon import Daemon, DEFAULTS, request
+from .utils import Mockx55Instrument, PeakGenerator
+
+
+pytestmark = [pytest.mark.asyncio, pytest.mark.usefixtures("configuration")]
+
+CONTROL_PORT = 52050
+
+
+async def test_daemon_control():
+    config = dict(
+        DEFAULTS,
+        instruments=[
+            {
+                "host": "127.0.0.1",
+                "setup": "BASEMENT",
+                "options": {"command_port": 52041, "peak_streaming_port": 52042},
+            }
+        ],
+        record=False,
+        control_port=CONTROL_PORT,
+    )
+    daemon = Daemon(config)
+    started = datetime.now(timezone.utc)
+
+    async with Mockx55Instrument(
+        PeakGenerator(["basement_fbg"]),
+        scan_speed=100,
+        command_port=52041,
+        peak_streaming_port=52042,
+    ) as instrument:
+        running = asyncio.ensure_future(daemon.run())
+        await asyncio.sleep(0.1)
+
+        response = await request("status", port=CONTROL_PORT)
+        assert response["ok"] and not response["recording"]
+
+        assert (await request("start", port=CONTROL_PORT))["recording"]
+        await asyncio.sleep(0.3)
+        response = await request("divider", port=CONTROL_PORT, divider=10)
+        assert response == {"ok": True, "divider": 10}
+        assert instrument.divider == 10
+
+        response = await request("setup", port=CONTROL_PORT, setup="FRAME")
+        assert not response["ok"] and "recording" in response["error"]
+        response = await request("missing", port=CONTROL_PORT)
+        assert not response["ok"]
+
+        assert not (await request("stop", port=CONTROL_PORT))["recording"]
+        status = await request("status", port=CONTROL_PORT)
+        client = daemon.collector.clients[0]
+        assert status["instruments"][client.name]["written"] == instrument.sent > 0
+        tables = list(client.configuration.sensors)
+
+        response = await request("setup", port=CONTROL_PORT, setup="FRAME")
+        assert response == {"ok": True, "setup": "FRAME"}
+
+        await request("shutdown", port=CONTROL_PORT)
+        await running
+        assert not client.connected
+
+    with db.begin() as connection:
+        for table in tables:
+            connection.execute(
+                table.__table__.delete().where(table.timestamp >= started)
+            )
@@ -0,0 +1,194 @@
+import asyncio
+import multiprocessing
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+from .. import db
+from ..configuration import SetupOptions
+from ..pipeline import FrameRing, Pipeline
+from ..writers import OverflowPolicy
+from .utils import PeakGenerator
+
+
+def test_frame_ring_broadcast():
+    ring = FrameRing(64, 2)
+    assert ring.write(b"abc")
+    assert ring.write(b"defg")
+
+    for consumer in range(2):
+        block, position = ring.read(consumer)
+        assert bytes(block) == b"abc"
+        ring.advance(consumer, position)
+        block, position = ring.read(consumer)
+        assert bytes(block) == b"defg"
+        ring.advance(consumer, position)
+        assert ring.read(consumer) is None
+        assert ring.pending(consumer) == 0
+
+
+def test_frame_ring_empty_block():
+    ring = FrameRing(64, 1)
+    assert ring.write(b"")  # Not appended, as it would read as a wrap marker
+    assert ring.read(0) is None
+    assert ring.write(b"abc")
+    block, position = ring.read(0)
+    assert (bytes(block), position) == (b"abc", 7)
+
+
+def test_frame_ring_full_and_wrap():
+    ring = FrameRing(64, 2)
+    assert ring.write(bytes(20))
+    assert ring.write(bytes(20))
+    assert not ring.write(bytes(20))  # Only 16 bytes are free
+
+    # Space is only reclaimed once the slowest consumer has read past it
+    ring.advance(0, ring.read(0)[1])
+    assert not ring.write(bytes(20))
+    ring.advance(1, ring.read(1)[1])
+
+    # The block doesn't fit in the 16 bytes before the end, so it wraps to the start
+    assert ring.write(b"x" * 20)
+    for consumer in range(2):
+        ring.advance(consumer, ring.read(consumer)[1])
+        block, position = ring.read(consumer)
+        assert bytes(block) == b"x" * 20
+        ring.advance(consumer, position)
+        assert ring.pending(consumer) == 0
+
+    with pytest.raises(ValueError):
+        ring.write(bytes(64))
+
+
+def read_all(ring, results):
+    while not (ring.closed and not ring.pending(0)):
+        block = ring.read(0)
+        if block is not None:
+            results.put(bytes(block[0]))
+            ring.advance(0, block[1])
+
+
+def test_frame_ring_process():
+    context = multiprocessing.get_context("spawn")
+    ring = FrameRing(64, 1, context)
+    results = context.Queue()
+    process = context.Process(target=read_all, args=(ring, results))
+    process.start()
+
+    blocks = [bytes([i]) * 10 for i in range(20)]
+    for block in blocks:
+        while not ring.write(block):
+            time.sleep(0.001)
+    ring.close()
+
+    assert [results.get(timeout=10) for _ in blocks] == blocks
+    process.join(10)
+    assert process.exitcode == 0
+
+
+def frames(start: int, count: int) -> bytes:
+    generator = PeakGenerator()
+    return b"".join(generator.response(start + i * 10 ** 7) for i in range(count))
+
+
+@pytest.mark.asyncio
+async def test_pipeline(configuration):
+    tables = list(configuration.sensors)
+    pipeline = Pipeline(
+        SetupOptions.BASEMENT_AND_FRAME, tables, 2, 1000, OverflowPolicy.BLOCK
+    )
+    started = datetime.now(timezone.utc)
+    start = (time.time_ns() // 10 ** 9 + 1) * 10 ** 9
+    pipeline.start()
+    for i in range(5):
+        await pipeline.put(frames(start + i * 10 ** 8, 10))
+    await asyncio.wait_for(pipeline.stop(), 60)
+
+    # Each worker decoded every frame and wrote its own table
+    status = pipeline.poll_status()
+    assert sorted(status) == [0, 1]
+    for worker in status.values():
+        assert not worker["running"]
+        assert (worker["frames"], worker["written"]) == (50, 50)
+
+    with db.begin() as connection:
+        for table in tables:
+            rows = connection.execute(
+                table.__table__.select().where(table.timestamp >= started)
+            ).fetchall()
+            assert len(rows) == 50
+            connection.execute(
+                table.__table__.delete().where(table.timestamp >= started)
+            )
+
+
+@pytest.mark.asyncio
+async def test_pipeline_worker_dies(configuration):
+    tables = list(configuration.sensors)
+    pipeline = Pipeline(
+        SetupOptions.BASEMENT_AND_FRAME,
+        tables,
+        2,
+        1000,
+        OverflowPolicy.BLOCK,
+        ring_size=2 ** 16,
+    )
+    started = datetime.now(timezone.utc)
+    start = (time.time_ns() // 10 ** 9 + 1) * 10 ** 9
+    pipeline.start()
+    deadline = time.monotonic() + 30
+    sent = 0
+    while 0 not in pipeline.poll_status() and time.monotonic() < deadline:
+        await pipeline.put(frames(start + sent * 10 ** 7, 1))  # Workers report as they go
+        sent += 1
+        await asyncio.sleep(0.1)
+    pipeline.processes[0].kill()
+    pipeline.processes[0].join(10)
+    assert not pipeline.poll_status()[0]["running"]
+
+    # Once the dead worker holds up the ring, putting raises rather than waiting forever
+    with pytest.raises(RuntimeError):
+        for i in range(100):
+            block = frames(start + (sent + 10 * i) * 10 ** 7, 10)
+            await asyncio.wait_for(pipeline.put(block), 10)
+    with pytest.raises(RuntimeError):
+        await asyncio.wait_for(pipeline.stop(), 60)
+    assert pipeline.processes[1].exitcode == 0
+
+    with db.begin() as connection:
+        for table in tables:
+            connection.execute(
+                table.__table__.delete().where(table.timestamp >= started)
+            )
+
+
+@pytest.mark.asyncio
+async def test_pipeline_writer_fails(configuration):
+    # One worker with both tables, so that the other writer must still be stopped
+    tables = list(configuration.sensors)
+    pipeline = Pipeline(
+        SetupOptions.BASEMENT_AND_FRAME, tables, 1, 1000, OverflowPolicy.BLOCK
+    )
+    started = datetime.now(timezone.utc)
+    start = (time.time_ns() // 10 ** 9 + 1) * 10 ** 9
+
+    # A row already at the first timestamp fails the first table's writer
+    with db.begin() as connection:
+        connection.execute(
+            tables[0]
+            .__table__.insert()
+            .values(timestamp=datetime.fromtimestamp(start // 10 ** 9, timezone.utc))
+        )
+
+    pipeline.start()
+    await pipeline.put(frames(start, 10))
+    with pytest.raises(RuntimeError):
+        await asyncio.wait_for(pipeline.stop(), 60)
+    assert pipeline.processes[0].exitcode == 1
+
+    with db.begin() as connection:
+        for table in tables:
+            connection.execute(
+                table.__table__.delete().where(table.timestamp >= started)
+            )
@@ -0,0 +1,129 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+from database_models import Basement
+from .. import db
+from ..spool import Spool
+from ..writers import TableInsert, BatchPolicy, DatabaseWriter
+
+
+def chunk(start, rows=1, columns=2):
+    timestamps = [
+        datetime(2002, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=start + i)
+        for i in range(rows)
+    ]
+    return timestamps, np.arange(start, start + rows * columns, dtype=float).reshape(
+        rows, columns
+    )
+
+
+def test_spool_round_trip(tmp_path):
+    spool = Spool(str(tmp_path / "spool"), ["A1", "A2"])
+    spool.put(chunk(0, rows=2))
+    spool.put((chunk(2)[0], np.array([[np.nan, 1.0]])))
+    assert len(spool) == spool.depth == 3
+
+    chunks = spool.get(10, timeout=0)
+    assert [t for c in chunks for t in c[0]] == chunk(0, rows=3)[0]
+    assert np.isnan(chunks[1][1][0, 0])
+    assert len(spool) == 0
+    assert spool.depth == 3  # Not committed yet
+
+    spool.commit()
+    assert spool.depth == 0
+    assert spool.replay_rate > 0
+    spool.close()
+
+
+def test_spool_rotates_segments(tmp_path):
+    directory = str(tmp_path / "spool")
+    spool = Spool(directory, ["A1", "A2"], segment_size=100)
+    for i in range(10):
+        spool.put(chunk(i))  # 32 bytes per record, so three to a segment
+    assert len([name for name in os.listdir(directory) if name.endswith(".spool")]) == 4
+
+    chunks = spool.get(7, timeout=0)
+    assert [c[0][0].second for c in chunks] == list(range(7))
+    spool.commit()
+    assert len([name for name in os.listdir(directory) if name.endswith(".spool")]) == 2
+
+    spool.put(chunk(10, rows=5))  # Larger than a segment
+    chunks = spool.get(100, timeout=0)
+    assert sum(len(c[0]) for c in chunks) == 8
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test_spool_put_async(tmp_path, monkeypatch):
+    directory = str(tmp_path / "spool")
+    spool = Spool(directory, ["A1", "A2"], segment_size=100, sync_interval=0.05)
+    sync = Spool.sync
+
+    def slow_sync(self):
+        time.sleep(0.1)  # As msync can take on a busy disk
+        sync(self)
+
+    monkeypatch.setattr(Spool, "sync", slow_sync)
+
+    async def tick(gaps: list):
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(0.005)
+            gaps.append(time.monotonic() - last)
+            last = time.monotonic()
+
+    # Syncing and rotating every few appends never holds up the loop
+    gaps = []
+    ticking = asyncio.ensure_future(tick(gaps))
+    for i in range(20):
+        await spool.put_async(chunk(i))
+        await asyncio.sleep(0.01)
+    ticking.cancel()
+    assert len([name for name in os.listdir(directory) if name.endswith(".spool")]) > 1
+    assert max(gaps) < 0.05
+
+    chunks = spool.get(100, timeout=0)
+    assert [c[0][0].second for c in chunks] == list(range(20))
+    spool.close()
+
+
+def test_spool_replays_uncommitted(tmp_path):
+    directory = str(tmp_path / "spool")
+    spool = Spool(directory, ["A1", "A2"], segment_size=100)
+    for i in range(5):
+        spool.put(chunk(i))
+    spool.get(2, timeout=0)
+    spool.commit()
+    spool.get(2, timeout=0)  # Read, but never committed
+    spool.close()
+
+    spool = Spool(directory, ["A1", "A2"], segment_size=100)
+    assert len(spool) == 3
+    chunks = spool.get(10, timeout=0)
+    assert [c[0][0].second for c in chunks] == [2, 3, 4]
+    spool.close()
+
+    # A spool of other columns is moved aside rather than replayed
+    spool = Spool(directory, ["A1"])
+    assert len(spool) == 0
+    assert len(os.listdir(str(tmp_path))) == 2
+    spool.close()
+
+
+def test_database_writer_from_spool(tmp_path):
+    spool = Spool(str(tmp_path / "spool"), ["A1", "A2"])
+    insert = TableInsert(Basement, ["A1", "A2"], db.dialect)
+    writer = DatabaseWriter(db, insert, spool, BatchPolicy(max_rows=4))
+    writer.start()
+    for i in range(10):
+        spool.put(chunk(i))
+    writer.stop()
+    spool.close()
+
+    assert writer.written_rows == 10
+    assert spool.depth == 0
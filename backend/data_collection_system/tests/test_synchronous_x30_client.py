@@ -0,0 +1,79 @@
+import importlib.util
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from .. import ROOT_DIR
+from .utils import Mockx30Instrument, PeakGenerator
+
+# The utilities are scripts rather than a package, so import the client from its path
+spec = importlib.util.spec_from_file_location(
+    "synchronous_x30_client",
+    os.path.join(ROOT_DIR, "..", "..", "utilities", "synchronous_x30_client.py"),
+)
+synchronous_x30_client = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(synchronous_x30_client)
+Synchronousx30Client = synchronous_x30_client.Synchronousx30Client
+
+
+def send_slowly(connection: socket.socket, data: bytes, size: int):
+    for i in range(0, len(data), size):
+        connection.sendall(data[i : i + size])
+        time.sleep(0.001)
+
+
+def test_recv_exactly():
+    client = Synchronousx30Client()
+    client.socket, instrument = socket.socketpair()
+
+    # A response split over many segments is received whole, and nothing after it
+    response = bytes(range(256)) * 400
+    sender = threading.Thread(
+        target=send_slowly, args=(instrument, response + b"next", 1000)
+    )
+    sender.start()
+    assert len(client.buffer) < len(response)
+    received = client.recv_exactly(len(response))
+    assert received == response
+    assert received.obj is client.buffer  # Grown to fit, and then reused
+    assert client.recv_exactly(4) == b"next"
+    sender.join()
+
+    instrument.sendall(b"ab")
+    instrument.close()
+    with pytest.raises(ConnectionError):
+        client.recv_exactly(3)
+    client.end()
+
+
+def test_read_and_poll():
+    generator = PeakGenerator(["basement_fbg"])
+    response = generator.x30_data()  # Responses differ only in noise
+    with Mockx30Instrument(generator) as mock:
+        thread = threading.Thread(target=mock.start, daemon=True)
+        thread.start()
+        client = Synchronousx30Client("127.0.0.1", 9500)
+        client.start()
+
+        # By default responses are copied out of the reused receive buffer
+        status_header, data = client.get_data()
+        assert (type(status_header), type(data)) == (bytes, bytes)
+        assert status_header == response[:88]
+        assert len(data) == len(response) - 88
+
+        responses = []
+        stats = client.poll(
+            200,
+            requests=20,
+            callback=lambda header, data: responses.append((bytes(header), len(data))),
+        )
+        client.end()
+        thread.join()
+
+    assert responses == 20 * [(response[:88], len(response) - 88)]
+    assert stats["requests"] == 20
+    assert 0 < stats["latency_mean"] <= stats["latency_max"]
+    assert stats["rate"] <= 200 * 1.1
@@ -0,0 +1,265 @@
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from sqlalchemy.dialects.postgresql import psycopg2
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from database_models import Basement
+from .. import db, Session
+from .. import writers
+from ..writers import (
+    TableInsert,
+    ExecutemanySink,
+    CopySink,
+    make_sink,
+    BoundedQueue,
+    OverflowPolicy,
+    BatchPolicy,
+    DatabaseWriter,
+)
+
+
+def chunk(start, rows=1, columns=2):
+    timestamps = [
+        datetime(2001, 1, 1) + timedelta(seconds=start + i) for i in range(rows)
+    ]
+    return timestamps, np.arange(start, start + rows * columns, dtype=float).reshape(
+        rows, columns
+    )
+
+
+def test_table_insert():
+    insert = TableInsert(Basement, ["A1", "A2"], db.dialect)
+    timestamps = [datetime(2000, 1, 1) + timedelta(seconds=i) for i in range(3)]
+    values = np.array([[1.0, 2.0], [3.0, np.nan], [5.0, 6.0]])
+
+    rows = insert.rows([(timestamps[:2], values[:2]), (timestamps[2:], values[2:])])
+    assert rows[1] == (timestamps[1], 3.0, None)
+
+    with db.connect() as connection:
+        with connection.begin():
+            insert.execute(connection, rows)
+
+    session = Session()
+    inserted = (
+        session.query(Basement.A1, Basement.A2, Basement.A3)
+        .filter(Basement.timestamp.in_(timestamps))
+        .order_by(Basement.timestamp)
+        .all()
+    )
+    session.close()
+
+    assert inserted == [(1.0, 2.0, None), (3.0, None, None), (5.0, 6.0, None)]
+
+    # Rows went straight to the DBAPI, whose errors are still raised as SQLAlchemy's
+    assert insert.positional
+    with pytest.raises(IntegrityError):
+        with db.connect() as connection:
+            with connection.begin():
+                insert.execute(connection, rows[:1])
+
+
+def test_make_sink():
+    insert = TableInsert(Basement, ["A1", "A2"], db.dialect)
+    assert isinstance(make_sink(insert, db.dialect), ExecutemanySink)
+
+    dialect = psycopg2.dialect()
+    sink = make_sink(TableInsert(Basement, ["A1", "A2"], dialect), dialect)
+    assert isinstance(sink, CopySink)
+    assert sink.statement == (
+        'COPY basement_fbg (timestamp, "A1", "A2") FROM STDIN WITH (FORMAT csv)'
+    )
+
+
+def test_copy_sink():
+    class Cursor:
+        def copy_expert(self, statement, file):
+            self.statement = statement
+            self.copied = file.read()
+
+        def close(self):
+            pass
+
+    class Connection:
+        def __init__(self):
+            self.connection = self
+            self.opened = Cursor()
+
+        def cursor(self):
+            return self.opened
+
+    dialect = psycopg2.dialect()
+    sink = CopySink(TableInsert(Basement, ["A1", "A2"], dialect), dialect)
+    connection = Connection()
+    sink.write(connection, [(datetime(2000, 1, 1), 1.5, None)])
+
+    assert connection.opened.statement == sink.statement
+    assert connection.opened.copied == "2000-01-01 00:00:00,1.5,\r\n"
+
+
+def test_bounded_queue_drop_oldest():
+    q = BoundedQueue(3, OverflowPolicy.DROP_OLDEST)
+    for i in range(5):
+        q.put(chunk(i))
+
+    chunks = q.get(10, timeout=0)
+    assert [c[0][0].second for c in chunks] == [2, 3, 4]
+    assert q.dropped == 2
+    assert q.high_water_mark == 3
+    assert len(q) == 0
+
+
+def test_bounded_queue_decimate():
+    q = BoundedQueue(4, OverflowPolicy.DECIMATE)
+    for i in range(5):
+        q.put(chunk(i))
+
+    chunks = q.get(10, timeout=0)
+    assert [t.second for c in chunks for t in c[0]] == [0, 2, 4]
+    assert q.dropped == 2
+
+
+def test_bounded_queue_decimate_bound():
+    q = BoundedQueue(4, OverflowPolicy.DECIMATE)
+    q.put(chunk(0, rows=4))
+    q.put(chunk(10, rows=3))  # Halving the queue leaves room for only one of its rows
+
+    chunks = q.get(10, timeout=0)
+    assert [t.second for c in chunks for t in c[0]] == [2, 10, 11, 12]
+    assert [v for c in chunks for v in c[1][:, 0]] == [4.0, 10.0, 12.0, 14.0]
+    assert q.dropped == 3
+    assert q.high_water_mark == 4
+
+
+def test_bounded_queue_decimate_oversized_chunk():
+    q = BoundedQueue(2, OverflowPolicy.DECIMATE)
+    q.put(chunk(0, rows=3))  # With nothing queued to decimate, it's let in whole
+
+    assert len(q) == 3
+    assert q.dropped == 0
+
+
+@pytest.mark.asyncio
+async def test_bounded_queue_put_async():
+    q = BoundedQueue(2)
+    for i in range(2):
+        await q.put_async(chunk(i))
+    assert not q.put(chunk(2), timeout=0)
+
+    # Waiting for room holds up only the putting task, not the loop
+    putting = asyncio.ensure_future(q.put_async(chunk(2)))
+    await asyncio.sleep(0.05)
+    assert not putting.done()
+    assert len(q.get(1, timeout=0)) == 1
+    await asyncio.wait_for(putting, 1)
+    assert [c[0][0].second for c in q.get(10, timeout=0)] == [1, 2]
+
+
+def test_bounded_queue_get_limit():
+    q = BoundedQueue(100)
+    for i in range(5):
+        q.put(chunk(2 * i, rows=2))
+
+    assert len(q.get(5, timeout=0)) == 2
+    assert len(q.get(1, timeout=0)) == 1  # Always at least one chunk
+    assert len(q) == 4
+
+
+def test_batch_policy():
+    policy = BatchPolicy(max_rows=100, max_age=1, max_bytes=1000)
+    assert not policy.due(rows=10, size=100, age=0.5)
+    assert policy.due(rows=100, size=100, age=0.5)
+    assert policy.due(rows=10, size=1000, age=0.5)
+    assert policy.due(rows=10, size=100, age=1)
+
+    policy.update(1.0)
+    assert policy.max_rows == 200
+    for i in range(40):
+        policy.update(0.0)
+    assert policy.max_rows == policy.min_rows
+
+
+def test_database_writer():
+    q = BoundedQueue(1000)
+    insert = TableInsert(Basement, ["A1", "A2"], db.dialect)
+    writer = DatabaseWriter(db, insert, q, BatchPolicy(max_rows=4))
+    writer.start()
+    for i in range(10):
+        q.put(chunk(100 + i))
+    writer.stop()
+
+    assert writer.written_rows == 10
+    assert len(writer.latencies) >= 1
+
+
+def test_database_writer_retries(monkeypatch):
+    monkeypatch.setattr(writers, "RETRY_INTERVAL", 0.01)
+    q = BoundedQueue(1000)
+    insert = TableInsert(Basement, ["A1", "A2"], db.dialect)
+    writer = DatabaseWriter(db, insert, q, BatchPolicy(max_rows=4))
+
+    write = writer.sink.write
+    failures = iter([True, True])
+
+    def flaky_write(connection, rows):
+        if next(failures, False):
+            raise OperationalError("INSERT", {}, Exception("Database is down"))
+        write(connection, rows)
+
+    writer.sink.write = flaky_write
+    writer.start()
+    for i in range(4):
+        q.put(chunk(200 + i))
+    deadline = time.monotonic() + 5
+    while writer.written_rows < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    writer.stop()
+
+    assert writer.failed_writes == 2
+    assert writer.written_rows == 4
+
+
+def test_database_writer_fails():
+    q = BoundedQueue(2)
+    insert = TableInsert(Basement, ["A1", "A2"], db.dialect)
+    writer = DatabaseWriter(db, insert, q, BatchPolicy(max_rows=2))
+    failing = threading.Event()
+
+    def failing_write(connection, rows):
+        failing.wait(5)
+        raise IntegrityError("INSERT", {}, Exception("Duplicate timestamp"))
+
+    writer.sink.write = failing_write
+    q.put(chunk(300))
+    q.put(chunk(301))
+    writer.start()
+
+    # A producer blocked on the full queue is woken once the writer fails
+    errors = []
+
+    def put():
+        try:
+            for i in range(302, 305):
+                q.put(chunk(i))
+        except RuntimeError as e:
+            errors.append(e)
+
+    producer = threading.Thread(target=put)
+    producer.start()
+    deadline = time.monotonic() + 5
+    while len(q) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    assert producer.is_alive()
+    failing.set()
+    producer.join(5)
+    writer.stop()
+
+    assert isinstance(writer.error, IntegrityError)
+    assert len(errors) == 1 and errors[0].__cause__ is writer.error
+    with pytest.raises(RuntimeError):
+        q.put(chunk(305))
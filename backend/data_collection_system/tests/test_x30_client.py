@@ -1,17 +1,159 @@
+import asyncio
+import threading
+from datetime import datetime, timezone
+from struct import pack
+
+import numpy as np
 import pytest
 
-from ..x30.x30_protocol import GET_DATA, DATA
+from .. import db
+from ..configuration import SetupOptions
+from ..x30.x30_client import x30Client
+from ..x30.x30_protocol import (
+    DELIMITER,
+    GET_DATA,
+    DATA,
+    DataFrame,
+    DataBatch,
+    STATUS_HEADER_LENGTH,
+)
+from .utils import Mockx30Instrument, PeakGenerator
+
+pytestmark = pytest.mark.asyncio
+
 
-pytestmark = [pytest.mark.asyncio, pytest.mark.usefixtures("x30_instrument")]
+def data_response(peaks, granularity: int = 20000, counted: bool = True) -> bytes:
+    """A streamed DATA response with the given peaks in nm for each of the 4 channels."""
+    header = bytearray(STATUS_HEADER_LENGTH)
+    header[3] = 1 << 4  # Primary fan
+    header[6] = (2 << 6) | (1 << 4) | 1  # Operating mode, triggering, switch position
+    header[16:24] = pack("<4H", *(len(channel) for channel in peaks))
+    header[72:76] = pack("<L", granularity)
+    raw = [round(peak * granularity) for channel in peaks for peak in channel]
+    data = bytes(header) + pack("<%dL" % len(raw), *raw)
+    if counted:
+        return b"%010d" % (len(data) + len(DELIMITER)) + data + DELIMITER
+    return b"%010d" % len(data) + data + DELIMITER
 
 
+PEAKS = [[1510.5, 1530.25], [], [1550.0], [1560.0, 1570.0, 1580.0]]
+
+
+@pytest.mark.usefixtures("x30_instrument")
 async def test_get_data(x30_client):
     response = await x30_client.execute(GET_DATA())
     assert response == bytes(88)
 
 
+@pytest.mark.usefixtures("x30_instrument")
 async def test_stream_data(x30_client):
     streamer = x30_client.stream()
-    assert await streamer.__anext__() == DATA(bytes(88) + b"XXXXXXXX")
-    assert await streamer.__anext__() == DATA(bytes(88) + b"XXXXXXXX")
+    for _ in range(2):
+        frame = await streamer.__anext__()
+        assert frame.counts.tolist() == [0, 0, 0, 0]
+        assert frame.peaks.size == 0
     x30_client.streaming = False
+
+
+async def test_data_frame():
+    response = data_response(PEAKS)[10:]
+    frame = DataFrame(response)
+    assert frame.granularity == 20000
+    assert frame.primary_fan and not frame.secondary_fan
+    assert (frame.switch_position, frame.triggering_mode) == (1, 1)
+    assert frame.operating_mode == 2
+    assert [channel.tolist() for channel in frame.content] == PEAKS
+    assert frame.peaks.dtype == np.float64
+
+    # Matches the pydantic DATA response once converted to nm
+    data = DATA(response)
+    assert [peak / data.granularity for peak in data.channel_4_peaks] == PEAKS[3]
+    assert np.isnan(frame.padded[1]).all()
+
+
+async def test_data_batch():
+    other = [[1520.0], [1540.0], [], []]
+    responses = (
+        data_response(PEAKS)
+        + data_response(other, granularity=10000, counted=False)
+        + data_response(PEAKS)
+    )
+    batch, consumed = DataBatch.decode(responses + responses[:50])
+    assert consumed == len(responses)
+    assert len(batch) == 3
+    assert batch.counts.tolist() == [[2, 0, 1, 3], [1, 1, 0, 0], [2, 0, 1, 3]]
+    assert batch.peaks.shape == (3, 4, 3)
+    assert batch.headers["granularity"].tolist() == [20000, 10000, 20000]
+    np.testing.assert_array_equal(
+        batch.peaks[0], DataFrame(data_response(PEAKS)[10:]).padded
+    )
+    assert batch.peaks[1, :2, 0].tolist() == [1520.0, 1540.0]
+    assert np.isnan(batch.peaks[1, :, 1:]).all()
+
+    batch, consumed = DataBatch.decode(responses[:50])
+    assert (len(batch), consumed) == (0, 0)
+
+
+@pytest.mark.usefixtures("configuration")
+async def test_record():
+    x30_client = x30Client()
+    x30_client.host = "127.0.0.1"
+    x30_client.port = 9500
+    x30_client.live_status = False
+    x30_client.configuration.load(SetupOptions.BASEMENT)
+    (table, sensors), = x30_client.configuration.sensors.items()
+    on_x30 = sensors.channel < 4
+
+    started = datetime.now(timezone.utc)
+    with Mockx30Instrument(PeakGenerator(["basement_fbg"]), interval=0.005) as mock:
+        thread = threading.Thread(target=mock.start, daemon=True)
+        thread.start()
+        await x30_client.connect()
+
+        recording = asyncio.ensure_future(x30_client.record())
+        await asyncio.sleep(0.5)
+        x30_client.streaming = False
+        await recording
+        await x30_client.disconnect()
+        thread.join()
+
+    assert x30_client.received > 10
+    assert x30_client.written_rows == x30_client.received
+    assert not x30_client.configuration.unmatched_peaks[table]
+
+    with db.begin() as connection:
+        rows = connection.execute(
+            table.__table__.select().where(table.timestamp >= started)
+        ).fetchall()
+        assert len(rows) == x30_client.received
+        assert len({row.timestamp for row in rows}) == len(rows)
+        for uid, recorded in zip(sensors.uids, on_x30):
+            assert (getattr(rows[-1], uid) is not None) == recorded
+        connection.execute(table.__table__.delete().where(table.timestamp >= started))
+
+
+@pytest.mark.usefixtures("configuration")
+async def test_record_fails(monkeypatch):
+    x30_client = x30Client()
+    x30_client.host = "127.0.0.1"
+    x30_client.port = 9500
+    x30_client.live_status = False
+    x30_client.configuration.load(SetupOptions.BASEMENT)
+
+    def map(peaks, table):
+        raise ValueError("Mapping failed")
+
+    monkeypatch.setattr(x30_client.configuration, "map", map)
+    with Mockx30Instrument(PeakGenerator(["basement_fbg"]), interval=0.005) as mock:
+        thread = threading.Thread(target=mock.start, daemon=True)
+        thread.start()
+        await x30_client.connect()
+
+        with pytest.raises(ValueError):
+            await asyncio.wait_for(x30_client.record(), 5)
+
+        # Streaming was still stopped, and the connection can be used again
+        assert not mock.streaming
+        assert await x30_client.execute(GET_DATA())
+        await x30_client.disconnect()
+        thread.join()
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+from ..x30.x30_framer import Framer
+from ..x30.x30_protocol import DELIMITER, STOP_DELIMITER
+
+
+pytestmark = pytest.mark.asyncio
+
+
+def response(data: bytes) -> bytes:
+    return b"%010d" % len(data) + data
+
+
+async def test_framer_reassembles_split_responses():
+    reader = asyncio.StreamReader()
+    framer = Framer(reader)
+    stream = (
+        response(bytes(88) + DELIMITER)
+        + response(bytes(88))  # Delimiter not counted in the length
+        + DELIMITER
+        + response(b"Streaming data disabled.\n" + STOP_DELIMITER)
+    )
+
+    async def feed():
+        for i in range(0, len(stream), 7):
+            reader.feed_data(stream[i : i + 7])
+            await asyncio.sleep(0)
+
+    feeding = asyncio.ensure_future(feed())
+    assert await framer.read_streamed() == bytes(88) + DELIMITER
+    assert await framer.read_streamed() == bytes(88) + DELIMITER
+    assert await framer.discard_until(STOP_DELIMITER) == 10 + 25 + 8
+    await feeding
+
+
+async def test_framer_discards_past_the_limit():
+    reader = asyncio.StreamReader(limit=1024)
+    framer = Framer(reader)
+    reader.feed_data(response(bytes(88) + DELIMITER) * 1000 + STOP_DELIMITER + b"next")
+    assert await framer.discard_until(STOP_DELIMITER) == 106 * 1000 + 8
+    assert await reader.readexactly(4) == b"next"
+
+
+async def test_framer_rejects_bad_lengths():
+    reader = asyncio.StreamReader()
+    reader.feed_data(b"not a size")
+    with pytest.raises(ValueError):
+        await Framer(reader).read()
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+from ..x30.x30_client import x30Client
+from ..x30.x30_spectrum import SpectrumFile, spectrum_points
+from .utils import Mockx30Instrument, SPECTRUM_POINTS
+
+pytestmark = pytest.mark.asyncio
+
+POINTS = 10
+SECOND = 10 ** 9  # ns
+
+
+def spectrum(level: int) -> bytes:
+    return bytes(88) + np.full(4 * POINTS, level, dtype="<u2").tobytes()
+
+
+async def test_spectrum_file(tmp_path):
+    path = str(tmp_path / "test.spectra")
+    spectra = SpectrumFile(path, spectrum_points(len(spectrum(0))), capacity=4)
+    for i in range(3):
+        spectra.append(spectrum(i), received=(1600000000 + i) * SECOND)
+    with pytest.raises(ValueError):
+        spectra.append(bytes(100))
+    spectra.close()
+
+    # Reopened, the spectra written are found from the index
+    spectra = SpectrumFile(path)
+    assert (spectra.points, spectra.capacity, len(spectra)) == (POINTS, 4, 3)
+    timestamps, levels = spectra.read(
+        datetime.fromtimestamp(1600000001, timezone.utc),
+        datetime.fromtimestamp(1600000002, timezone.utc),
+    )
+    assert timestamps.tolist() == [(1600000000 + 1) * SECOND]
+    assert (levels["levels"] == 1).all()
+    assert np.shares_memory(levels, spectra.spectra)
+
+    spectra.append(spectrum(3))
+    assert spectra.full
+    with pytest.raises(IndexError):
+        spectra.append(spectrum(4))
+    assert len(spectra.read()[1]) == 4
+    spectra.close()
+
+
+async def test_capture_spectra(tmp_path):
+    client = x30Client()
+    client.host = "127.0.0.1"
+    client.port = 9500
+
+    with Mockx30Instrument() as mock:
+        thread = threading.Thread(target=mock.start, daemon=True)
+        thread.start()
+        await client.connect()
+
+        capturing = asyncio.ensure_future(
+            client.capture_spectra(0.05, str(tmp_path), capacity=2)
+        )
+        await asyncio.sleep(0.28)
+        client.stop_capture()
+        await capturing
+        await client.disconnect()
+        thread.join()
+
+    paths = sorted(os.listdir(tmp_path))
+    counts = []
+    for path in paths:
+        spectra = SpectrumFile(str(tmp_path / path))
+        timestamps, levels = spectra.read()
+        counts.append(len(spectra))
+        assert spectra.points == SPECTRUM_POINTS
+        assert (np.diff(timestamps.astype("i8")) >= 0.04 * SECOND).all()
+        expected = np.arange(4 * SPECTRUM_POINTS).reshape(4, SPECTRUM_POINTS)
+        assert (levels["levels"] == expected).all()
+        wavelengths = spectra.wavelengths(levels[0])
+        assert (wavelengths[0], wavelengths[-1]) == (1510, 1590)
+        spectra.close()
+
+    assert sum(counts) >= 5
+    assert counts[:-1] == [2] * (len(counts) - 1)
@@ -1,8 +1,18 @@
-from datetime import datetime
+import asyncio
+import time
+from datetime import datetime, timezone
 from ipaddress import ip_address
 
+import numpy as np
 import pytest
 
+from .. import db
+from ..configuration import SetupOptions
+from .utils import Mockx55Instrument, PeakGenerator
+from ..writers import DatabaseWriter
+from ..x55 import x55_client as x55_client_module, x55_monitor
+from ..x55.x55_client import x55Client, resolve
+from ..x55.x55_monitor import StreamMonitor
 from ..x55.x55_protocol import (
     GetFirmwareVersion,
     GetInstrumentName,
@@ -29,6 +39,8 @@ from ..x55.x55_protocol import (
     Ready,
     DutChannelCount,
     Peaks,
+    PeakFrame,
+    PeakBatch,
     PeakDataStreamingStatus,
     PeakDataStreamingDivider,
     PeakDataStreamingAvailableBuffer,
@@ -74,6 +86,55 @@ async def test_get_dut_channel_count(x55_client):
     assert response.content == 16
 
 
+async def test_serialize_requests():
+    # Requests without arguments are serialized once, when their class is defined
+    assert GetPeaks().serialize() is GetPeaks().serialize()
+    assert GetPeaks().serialize() == b"\x00\x00\x09\x00\x00\x00\x00\x00#GetPeaks"
+    assert (
+        SetNtpEnabled(enabled=True).serialize()
+        == b"\x00\x00\x0e\x00\x01\x00\x00\x00#SetNtpEnabled1"
+    )
+    assert (
+        SetInstrumentUtcDateTime(dt=datetime(2020, 1, 2, 3, 4, 5))
+        .serialize()
+        .endswith(b"#SetInstrumentUtcDateTime2020 01 02 03 04 05")
+    )
+    with pytest.raises(TypeError):
+        SetLaserScanSpeed()
+    with pytest.raises(AttributeError):
+        GetPeaks().unknown = 1  # Messages have slots, not a __dict__
+
+
+async def test_execute_many(x55_client):
+    name, count, firmware = await x55_client.command.execute_many(
+        [GetInstrumentName(), GetDutChannelCount(), GetFirmwareVersion()]
+    )
+
+    assert InstrumentName(name).content == "Lab-1"
+    assert DutChannelCount(count).content == 16
+    assert FirmwareVersion(firmware).content == "12.12.1.20099"
+    assert not x55_client.command.busy
+
+
+async def test_execute_pipelined(x55_client):
+    # A cancelled request's response is still read, so later ones stay matched
+    cancelled = asyncio.ensure_future(x55_client.command.execute(GetFirmwareVersion()))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+
+    name, count = await asyncio.gather(
+        x55_client.command.execute(GetInstrumentName()),
+        x55_client.command.execute(GetDutChannelCount()),
+    )
+    assert InstrumentName(name).content == "Lab-1"
+    assert DutChannelCount(count).content == 16
+
+    await x55_client.update_status()
+    assert x55_client.instrument_name == "Lab-1"
+    assert x55_client.ntp_server == ip_address("98.175.203.200")
+    assert x55_client.peak_data_streaming_available_buffer == 100
+
+
 async def test_get_peaks(x55_client):
     response = Peaks(await x55_client.command.execute(GetPeaks()))
 
@@ -83,6 +144,33 @@ async def test_get_peaks(x55_client):
     assert response.content == [20 * [800.0] for i in range(16)]
 
 
+async def test_get_peak_frame(x55_client):
+    response = PeakFrame(await x55_client.command.execute(GetPeaks()))
+
+    assert response.status == True
+    assert response.message == ""
+    assert response.timestamp_ns == 10500000000
+    assert response.timestamp.timestamp() == 10.5
+    assert response.counts.tolist() == 16 * [20]
+    assert [channel.tolist() for channel in response.content] == [
+        20 * [800.0] for i in range(16)
+    ]
+    assert response.channel(3).base is not None  # A view, not a copy
+
+
+async def test_decode_peak_batch():
+    response = Mockx55Instrument().respond("#GetPeaks")
+    batch, consumed = PeakBatch.decode(3 * response + response[:100])
+
+    assert consumed == 3 * len(response)
+    assert len(batch) == 3
+    assert batch.timestamps.tolist() == 3 * [10500000000]
+    assert batch.datetimes[0].timestamp() == 10.5
+    assert batch.counts.shape == (3, 16)
+    assert batch.peaks.shape == (3, 16, 20)
+    assert np.all(batch.peaks == 800.0)
+
+
 async def test_enable_peak_data_streaming(x55_client):
     response = Response(await x55_client.command.execute(EnablePeakDataStreaming()))
 
@@ -219,14 +307,333 @@ async def test_get_ntp_server(x55_client):
     assert response.content == ip_address("98.175.203.200")
 
 
-async def test_peaks_streaming(x55_client):
-    count = 1
+async def test_peaks_streaming(x55_client, x55_instrument):
+    timestamps = []
     async for response in x55_client.stream():
         assert response.status == True
         assert response.message == ""
-        assert response.timestamp.timestamp() == 10.5
-        assert response.content == [20 * [800.0] for i in range(16)]
+        assert response.counts.tolist() == x55_instrument.generator.counts.tolist()
+        assert np.allclose(
+            np.concatenate(response.content),
+            x55_instrument.generator.wavelength,
+            atol=0.01,
+        )
+
+        timestamps.append(response.timestamp_ns)
+        if len(timestamps) == 5:
+            x55_client.streaming = False
+
+    assert np.diff(timestamps).tolist() == 4 * [x55_instrument.period]
+
+
+async def test_peak_frames_are_copied(x55_client, x55_instrument):
+    # Frames kept past the next read still hold their own response
+    frames = []
+    async for frame in x55_client.stream():
+        frames.append(frame)
+        if len(frames) == 5:
+            x55_client.streaming = False
+
+    timestamps = [frame.timestamp_ns for frame in frames]
+    assert np.diff(timestamps).tolist() == 4 * [x55_instrument.period]
+
+
+async def test_batch_peaks_streaming(x55_client, x55_instrument):
+    timestamps = []
+    async for response in x55_client.stream(batch=True):
+        assert len(response) >= 1
+        assert np.all(response.counts == x55_instrument.generator.counts)
+
+        timestamps.extend(response.timestamps.tolist())
+        if len(timestamps) >= 3:
+            x55_client.streaming = False
+
+    assert np.all(np.diff(timestamps) == x55_instrument.period)
+
+
+async def test_raw_peaks_streaming(x55_client):
+    count = 1
+    async for frames in x55_client.stream(raw=True):
+        batch, consumed = PeakBatch.decode(frames)
+        assert consumed == len(frames)
+        assert len(batch) >= 1
 
         count += 1
-        if count > 5:
+        if count > 3:
+            x55_client.streaming = False
+
+
+async def test_streaming_rate(x55_client, x55_instrument):
+    await x55_client.update_laser_scan_speed(1000)
+    await x55_client.update_peak_data_streaming_divider(10)
+    assert x55_instrument.period == 10 ** 7
+
+    timestamps = []
+    async for response in x55_client.stream(batch=True):
+        timestamps.extend(response.timestamps.tolist())
+        if len(timestamps) >= 20:
+            x55_client.streaming = False
+
+    assert np.all(np.diff(timestamps) == 10 ** 7)
+
+
+async def test_capture_and_replay(x55_client, tmp_path):
+    x55_client.capture = str(tmp_path / "peaks.x55")
+    captured = []
+    async for response in x55_client.stream():
+        captured.append(response.timestamp_ns)
+        if len(captured) == 3:
+            x55_client.streaming = False
+
+    x55_client.capture = None
+    x55_client.replay = str(tmp_path / "peaks.x55")
+    replayed = []
+    async for response in x55_client.stream(batch=True):
+        replayed.extend(response.timestamps.tolist())
+    assert replayed == captured
+
+    # At the original cadence, the mock instrument sends a response every 0.1 s
+    x55_client.replay_realtime = True
+    start = time.monotonic()
+    replayed = []
+    async for response in x55_client.stream():
+        replayed.append(response.timestamp_ns)
+    assert replayed == captured
+    assert time.monotonic() - start > 0.15
+
+
+async def test_monitor_decisions(x55_client):
+    monitor = StreamMonitor(x55_client)
+    monitor.divider = monitor.original_divider = 1
+
+    # Throttle one step at a time after THROTTLE_SAMPLES lagging samples in a row
+    assert [monitor.decide(0.9) for _ in range(3)] == [None, None, 10]
+    monitor.divider = 10
+    assert monitor.decide(0.3) is None
+    assert [monitor.decide(0.9) for _ in range(3)] == [None, None, 100]
+    monitor.divider = 100
+    assert [monitor.decide(0.9) for _ in range(3)] == [None, None, 100]
+
+    # and restore one step at a time after RESTORE_SAMPLES with headroom
+    assert [monitor.decide(0.0) for _ in range(10)] == 9 * [None] + [10]
+    monitor.divider = 10
+    assert [monitor.decide(0.0) for _ in range(10)] == 9 * [None] + [1]
+    monitor.divider = 1
+    assert [monitor.decide(0.0) for _ in range(10)] == 10 * [None]
+
+    # Straight back to an original divider that isn't one of the options
+    monitor.divider = monitor.original_divider = 5
+    assert [monitor.decide(0.9) for _ in range(3)] == [None, None, 10]
+    monitor.divider = 10
+    assert [monitor.decide(0.0) for _ in range(10)] == 9 * [None] + [5]
+
+
+async def test_monitor_throttles(x55_client, x55_instrument, monkeypatch):
+    monkeypatch.setattr(x55_monitor, "THROTTLE_LAG", -1)  # Always behind
+    await x55_client.update_laser_scan_speed(1000)
+    x55_client.monitor_interval = 0.01
+
+    start = time.monotonic()
+    dividers = set()
+    async for _ in x55_client.stream(batch=True):
+        dividers.add(x55_instrument.divider)
+        if x55_instrument.divider > 1 or time.monotonic() - start > 5:
+            x55_client.streaming = False
+    assert dividers == {1, 10}
+
+    # Restored once streaming stops
+    assert x55_instrument.divider == 1
+
+
+async def test_stream_closed_early(x55_client, x55_instrument, monkeypatch):
+    monkeypatch.setattr(x55_monitor, "THROTTLE_LAG", -1)  # Always behind
+    await x55_client.update_laser_scan_speed(1000)
+    x55_client.monitor_interval = 0.01
+
+    # The consumer fails while the stream is throttled
+    start = time.monotonic()
+    stream = x55_client.stream(batch=True)
+    with pytest.raises(RuntimeError):
+        try:
+            async for _ in stream:
+                if x55_instrument.divider > 1 or time.monotonic() - start > 5:
+                    raise RuntimeError("Consumer failed")
+        finally:
+            await stream.aclose()
+
+    # Closing the stream still stops monitoring and streaming, restoring the divider
+    assert x55_client.monitor is None
+    assert not x55_client.streaming
+    assert not x55_instrument.streaming
+    assert x55_instrument.divider == 1
+
+
+async def test_monitor_keeps_divider_set_while_streaming(
+    x55_client, x55_instrument, monkeypatch
+):
+    monkeypatch.setattr(x55_monitor, "THROTTLE_LAG", -1)  # Always behind
+    await x55_client.update_laser_scan_speed(1000)
+    x55_client.monitor_interval = 0.01
+
+    # The divider is set while the stream is throttled
+    start = time.monotonic()
+    async for _ in x55_client.stream(batch=True):
+        if x55_instrument.divider == 10 or time.monotonic() - start > 5:
+            await x55_client.update_peak_data_streaming_divider(100)
+            await asyncio.sleep(0.05)  # For the monitor to sample
+            x55_client.streaming = False
+
+    # and is not restored to the divider that streaming started with
+    assert x55_instrument.divider == 100
+
+
+async def test_monitor_fails(x55_client, x55_instrument, monkeypatch):
+    def decide(self, lag):
+        raise ValueError("Monitor failed")
+
+    monkeypatch.setattr(StreamMonitor, "decide", decide)
+    await x55_client.update_laser_scan_speed(1000)
+    x55_client.monitor_interval = 0.01
+
+    async for _ in x55_client.stream(batch=True):
+        await asyncio.sleep(0.05)
+        x55_client.streaming = False
+
+    # Streaming is still stopped and the connection closed
+    assert x55_client.monitor is None
+    assert not x55_instrument.streaming
+    assert x55_client.peaks.transport.is_closing()
+
+
+async def test_drain_on_stop(x55_client, x55_instrument):
+    await x55_client.update_laser_scan_speed(1000)
+
+    timestamps = []
+    async for response in x55_client.stream(batch=True, drain=True):
+        timestamps.extend(response.timestamps.tolist())
+        if len(timestamps) >= 20:
             x55_client.streaming = False
+        await asyncio.sleep(0.05)  # Fall behind, so that responses are left over
+
+    # Every response sent before streaming was disabled is taken in, without gaps
+    assert len(timestamps) == x55_instrument.sent
+    assert np.all(np.diff(timestamps) == x55_instrument.period)
+
+
+@pytest.mark.usefixtures("configuration")
+@pytest.mark.parametrize("batch", [False, True])
+async def test_record(batch):
+    x55_client = x55Client()
+    x55_client.host = "127.0.0.1"
+    x55_client.command_port = 52031
+    x55_client.peak_streaming_port = 52032
+    x55_client.live_status = False
+    # Two tables, each mapped from the same peaks
+    x55_client.configuration.load(SetupOptions.BASEMENT_AND_FRAME)
+    assert len(x55_client.configuration.sensors) == 2
+
+    started = datetime.now(timezone.utc)
+    async with Mockx55Instrument(
+        PeakGenerator(["basement_fbg", "steel_frame_fbg"]),
+        scan_speed=100,
+        command_port=52031,
+        peak_streaming_port=52032,
+    ) as mock:
+        await x55_client.connect()
+        recording = asyncio.ensure_future(x55_client.record(batch))
+        await asyncio.sleep(0.3)
+        x55_client.streaming = False
+        await asyncio.wait_for(recording, 5)
+        await x55_client.disconnect()
+
+    assert mock.sent > 10
+    assert x55_client.written_rows == mock.sent
+    with db.begin() as connection:
+        for table, sensors in x55_client.configuration.sensors.items():
+            assert not x55_client.configuration.unmatched_peaks[table]
+            rows = connection.execute(
+                table.__table__.select().where(table.timestamp >= started)
+            ).fetchall()
+            assert len(rows) == mock.sent
+            assert all(getattr(rows[-1], uid) is not None for uid in sensors.uids)
+            connection.execute(
+                table.__table__.delete().where(table.timestamp >= started)
+            )
+
+
+async def test_record_slow_writer_stop(monkeypatch):
+    stop = DatabaseWriter.stop
+
+    def slow_stop(writer):
+        time.sleep(0.5)
+        stop(writer)
+
+    monkeypatch.setattr(DatabaseWriter, "stop", slow_stop)
+    x55_client = x55Client()
+    x55_client.host = "127.0.0.1"
+    x55_client.command_port = 52031
+    x55_client.peak_streaming_port = 52032
+    x55_client.live_status = False
+    x55_client.configuration.load(SetupOptions.BASEMENT)
+
+    async def tick(gaps: list):
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(0.01)
+            gaps.append(time.monotonic() - last)
+            last = time.monotonic()
+
+    started = datetime.now(timezone.utc)
+    async with Mockx55Instrument(
+        PeakGenerator(["basement_fbg"]),
+        scan_speed=100,
+        command_port=52031,
+        peak_streaming_port=52032,
+    ):
+        await x55_client.connect()
+        recording = asyncio.ensure_future(x55_client.record())
+        await asyncio.sleep(0.2)
+        gaps = []
+        ticking = asyncio.ensure_future(tick(gaps))
+        x55_client.streaming = False
+        await asyncio.wait_for(recording, 5)
+        ticking.cancel()
+        await x55_client.disconnect()
+
+    # The loop carried on while waiting for the writer to stop
+    assert sum(gaps) > 0.5
+    assert max(gaps) < 0.2
+
+    with db.begin() as connection:
+        for table in x55_client.configuration.sensors:
+            connection.execute(
+                table.__table__.delete().where(table.timestamp >= started)
+            )
+
+
+async def test_status_tiers(x55_client):
+    fields = list(x55_client_module.STATUS_FIELDS)
+    assert await x55_client.update_status() == fields
+
+    # Only the dynamic fields are due again a second later, and nothing straight away
+    assert await x55_client.update_status() == []
+    for field in fields:
+        x55_client.status_updated[field] -= 1
+    assert await x55_client.update_status() == [
+        "is_ready",
+        "peak_data_streaming_status",
+        "peak_data_streaming_available_buffer",
+        "instrument_time",
+    ]
+
+    # Setting the divider counts as fetching it
+    for field in fields:
+        x55_client.status_updated[field] -= 60
+    await x55_client.update_peak_data_streaming_divider(10)
+    assert "peak_data_streaming_divider" not in await x55_client.update_status()
+    assert await x55_client.update_status(force=True) == fields
+
+
+async def test_resolve():
+    assert await resolve("localhost") == ip_address("127.0.0.1")
+    assert "localhost" in x55_client_module._resolved
@@ -1,30 +1,53 @@
 import socket
 import re
+import os
+import csv
+import time
 from struct import pack, unpack
 import asyncio
 
+import numpy as np
+
+TEST_DATA = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "../../database_models/test_data"
+)
+OUT_OF_BAND = 1500.0  # nm, below every wavelength window
+TICK = 0.005  # Seconds between writes of streamed responses
+SPECTRUM_POINTS = 2000  # Per channel of the mock sm130's spectra
+
 
 class Mockx30Instrument:
-    def __init__(self):
+    """
+    Mock sm130, streaming a response every interval seconds, with no peaks or with the
+    peaks of a PeakGenerator on its first four channels.
+    """
+
+    def __init__(self, generator=None, interval=1):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.streaming = False
+        self.generator = generator
+        self.interval = interval
+        self.sent = 0  # Streamed responses
 
     def __enter__(self):
         self.socket.bind(("127.0.0.1", 9500))
+        self.socket.listen()
         return self
 
     def __exit__(self, exception_type, value, traceback):
         self.socket.close()
 
     def start(self):
-        self.socket.listen()
         conn, _ = self.socket.accept()
-        conn.settimeout(1)
+        conn.settimeout(self.interval)
         while True:
             while True:
                 try:
                     data = conn.recv(1024)
+                    if not data:  # The client disconnected
+                        conn.close()
+                        return
                     if b"\n" in data:
                         break
                 except socket.timeout:
@@ -40,13 +63,20 @@ class Mockx30Instrument:
 
     def respond(self, command):
         if command == "GET_DATA":
-            data = bytes(88)
+            if self.generator is not None:
+                data = self.generator.x30_data()
+            else:
+                data = bytes(88)
             if self.streaming:
                 data += b"XXXXXXXX"
+                self.sent += 1
             length = format(len(data), "010").encode("ascii")
             response = length + data
             return response
 
+        elif command == "GET_SPECTRUM":
+            return self.spectrum()
+
         elif command == "SET_STREAMING_DATA 1":
             self.streaming = True
             data = b"Streaming data enabled.\n"
@@ -61,19 +91,165 @@ class Mockx30Instrument:
             response = length + data
             return response
 
+    def spectrum(self, granularity: int = 20000) -> bytes:
+        """A GET_SPECTRUM response from 1510 nm to 1590 nm on every channel."""
+        header = bytearray(88)
+        header[72:76] = pack("<I", granularity)
+        header[80:88] = pack("<II", 1510 * granularity, 1590 * granularity)
+        levels = np.arange(4 * SPECTRUM_POINTS, dtype="<u2")
+        data = bytes(header) + levels.tobytes()
+        return format(len(data), "010").encode("ascii") + data
+
+
+class PeakGenerator:
+    """
+    Realistic #GetPeaks responses, with a peak for every sensor in the metadata CSVs of
+    the given tables on its channel and at its initial wavelength, plus some noise.
+    Faults can be injected at random: each peak is dropped with probability drop or
+    followed by an extra reading in the same window with probability extra, and each
+    channel reads an out-of-band peak with probability out_of_band.
+    With peaks_per_channel, every channel is instead trimmed or padded with out-of-band
+    peaks to that many peaks.
+    """
+
+    def __init__(
+        self,
+        tables=("basement_fbg", "steel_frame_fbg"),
+        peaks_per_channel=None,
+        noise=0.001,
+        drop=0.0,
+        extra=0.0,
+        out_of_band=0.0,
+        seed=0,
+    ):
+        channels = [[] for _ in range(16)]
+        for table in tables:
+            path = os.path.join(TEST_DATA, f"{table}_metadata.csv")
+            with open(path, encoding="utf-8-sig") as csvfile:
+                for row in csv.DictReader(csvfile):
+                    wavelength = (
+                        row["initial_wavelength"] or row["reference_wavelength"]
+                    )
+                    if row["channel"] and wavelength:
+                        channels[int(row["channel"])].append(float(wavelength))
+
+        for peaks in channels:
+            peaks.sort()
+            if peaks_per_channel is not None:
+                del peaks[peaks_per_channel:]
+                peaks.extend(
+                    OUT_OF_BAND - i for i in range(peaks_per_channel - len(peaks))
+                )
+                peaks.sort()
+
+        self.counts = np.array([len(peaks) for peaks in channels])
+        self.channel = np.repeat(np.arange(16), self.counts)
+        self.wavelength = np.array([peak for peaks in channels for peak in peaks])
+        self.noise = noise
+        self.drop = drop
+        self.extra = extra
+        self.out_of_band = out_of_band
+        self.random = np.random.RandomState(seed)
+
+    def response(self, timestamp: int) -> bytes:
+        """A framed response with an instrument timestamp in nanoseconds."""
+        random = self.random
+        channel = self.channel
+        wavelength = self.wavelength + self.noise * random.standard_normal(len(channel))
+
+        if self.drop:
+            kept = random.random_sample(len(channel)) >= self.drop
+            channel, wavelength = channel[kept], wavelength[kept]
+        if self.extra:
+            extra = random.random_sample(len(channel)) < self.extra
+            channel = np.concatenate((channel, channel[extra]))
+            wavelength = np.concatenate((wavelength, wavelength[extra] + 0.05))
+        if self.out_of_band:
+            out_of_band = np.nonzero(random.random_sample(16) < self.out_of_band)[0]
+            channel = np.concatenate((channel, out_of_band))
+            wavelength = np.concatenate(
+                (wavelength, np.full(len(out_of_band), OUT_OF_BAND))
+            )
+
+        order = np.lexsort((wavelength, channel))
+        seconds, nanoseconds = divmod(timestamp, 10 ** 9)
+        content = (
+            pack("<HH4x8xII", 56, 0, seconds, nanoseconds)
+            + np.bincount(channel, minlength=16).astype("<u2").tobytes()
+            + wavelength[order].astype("<f8").tobytes()
+        )
+        return pack("<BBHI", 0, 0, 0, len(content)) + content
+
+    def x30_data(self, granularity: int = 20000) -> bytes:
+        """An sm130 DATA response, with the peaks of only the first four channels."""
+        random = self.random
+        on_x30 = self.channel < 4
+        channel = self.channel[on_x30]
+        wavelength = self.wavelength[on_x30] + self.noise * random.standard_normal(
+            len(channel)
+        )
+
+        header = bytearray(88)
+        header[16:24] = np.bincount(channel, minlength=4).astype("<u2").tobytes()
+        header[72:76] = pack("<I", granularity)
+        peaks = np.round(wavelength * granularity).astype("<u4")
+        return bytes(header) + peaks.tobytes()
+
 
 class Mockx55Instrument:
-    def __init__(self):
+    """
+    Mock si255 with a command port, and a peak streaming port that streams responses
+    from a PeakGenerator at the laser scan speed divided by the streaming divider, both
+    of which can be set with their commands. Instrument timestamps start at start, in
+    nanoseconds since the epoch (or now), and advance by exactly one period per response.
+    Responses the client has not yet taken off the socket are held in a streaming buffer
+    of buffer_size bytes, whose free space is the available streaming buffer reported.
+    A #GetPeaks on the command port still returns the same fixed response every time.
+    """
+
+    def __init__(
+        self,
+        generator=None,
+        scan_speed=10,
+        divider=1,
+        start=None,
+        buffer_size=2 ** 22,
+        command_port=51971,
+        peak_streaming_port=51972,
+    ):
         self.command = None
         self.peaks = None
         self.streaming = False
+        self.generator = generator or PeakGenerator()
+        self.scan_speed = scan_speed
+        self.divider = divider
+        self.timestamp = time.time_ns() if start is None else start
+        self.sent = 0  # Responses streamed
+        self.buffer_size = buffer_size
+        self.transport = None  # Of the peak streaming connection
+        self.streams = set()  # Tasks streaming to each peak streaming connection
+        self.command_port = command_port
+        self.peak_streaming_port = peak_streaming_port
+
+    @property
+    def available_buffer(self) -> int:
+        """Percentage of the streaming buffer that is free."""
+        if self.transport is None:
+            return 100
+        used = self.transport.get_write_buffer_size() / self.buffer_size
+        return max(0, 100 - int(100 * used))
+
+    @property
+    def period(self) -> int:
+        """Nanoseconds between streamed responses."""
+        return 10 ** 9 * self.divider // self.scan_speed
 
     async def __aenter__(self):
         self.command = await asyncio.start_server(
-            self.start_command, host="127.0.0.1", port=51971
+            self.start_command, host="127.0.0.1", port=self.command_port
         )
         self.peaks = await asyncio.start_server(
-            self.start_peaks, host="127.0.0.1", port=51972
+            self.start_peaks, host="127.0.0.1", port=self.peak_streaming_port
         )
         return self
 
@@ -81,13 +257,22 @@ class Mockx55Instrument:
         self.command.close()
         self.peaks.close()
 
+        # A client that never disconnected would otherwise leave them streaming
+        streams = list(self.streams)
+        for task in streams:
+            task.cancel()
+        await asyncio.gather(*streams, return_exceptions=True)
+
     async def start_command(self, reader, writer):
         while True:
-            data = await reader.read(8)
-            command_size = unpack("<H", data[2:4])[0]
-            arguments_size = unpack("<I", data[4:8])[0]
-            command = (await reader.read(command_size)).decode("ascii")
-            arguments = await reader.read(arguments_size)
+            try:
+                data = await reader.readexactly(8)
+                command_size = unpack("<H", data[2:4])[0]
+                arguments_size = unpack("<I", data[4:8])[0]
+                command = (await reader.readexactly(command_size)).decode("ascii")
+                arguments = await reader.readexactly(arguments_size)
+            except asyncio.IncompleteReadError:  # The client disconnected
+                return
 
             if command == "#EnablePeakDataStreaming":
                 self.streaming = True
@@ -95,15 +280,49 @@ class Mockx55Instrument:
             if command == "#DisablePeakDataStreaming":
                 self.streaming = False
 
+            if command == "#SetLaserScanSpeed":
+                self.scan_speed = int(arguments)
+
+            if command == "#SetPeakDataStreamingDivider":
+                self.divider = int(arguments)
+
             response = self.respond(command, arguments)
             writer.write(response)
 
     async def start_peaks(self, _, writer):
-        response = self.respond("#GetPeaks")
-        while True:
-            if self.streaming:
-                writer.write(response)
-            await asyncio.sleep(0.1)
+        task = asyncio.current_task()
+        self.streams.add(task)
+        try:
+            await self.stream_peaks(writer)
+        finally:
+            self.streams.discard(task)
+            writer.close()
+
+    async def stream_peaks(self, writer):
+        self.transport = writer.transport
+        self.transport.set_write_buffer_limits(high=self.buffer_size)
+        rate = None  # Responses per second since started, at the time started
+        while not writer.is_closing():
+            if not self.streaming:
+                rate = None
+            else:
+                if rate != self.scan_speed / self.divider:
+                    rate = self.scan_speed / self.divider
+                    started, sent = time.monotonic(), self.sent
+
+                # Send the first response straight away and the rest on schedule
+                due = sent + 1 + int((time.monotonic() - started) * rate) - self.sent
+                if due > 0:
+                    writer.write(
+                        b"".join(
+                            self.generator.response(self.timestamp + i * self.period)
+                            for i in range(due)
+                        )
+                    )
+                    self.timestamp += due * self.period
+                    self.sent += due
+                    await writer.drain()
+            await asyncio.sleep(TICK)
 
     def respond(self, command, arguments=None):
         status = pack("<B", 0)
@@ -165,16 +384,23 @@ class Mockx55Instrument:
                 content = pack("<I", 0)
 
         elif command == "#GetPeakDataStreamingDivider":
-            message = b"The data streaming divider is currently 1."
-            content = pack("<I", 1)
+            message = b"The data streaming divider is currently %d." % self.divider
+            content = pack("<I", self.divider)
+
+        elif command == "#SetPeakDataStreamingDivider":
+            message = b"Data streaming divider set to %b." % arguments
+            content = b""
 
         elif command == "#GetPeakDataStreamingAvailableBuffer":
-            message = b"The available streaming data buffer is currently 100%."
-            content = pack("<I", 100)
+            message = (
+                b"The available streaming data buffer is currently %d%%."
+                % self.available_buffer
+            )
+            content = pack("<I", self.available_buffer)
 
         elif command == "#GetLaserScanSpeed":
-            message = b"The current scan speed is 10 Hz."
-            content = pack("<I", 10)
+            message = b"The current scan speed is %d Hz." % self.scan_speed
+            content = pack("<I", self.scan_speed)
 
         elif command == "#SetLaserScanSpeed":
             message = b"Laser scan speed set to %b Hz." % arguments
@@ -0,0 +1,477 @@
+import asyncio
+import csv
+import io
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from enum import IntEnum
+from typing import List, Tuple
+
+import numpy as np
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+from database_models import Base
+from . import logger
+
+# A chunk of rows as column arrays: a timestamp per row and an (N, S) array of values
+Chunk = Tuple[List[datetime], np.ndarray]
+
+LOG_INTERVAL = 60  # Seconds between logging the rate of each database writer
+RETRY_INTERVAL = 1  # Seconds before first retrying a failed write, doubling each time
+RETRY_LIMIT = 30  # Most seconds between retries
+PUT_INTERVAL = 0.01  # Seconds between attempts to put to a full queue from the loop
+
+
+def chunk_bytes(chunk: Chunk) -> int:
+    return chunk[1].nbytes + 8 * len(chunk[0])
+
+
+class TableInsert:
+    """
+    Core INSERT into a values table of only the columns that are currently recording,
+    compiled once and executed with executemany, bypassing the ORM entirely.
+    Where the DBAPI takes positional parameters, row tuples go straight to its
+    executemany with only the timestamps converted, rather than as a dict per row
+    through Connection.execute, which would build every row's parameters over again.
+    """
+
+    def __init__(self, table: Base, columns: List[str], dialect):
+        self.table = table
+        self.columns = ["timestamp"] + list(columns)
+        self.statement = table.__table__.insert().compile(
+            dialect=dialect, column_keys=self.columns
+        )
+        self.dialect = dialect
+        self.positional = dialect.positional and (
+            list(self.statement.positiontup) == self.columns
+        )
+        # Values are already floats or None, as every values column is a Float
+        timestamp = table.__table__.c.timestamp.type.dialect_impl(dialect)
+        self.process_timestamp = timestamp.bind_processor(dialect)
+
+    def rows(self, chunks: List[Chunk]) -> List[tuple]:
+        """Flatten chunks into row tuples, with every missing (NaN) value as None."""
+        if not chunks:
+            return []
+        timestamps = [timestamp for chunk in chunks for timestamp in chunk[0]]
+        values = np.concatenate([chunk[1] for chunk in chunks])
+        missing = np.isnan(values)
+        values = values.astype(object)
+        values[missing] = None
+        return [(t, *row) for t, row in zip(timestamps, values.tolist())]
+
+    def execute(self, connection: Connection, rows: List[tuple]):
+        if not rows:
+            return
+        if not self.positional:
+            connection.execute(
+                self.statement, [dict(zip(self.columns, row)) for row in rows]
+            )
+            return
+
+        if self.process_timestamp is not None:
+            process = self.process_timestamp
+            rows = [(process(row[0]),) + row[1:] for row in rows]
+        dbapi = self.dialect.dbapi
+        cursor = connection.connection.cursor()  # The underlying DBAPI connection
+        try:
+            cursor.executemany(self.statement.string, rows)
+        except dbapi.Error as e:
+            # As Connection.execute would raise it, so that failed writes are retried
+            raise DBAPIError.instance(
+                self.statement.string,
+                None,
+                e,
+                dbapi.Error,
+                connection_invalidated=self.dialect.is_disconnect(
+                    e, connection.connection, cursor
+                ),
+                dialect=self.dialect,
+            ) from e
+        finally:
+            cursor.close()
+
+
+class ExecutemanySink:
+    """Write rows with the TableInsert's executemany, for any database."""
+
+    name = "executemany"
+
+    def __init__(self, insert: TableInsert):
+        self.insert = insert
+
+    def write(self, connection: Connection, rows: List[tuple]):
+        self.insert.execute(connection, rows)
+
+
+class CopySink:
+    """
+    Stream rows into PostgreSQL with COPY FROM STDIN in CSV format, which is far faster
+    than even a batched INSERT. Missing values are written as unquoted empty fields,
+    which COPY reads as NULL.
+    """
+
+    name = "COPY"
+
+    def __init__(self, insert: TableInsert, dialect):
+        self.insert = insert
+        quote = dialect.identifier_preparer.quote
+        self.statement = "COPY %s (%s) FROM STDIN WITH (FORMAT csv)" % (
+            dialect.identifier_preparer.format_table(insert.table.__table__),
+            ", ".join(quote(column) for column in insert.columns),
+        )
+
+    def write(self, connection: Connection, rows: List[tuple]):
+        if not rows:
+            return
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        cursor = connection.connection.cursor()  # The underlying psycopg2 connection
+        try:
+            cursor.copy_expert(self.statement, buffer)
+        finally:
+            cursor.close()
+
+
+def make_sink(insert: TableInsert, dialect):
+    """Choose the fastest sink that the database supports."""
+    if dialect.name == "postgresql" and dialect.driver == "psycopg2":
+        return CopySink(insert, dialect)
+    return ExecutemanySink(insert)
+
+
+class OverflowPolicy(IntEnum):
+    BLOCK = 0  # Block the producer until the writer has caught up
+    DROP_OLDEST = 1  # Discard the oldest queued rows
+    DECIMATE = 2  # Discard every other queued row, halving the rate over the backlog
+
+    def __str__(self):
+        return self._name_.replace("_", " ")
+
+
+class BoundedQueue:
+    """
+    Thread-safe queue of chunks for a database writer, bounded by a number of rows.
+    When a put would take the queue over max_rows the overflow policy applies, so that a
+    slow database pushes back on the producer instead of growing the queue without limit.
+    """
+
+    durable = False  # Queued rows are lost if the program exits before writing them
+
+    def __init__(self, max_rows: int, policy: OverflowPolicy = OverflowPolicy.BLOCK):
+        self.max_rows = max_rows
+        self.policy = policy
+        self.chunks = deque()
+        self.rows = 0
+        self.high_water_mark = 0  # Most rows ever queued at once
+        self.dropped = 0  # Rows discarded by the overflow policy
+        self.error = None  # That the writer failed with, if it has
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return self.rows
+
+    def put(self, chunk: Chunk, timeout: float = None) -> bool:
+        """
+        Queue a chunk, returning whether it was queued. Under the BLOCK policy a full
+        queue is waited on for up to timeout seconds, or without limit if None, and the
+        chunk is left out if there is still no room. Raises RuntimeError once the writer
+        has failed, as nothing would ever take the rows.
+        """
+        rows = len(chunk[0])
+        with self.condition:
+            self._check()
+            if self.rows + rows > self.max_rows and not self._overflow(rows, timeout):
+                return False
+            self.chunks.append(chunk)
+            self.rows += rows
+            self.high_water_mark = max(self.high_water_mark, self.rows)
+            self.condition.notify_all()
+            return True
+
+    async def put_async(self, chunk: Chunk):
+        """
+        Queue a chunk from the event loop. A full queue is retried every PUT_INTERVAL
+        seconds rather than waited on, so backpressure holds up only the calling task and
+        never the loop, or any other client recording in it.
+        """
+        while not self.put(chunk, timeout=0):
+            await asyncio.sleep(PUT_INTERVAL)
+
+    def get(self, max_rows: int, timeout: float) -> List[Chunk]:
+        """
+        Take whole chunks totalling at most max_rows rows (but always at least one chunk),
+        waiting up to timeout seconds for the first to arrive.
+        """
+        with self.condition:
+            if not self.chunks:
+                self.condition.wait(timeout)
+
+            chunks = []
+            rows = 0
+            while self.chunks:
+                if chunks and rows + len(self.chunks[0][0]) > max_rows:
+                    break
+                chunk = self.chunks.popleft()
+                chunks.append(chunk)
+                rows += len(chunk[0])
+            self.rows -= rows
+            self.condition.notify_all()
+
+            return chunks
+
+    def commit(self):
+        """Chunks leave the queue as soon as they are taken, so there's nothing to do."""
+
+    def close(self):
+        pass
+
+    def fail(self, error: Exception):
+        """Record that the writer has failed with error, waking any blocked producer."""
+        with self.condition:
+            self.error = error
+            self.condition.notify_all()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError("The database writer has failed") from self.error
+
+    def _overflow(self, rows: int, timeout: float = None) -> bool:
+        """Make room for rows by the overflow policy, returning whether there is room."""
+        if self.policy == OverflowPolicy.BLOCK:
+            room = self.condition.wait_for(
+                lambda: self.error is not None
+                or not self.chunks
+                or self.rows + rows <= self.max_rows,
+                timeout,
+            )
+            self._check()
+            return room
+
+        elif self.policy == OverflowPolicy.DROP_OLDEST:
+            while self.chunks and self.rows + rows > self.max_rows:
+                dropped = len(self.chunks.popleft()[0])
+                self.rows -= dropped
+                self.dropped += dropped
+
+        elif self.policy == OverflowPolicy.DECIMATE and self.chunks:
+            timestamps = [t for chunk in self.chunks for t in chunk[0]][::2]
+            values = np.concatenate([chunk[1] for chunk in self.chunks])[::2]
+
+            # Halving may not make enough room for a large chunk, so the oldest go too
+            keep = min(len(timestamps), max(self.max_rows - rows, 0))
+            start = len(timestamps) - keep
+            self.dropped += self.rows - keep
+            self.chunks = deque([(timestamps[start:], values[start:])] if keep else [])
+            self.rows = keep
+
+        return True
+
+
+class BatchPolicy:
+    """
+    Decide when a database writer flushes: whichever comes first of max_rows rows,
+    the oldest row being max_age seconds old or max_bytes bytes.
+    Commits have a fixed overhead, so when the smoothed commit latency rises above
+    grow_latency the batch size doubles, up to row_limit, and when it falls below
+    shrink_latency it halves again, down to min_rows.
+    While more than max_rows rows are waiting, as when replaying a spool after the
+    database has been unavailable, batches of up to replay_rows rows are written instead.
+    """
+
+    def __init__(
+        self,
+        max_rows: int = 500,
+        max_age: float = 0.5,
+        max_bytes: int = 2 ** 24,
+        min_rows: int = 50,
+        row_limit: int = 50000,
+        grow_latency: float = 0.25,
+        shrink_latency: float = 0.05,
+        replay_rows: int = 10000,
+    ):
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.min_rows = min_rows
+        self.row_limit = row_limit
+        self.grow_latency = grow_latency
+        self.shrink_latency = shrink_latency
+        self.replay_rows = replay_rows
+        self.latency = None  # Exponentially weighted moving average of commit latency
+
+    def due(self, rows: int, size: int, age: float) -> bool:
+        return rows >= self.max_rows or size >= self.max_bytes or age >= self.max_age
+
+    def batch_rows(self, waiting: int) -> int:
+        """Most rows to take in one batch, given the rows waiting to be written."""
+        if waiting > self.max_rows:
+            return max(self.max_rows, self.replay_rows)
+        return self.max_rows
+
+    def update(self, latency: float):
+        """Adapt the batch size to the latency of the last commit."""
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * latency
+
+        if self.latency > self.grow_latency:
+            self.max_rows = min(2 * self.max_rows, self.row_limit)
+        elif self.latency < self.shrink_latency:
+            self.max_rows = max(self.max_rows // 2, self.min_rows)
+
+
+class DatabaseWriter:
+    """
+    Drain a BoundedQueue (or Spool) of chunks into one table from its own thread,
+    flushing batches through the fastest available sink as decided by a BatchPolicy.
+    If the database connection fails the batch is retried, backing off, until it's
+    written. Once stopped, a writer gives up retrying if its queue is durable, leaving
+    the rows to be replayed later, or otherwise after one last attempt.
+    Any other error ends the thread and fails the queue, so that the producer's next put
+    raises rather than waiting for a writer that has gone.
+    """
+
+    def __init__(
+        self, engine: Engine, insert: TableInsert, q: BoundedQueue, policy: BatchPolicy
+    ):
+        self.engine = engine
+        self.insert = insert
+        self.queue = q
+        self.policy = policy
+        self.sink = make_sink(insert, engine.dialect)
+        self.running = False
+        self.thread = threading.Thread(target=self.run)
+        self.connection = None
+        self.written_rows = 0
+        self.failed_writes = 0
+        self.error = None  # That the thread failed with, if it has
+        self.latencies = deque(maxlen=10000)  # Seconds taken by recent commits
+
+    @property
+    def name(self) -> str:
+        return self.insert.table.__tablename__
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop once everything queued has been written and wait for the thread to finish."""
+        self.running = False
+        self.thread.join()
+
+    def write(self, chunks: List[Chunk]):
+        start = time.monotonic()
+        if self.connection is None:
+            self.connection = self.engine.connect()
+        with self.connection.begin():
+            self.sink.write(self.connection, self.insert.rows(chunks))
+        latency = time.monotonic() - start
+
+        self.queue.commit()
+        self.latencies.append(latency)
+        self.policy.update(latency)
+        self.written_rows += sum(len(chunk[0]) for chunk in chunks)
+
+    def write_retrying(self, chunks: List[Chunk]) -> bool:
+        """Write chunks, retrying while the database is unavailable."""
+        interval = RETRY_INTERVAL
+        while True:
+            try:
+                self.write(chunks)
+                return True
+            except (OperationalError, DBAPIError) as e:
+                if not isinstance(e, OperationalError) and not e.connection_invalidated:
+                    raise
+                self.failed_writes += 1
+                if self.connection is not None:
+                    self.connection.invalidate()
+                    self.connection = None
+
+                if not self.running and (
+                    self.queue.durable or interval > RETRY_INTERVAL
+                ):
+                    logger.error(
+                        "Gave up writing %d rows to %s: %s",
+                        sum(len(chunk[0]) for chunk in chunks),
+                        self.name,
+                        e,
+                    )
+                    return False
+                logger.warning(
+                    "Failed writing to %s, retrying in %d s: %s", self.name, interval, e
+                )
+                time.sleep(interval)
+                interval = min(2 * interval, RETRY_LIMIT)
+
+    def run(self):
+        try:
+            self.drain()
+        except Exception as e:
+            # Such as an IntegrityError, which retrying won't fix
+            logger.exception("Writing %s failed", self.name)
+            self.error = e
+            self.queue.fail(e)
+        finally:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def drain(self):
+        """Write batches from the queue until stopped and everything queued is written."""
+        logger.info("Writing %s with %s", self.name, self.sink.name)
+
+        chunks = []
+        rows = size = 0
+        oldest = None  # When the oldest unwritten row was taken from the queue
+        start = last_log = time.monotonic()
+
+        while self.running or len(self.queue):
+            if oldest is None:
+                timeout = self.policy.max_age
+            else:
+                timeout = max(oldest + self.policy.max_age - time.monotonic(), 0)
+
+            limit = self.policy.batch_rows(rows + len(self.queue))
+            for chunk in self.queue.get(limit - rows, timeout):
+                chunks.append(chunk)
+                rows += len(chunk[0])
+                size += chunk_bytes(chunk)
+                if oldest is None:
+                    oldest = time.monotonic()
+
+            if chunks and self.policy.due(rows, size, time.monotonic() - oldest):
+                if not self.write_retrying(chunks):
+                    break
+                chunks = []
+                rows = size = 0
+                oldest = None
+
+            if time.monotonic() - last_log > LOG_INTERVAL:
+                last_log = time.monotonic()
+                logger.info(
+                    "Writing %s at %.0f rows/s in batches of up to %d rows",
+                    self.name,
+                    self.written_rows / (last_log - start),
+                    self.policy.max_rows,
+                )
+
+        else:  # Unless the writer gave up, write whatever is left
+            if chunks:
+                self.write_retrying(chunks)
+
+        logger.info(
+            "Wrote %d rows to %s with %s at %.0f rows/s, "
+            "with at most %d rows queued and %d rows dropped",
+            self.written_rows,
+            self.name,
+            self.sink.name,
+            self.written_rows / (time.monotonic() - start),
+            self.queue.high_water_mark,
+            self.queue.dropped,
+        )
@@ -1,17 +1,41 @@
 import asyncio
-import struct
+import os
+import pickle
+import time
+from datetime import datetime, timezone
 from itertools import count
+from typing import List
 import logging
 import sys
 
+import numpy as np
+
+from .. import db, ROOT_DIR
+from ..configuration import Configuration
+from ..spool import Spool, spool_directory
+from ..writers import (
+    TableInsert,
+    BoundedQueue,
+    OverflowPolicy,
+    BatchPolicy,
+    DatabaseWriter,
+)
 from .x30_protocol import (
     Request,
-    Response,
-    ACKNOWLEDGEMENT_LENGTH,
-    STATUS_HEADER_LENGTH,
     GET_DATA,
+    GET_SPECTRUM,
     SET_STREAMING_DATA,
-    DATA,
+    DataFrame,
+    STOP_DELIMITER,
+)
+from .x30_framer import Framer
+from .x30_spectrum import (
+    SpectrumFile,
+    spectrum_path,
+    spectrum_points,
+    SPECTRUM_CAPACITY,
+    SPECTRUM_DIR,
+    SPECTRUM_INTERVAL,
 )
 
 logger = logging.getLogger(__name__)
@@ -37,6 +61,7 @@ class x30Client:
         # I/O
         self.reader = None
         self.writer = None
+        self.framer = None
 
         # Status information
         self.fs_radix = None
@@ -56,12 +81,51 @@ class x30Client:
         self.full_spectrum_start_wvl = None
         self.full_spectrum_end_wvl = None
 
+        self.scan_rate = 1000  # Hz, of the sm130 model in use, which doesn't report it
+
         # Recording and streaming toggles
         self.recording = False
         self.streaming = False
+        self.live_status = True  # Write the status file for the web server
+
+        # Configuration setting
+        self.configuration = Configuration()
+
+        # Database writing queues, bounded to push back on streaming if writing falls behind
+        self.queues = {}
+        self.writers = []
+        self.queue_size = 100000  # rows
+        self.overflow_policy = OverflowPolicy.BLOCK
+        self.spool = False  # Spool rows to disk first, so none are lost if writes fail
+
+        # Responses are not timestamped by the sm130, so are stamped on arrival
+        self.received = 0
+        self.last_timestamp = None  # Of the last response, in integer microseconds
+
+        # Full spectra, captured periodically by a client of their own
+        self.spectra = None
+        self.capture_stopping = None
+
+    @property
+    def effective_sampling_rate(self):
+        return self.scan_rate
+
+    @property
+    def host_lag(self) -> float:
+        """Fraction of the host's queues in use, for whichever is furthest behind."""
+        return max(
+            (min(len(q) / self.queue_size, 1) for q in self.queues.values()),
+            default=0,
+        )
+
+    @property
+    def written_rows(self) -> int:
+        """Rows written to each table (or the least written to any one table)."""
+        return min((writer.written_rows for writer in self.writers), default=0)
 
     async def connect(self):
         self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.framer = Framer(self.reader)
         self.connected = True
         logger.info(f"{self.name} connected")
 
@@ -72,92 +136,217 @@ class x30Client:
         logger.info(f"{self.name} disconnected")
 
     async def read(self, override_length: int = None) -> bytes:
-        length = int(await self.reader.read(ACKNOWLEDGEMENT_LENGTH))
-        if override_length is not None:  # Override message length if provided
-            length = override_length
-        response = await self.reader.read(length)
-        return response
+        return await self.framer.read(override_length)
 
     async def execute(self, request: Request, override_length: int = None) -> bytes:
         self.writer.write(request.serialize())
         return await self.read(override_length)
 
     async def update_status(self):
-        response = await self.execute(GET_DATA())
-        status_header = response[:STATUS_HEADER_LENGTH]
-        self.fs_radix = status_header[0]
-        self.fw_version = status_header[2]
-        self.secondary_fan = bool((status_header[3] >> 3) & 1)
-        self.primary_fan = bool((status_header[3] >> 4) & 1)
-        self.calibration_fault = bool((status_header[3] >> 6) & 1)
-        self.switch_position = int(status_header[6] & 3)
-        self.mux_level = int((status_header[6] >> 1) & 3)
-        self.triggering_mode = int((status_header[6] >> 4) & 3)
-        self.operating_mode = int((status_header[6] >> 6) & 3)
-        self.num_peaks_detected = ", ".join(
-            [str(num) for num in struct.unpack("<HHHH", status_header[16:24])]
-        )
-        self.error = status_header[47]
-        self.buffer = status_header[48]
-        self.header_version = status_header[49]
-        self.granularity = struct.unpack("<L", status_header[72:76])[0]
-        self.full_spectrum_start_wvl = struct.unpack("<L", status_header[80:84])[0]
-        self.full_spectrum_end_wvl = struct.unpack("<L", status_header[84:88])[0]
-
-    async def stream(self):
+        frame = DataFrame(await self.execute(GET_DATA()))
+        header = frame.header
+        self.fs_radix = int(header["fs_radix"])
+        self.fw_version = int(header["fw_version"])
+        self.secondary_fan = frame.secondary_fan
+        self.primary_fan = frame.primary_fan
+        self.calibration_fault = frame.calibration_fault
+        self.switch_position = frame.switch_position
+        self.mux_level = frame.mux_level
+        self.triggering_mode = frame.triggering_mode
+        self.operating_mode = frame.operating_mode
+        self.num_peaks_detected = ", ".join(str(num) for num in frame.counts)
+        self.error = int(header["error"])
+        self.buffer = int(header["buffer"])
+        self.header_version = int(header["header_version"])
+        self.granularity = frame.granularity
+        self.full_spectrum_start_wvl = int(header["full_spectrum_start_wvl"])
+        self.full_spectrum_end_wvl = int(header["full_spectrum_end_wvl"])
+
+    async def stream(self, batch: bool = False):
+        """
+        Stream DATA responses, each decoded into a DataFrame, or with batch every
+        response received so far at a time, decoded into a DataBatch.
+        """
         self.streaming = (
             await self.execute(SET_STREAMING_DATA(val=True))
         ) == b"Streaming data enabled.\n"
         await self.execute(GET_DATA())
         logger.info(f"{self.name} started streaming")
 
-        while self.streaming:
-            response = await self.read()
-            while (
-                response[-8:] != b"XXXXXXXX"
-            ):  # Continue reading in until 8 Xs have been received
-                response += await self.reader.read(1)
-            yield DATA(response)
-
-        exit_response = await self.execute(SET_STREAMING_DATA(val=False))
-        # Stop streaming after 8 Zs have been received
-        while exit_response[-8:] != b"ZZZZZZZZ":
-            exit_response += await self.reader.read(1024)
+        try:
+            while self.streaming:
+                if batch:
+                    response = await self.framer.read_batch()
+                    self.received += len(response)
+                else:
+                    response = DataFrame(await self.framer.read_streamed())
+                    self.received += 1
+                yield response
+        finally:
+            # However the stream ends, even by the consumer raising or closing it early
+            self.streaming = False
+            await self._stop_streaming()
+
+    async def _stop_streaming(self):
+        """
+        Stop streaming, discarding everything up to the 8 Zs ending the response.
+        Failures of the connection are logged rather than raised, so that any error
+        already raised by the stream is not replaced.
+        """
+        try:
+            self.writer.write(SET_STREAMING_DATA(val=False).serialize())
+            unprocessed = await self.framer.discard_until(STOP_DELIMITER)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            logger.warning(f"{self.name} could not stop streaming: {e!r}")
+            return
         # logger.info the length of the exit response, which shows how much data we haven't processed since stopping streaming
         logger.info(
-            f"{self.name} finished streaming. {len(exit_response)} bytes in the streaming buffer were not processed."
+            f"{self.name} finished streaming. {unprocessed} bytes in the streaming buffer were not processed."
         )
 
-    # async def record(self):
-    #     db = create_engine(
-    #         "postgresql+psycopg2://postgres:@localhost/timescaletest", echo=False
-    #     )
-    #     Session = sessionmaker(db)
-    #     session = Session()
-
-    #     i = 0
-    #     async for response in self.stream():
-    #         channel_1_peaks_in_nm = [
-    #             peak / response.granularity for peak in response.channel_1_peaks
-    #         ]
-    #         channel_2_peaks_in_nm = [
-    #             peak / response.granularity for peak in response.channel_2_peaks
-    #         ]
-    #         channel_3_peaks_in_nm = [
-    #             peak / response.granularity for peak in response.channel_3_peaks
-    #         ]
-    #         channel_4_peaks_in_nm = [
-    #             peak / response.granularity for peak in response.channel_4_peaks
-    #         ]
-
-    #         # Now store data in database
-    #         # Create
-    #         entry = TestTable(sensor_1=channel_1_peaks_in_nm[0], sensor_2=0.0)
-    #         session.add(entry)
-    #         i += 1
-    #         if i > 2000:
-    #             session.flush()
-    #             i = 0
-
-    #     session.flush()
-    #     session.commit()
+    async def capture_spectra(
+        self,
+        interval: float = SPECTRUM_INTERVAL,
+        directory: str = SPECTRUM_DIR,
+        capacity: int = SPECTRUM_CAPACITY,
+    ):
+        """
+        Capture a full spectrum every interval seconds into a SpectrumFile in directory
+        until stop_capture, starting a new file whenever one fills.
+        The sm130 can't be asked for anything while it is streaming, so capture spectra
+        on a client of its own, connected alongside the one recording peaks.
+        """
+        self.capture_stopping = asyncio.Event()
+        os.makedirs(directory, exist_ok=True)
+        loop = asyncio.get_event_loop()
+        deadline = loop.time()
+        try:
+            while not self.capture_stopping.is_set():
+                response = await self.execute(GET_SPECTRUM())
+                received = time.time_ns()
+                if self.spectra is None or self.spectra.full:
+                    if self.spectra is not None:
+                        self.close_spectra()
+                    self.spectra = SpectrumFile(
+                        spectrum_path(directory, self.name, datetime.now(timezone.utc)),
+                        spectrum_points(len(response)),
+                        capacity,
+                    )
+                self.spectra.append(response, received)
+
+                # Keep to the interval however long each spectrum takes to arrive
+                deadline = max(deadline + interval, loop.time())
+                try:
+                    await asyncio.wait_for(
+                        self.capture_stopping.wait(), deadline - loop.time()
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if self.spectra is not None:
+                self.close_spectra()
+
+    def close_spectra(self):
+        logger.info(
+            "%s captured %d spectra to %s",
+            self.name,
+            len(self.spectra),
+            self.spectra.path,
+        )
+        self.spectra.close()
+        self.spectra = None
+
+    def stop_capture(self):
+        if self.capture_stopping is not None:
+            self.capture_stopping.set()
+
+    def timestamps(self, number: int) -> List[datetime]:
+        """
+        Timestamps for number responses received since the last ones, spread evenly from
+        just after the last timestamp up to now and at least a microsecond apart, as the
+        timestamp is the primary key of every values table.
+        """
+        now = time.time_ns() // 1000
+        last = self.last_timestamp if self.last_timestamp is not None else now - number
+        steps = np.arange(number)
+        stamps = last + (now - last) * (steps + 1) // number
+        stamps = np.maximum.accumulate(np.maximum(stamps - steps, last + 1)) + steps
+        self.last_timestamp = int(stamps[-1])
+        return [
+            dt.replace(tzinfo=timezone.utc)
+            for dt in stamps.astype("datetime64[us]").tolist()
+        ]
+
+    def set_live_status(self, live: bool):
+        if not self.live_status:
+            return
+        status = {
+            "live": live,
+            "packages": self.configuration.packages,
+            "sampling_rate": self.effective_sampling_rate,
+        }
+        with open(os.path.join(ROOT_DIR, "var/status.pickle"), "wb") as f:
+            pickle.dump(status, f)
+
+    async def record(self, batch: bool = True):
+        """
+        Record the peaks of every channel to the values tables of the current setup, each
+        through its own queue and DatabaseWriter thread, as x55Client.record does.
+        Channel n of the sm130 is channel n - 1 in the sensor metadata, so an sm130 can
+        stand in for the first four channels of an si255.
+        """
+        self.set_live_status(True)
+        self.configuration.unmatched_peaks.clear()
+
+        self.recording = True
+        self.queues = {
+            table: Spool(spool_directory(table), sensors.uids)
+            if self.spool
+            else BoundedQueue(self.queue_size, self.overflow_policy)
+            for table, sensors in self.configuration.sensors.items()
+        }
+        self.writers = [
+            DatabaseWriter(
+                db,
+                TableInsert(table, sensors.uids, db.dialect),
+                self.queues[table],
+                BatchPolicy(),
+            )
+            for table, sensors in self.configuration.sensors.items()
+        ]
+        for writer in self.writers:
+            writer.start()
+
+        logger.info("Started writer threads")
+
+        stream = self.stream(batch)
+        try:
+            async for response in stream:
+                if batch:
+                    peaks = response.peaks
+                else:
+                    peaks = response.padded[None]
+                timestamps = self.timestamps(len(peaks))
+
+                for table in self.queues:
+                    values = self.configuration.map(peaks, table)
+
+                    # Send the rows as column arrays to the database writer thread
+                    await self.queues[table].put_async((timestamps, values))
+        finally:
+            await stream.aclose()  # Stop streaming now, even on failure
+
+            # Toggle recording off and then wait for thread to finish, even on failure
+            self.recording = False
+            logger.info("Waiting for writer threads to join")
+            for writer in self.writers:
+                writer.stop()
+                writer.queue.close()
+            logger.info("Writer threads joined")
+
+        for table, unmatched_peaks in self.configuration.unmatched_peaks.items():
+            logger.info(
+                "%d unmatched peaks in %s", unmatched_peaks, table.__tablename__
+            )
+
+        self.set_live_status(False)
@@ -0,0 +1,70 @@
+import asyncio
+
+from .x30_protocol import ACKNOWLEDGEMENT_LENGTH, DELIMITER, DataBatch
+
+READ_SIZE = 2 ** 20  # Upper limit on the bytes taken from the reader in one batch
+
+
+class Framer:
+    """
+    Frame sm130 responses from a StreamReader: a 10 digit ASCII length, then that many
+    bytes, which while streaming are followed by DELIMITER if they don't already end in
+    it. Prefixes and responses are taken whole with readexactly and delimiters are found
+    with readuntil, all from the StreamReader's own buffer, so nothing is read a byte at
+    a time or built up by concatenation.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader):
+        self.reader = reader
+        self.buffer = bytearray()  # Partial responses left over from read_batch
+
+    async def read_length(self) -> int:
+        prefix = await self.reader.readexactly(ACKNOWLEDGEMENT_LENGTH)
+        try:
+            return int(prefix)
+        except ValueError:
+            raise ValueError("Invalid length prefix %r" % prefix)
+
+    async def read(self, override_length: int = None) -> bytes:
+        """Read a response, or override_length bytes after its length if given."""
+        length = await self.read_length()
+        if override_length is not None:
+            length = override_length
+        return await self.reader.readexactly(length)
+
+    async def read_streamed(self) -> bytes:
+        """Read a streamed response, up to and including its DELIMITER."""
+        response = await self.read()
+        if response.endswith(DELIMITER):
+            return response
+        return response + await self.reader.readuntil(DELIMITER)
+
+    async def read_batch(self) -> DataBatch:
+        """
+        Decode every complete streamed response already received, waiting for at least
+        one. Not to be mixed with read_streamed, as any partial response is held in
+        self.buffer rather than left in the reader.
+        """
+        while True:
+            batch, consumed = DataBatch.decode(self.buffer)
+            if consumed:
+                del self.buffer[:consumed]
+                return batch
+
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                raise asyncio.IncompleteReadError(bytes(self.buffer), None)
+            self.buffer += data
+
+    async def discard_until(self, delimiter: bytes) -> int:
+        """Discard everything up to and including delimiter, returning its length."""
+        discarded = len(self.buffer)
+        self.buffer.clear()
+        while True:
+            try:
+                return discarded + len(await self.reader.readuntil(delimiter))
+            except asyncio.LimitOverrunError as e:
+                # Too much before the delimiter to hold at once, so drop what has been
+                # searched, apart from what may be the start of the delimiter
+                await self.reader.readexactly(e.consumed)
+                discarded += e.consumed
@@ -1,15 +1,60 @@
 from ipaddress import IPv4Address
 from enum import Enum, IntEnum
 from datetime import datetime
-from typing import Union, List
+from typing import Union, List, Tuple
 from itertools import accumulate
 from struct import unpack
 
-from pydantic import BaseModel
+import numpy as np
+
+from ..codec import (
+    Message,
+    ascii_serializer,
+    bool_serializer,
+    datetime_serializer,
+    serializers,
+)
 
 
 ACKNOWLEDGEMENT_LENGTH = 10  # bytes
 STATUS_HEADER_LENGTH = 88  # bytes
+NUM_CHANNELS = 4
+DELIMITER = b"XXXXXXXX"  # Ends every streamed response
+STOP_DELIMITER = b"ZZZZZZZZ"  # Ends the response to disabling streaming
+
+# Layout of the fields of the status header at the start of every DATA response
+STATUS_HEADER = np.dtype(
+    {
+        "names": [
+            "fs_radix",
+            "fw_version",
+            "status",  # Fan and calibration fault bits
+            "modes",  # Switch position, mux level, triggering and operating mode bits
+            "num_peaks",
+            "error",
+            "buffer",
+            "header_version",
+            "granularity",
+            "full_spectrum_start_wvl",
+            "full_spectrum_end_wvl",
+        ],
+        "formats": [
+            "u1",
+            "u1",
+            "u1",
+            "u1",
+            ("<u2", (NUM_CHANNELS,)),
+            "u1",
+            "u1",
+            "u1",
+            "<u4",
+            "<u4",
+            "<u4",
+        ],
+        "offsets": [0, 2, 3, 6, 16, 47, 48, 49, 72, 80, 84],
+        "itemsize": STATUS_HEADER_LENGTH,
+    }
+)
 
 
 class Channel(IntEnum):
@@ -66,29 +111,40 @@ class TrigMode(IntEnum):
 
 
 # Requests
-class Request(BaseModel):
+class Request(Message):
+    """
+    A request, serialized as its command attribute, or else the class name, as the
+    command, with the value of x appended if it has one, then the space-separated
+    arguments and a newline.
+    The serializer of every argument is chosen once per request type, and the whole
+    request is serialized once per request type without arguments, when the class is
+    defined.
+    """
+
     _serializers = {
-        datetime: lambda x: x.strftime(f"%m.%d.%H.%M.%y").encode("ascii"),
-        bool: lambda x: str(int(x)).encode("ascii"),
+        datetime: datetime_serializer("%m.%d.%H.%M.%y"),
+        bool: bool_serializer,
     }
-    _default_serializer = lambda x: str(x).encode("ascii")
-
-    def serialize(self):
-        try:  # Command included as field
-            command = (getattr(self, "command")).encode("ascii")
-        except AttributeError:  # Take class name as command, with value x appended if specified
-            command = b"#%b%b" % (
-                (self.__class__.__name__).encode("ascii"),
-                str(getattr(self, "x", "")).encode("ascii"),
-            )
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        command = getattr(cls, "command", "#" + cls.__name__)
+        cls._command = command.encode("ascii")
+        cls._arguments = serializers(cls, Request._serializers)
+        cls._serialized = None
+        if not cls._arguments:
+            cls._serialized = cls._command + b"\n"
+
+    def serialize(self) -> bytes:
+        if self._serialized is not None:
+            return self._serialized
+        command = self._command
+        if "x" in self._fields:
+            command += ascii_serializer(self.x)
         arguments = [
-            self._serializers.get(self.__fields__[k].type_, self._default_serializer)(v)
-            for k, v in self.dict().items()
-            if k != "command"
+            serialize(getattr(self, field)) for field, serialize in self._arguments
         ]
-
-        return (b" ".join((command, *arguments))) + b"\n"
+        return b" ".join((command, *arguments)) + b"\n"
 
 
 class GET_DATA(Request):
@@ -425,13 +481,19 @@ class GET_SENSOR_LOCATION(Request):
 
 
 # Responses
-class Response(BaseModel):
+class Response(Message):
+    """A response, with its fields parsed into plain values by the parse of its type."""
+
     def __init__(self, response: bytes):
         try:
-            super().__init__(**self.parse(response))
-        except:
+            for field, value in self.parse(response).items():
+                setattr(self, field, value)
+        except Exception:
             raise ValueError("Could not parse response")
 
+    def parse(self, response: bytes) -> dict:
+        return {}
+
 
 class DATA(Response):
     granularity: int
@@ -458,8 +520,169 @@ class DATA(Response):
 
         return {
             "granularity": granularity,
-            "channel_1_peaks": channel_1_peaks,
-            "channel_2_peaks": channel_2_peaks,
-            "channel_3_peaks": channel_3_peaks,
-            "channel_4_peaks": channel_4_peaks,
+            "channel_1_peaks": list(channel_1_peaks),
+            "channel_2_peaks": list(channel_2_peaks),
+            "channel_3_peaks": list(channel_3_peaks),
+            "channel_4_peaks": list(channel_4_peaks),
         }
+
+
+class DataFrame:
+    """
+    Lightweight, read-only view of a DATA response, the NumPy counterpart of DATA.
+    The status header is a NumPy record straight from the response bytes, and the peaks
+    of every channel are converted to wavelengths in nm in a single array operation,
+    so decoding costs a handful of array constructions regardless of the number of peaks.
+    """
+
+    __slots__ = ("header", "counts", "offsets", "peaks")
+
+    def __init__(self, response: bytes):
+        try:
+            header = np.frombuffer(response, STATUS_HEADER, count=1)[0]
+            counts = header["num_peaks"]
+            offsets = np.zeros(NUM_CHANNELS + 1, dtype=np.intp)
+            np.cumsum(counts, out=offsets[1:])
+            peaks = np.frombuffer(
+                response, "<u4", count=offsets[-1], offset=STATUS_HEADER_LENGTH
+            )
+        except ValueError:
+            raise ValueError("Could not parse response")
+
+        self.header = header
+        self.counts = counts  # Number of peaks in each channel
+        self.offsets = offsets  # Start of each channel in peaks, plus the end
+        self.peaks = peaks / header["granularity"]  # All peaks in nm, in channel order
+
+    @property
+    def granularity(self) -> int:
+        return int(self.header["granularity"])
+
+    @property
+    def secondary_fan(self) -> bool:
+        return bool((self.header["status"] >> 3) & 1)
+
+    @property
+    def primary_fan(self) -> bool:
+        return bool((self.header["status"] >> 4) & 1)
+
+    @property
+    def calibration_fault(self) -> bool:
+        return bool((self.header["status"] >> 6) & 1)
+
+    @property
+    def switch_position(self) -> int:
+        return int(self.header["modes"] & 3)
+
+    @property
+    def mux_level(self) -> int:
+        return int((self.header["modes"] >> 1) & 3)
+
+    @property
+    def triggering_mode(self) -> int:
+        return int((self.header["modes"] >> 4) & 3)
+
+    @property
+    def operating_mode(self) -> int:
+        return int((self.header["modes"] >> 6) & 3)
+
+    def channel(self, channel: Channel) -> np.ndarray:
+        """Return the peaks of a single channel, numbered from 1, as a view by offset."""
+        return self.peaks[self.offsets[channel - 1] : self.offsets[channel]]
+
+    @property
+    def content(self) -> List[np.ndarray]:
+        """Per-channel views, in the same order as the channel_n_peaks of DATA."""
+        return [self.channel(channel) for channel in Channel]
+
+    @property
+    def padded(self) -> np.ndarray:
+        """Copy the peaks into a (4, max_peaks) array, padded with NaN as in DataBatch."""
+        present = np.arange(self.counts.max()) < self.counts[:, None]
+        padded = np.full(present.shape, np.nan)
+        padded[present] = self.peaks
+        return padded
+
+
+def split_responses(buffer) -> Tuple[List[int], int]:
+    """
+    Find the complete responses in a buffer of back-to-back length-prefixed responses,
+    each followed by DELIMITER if it doesn't already end in it.
+    Returns the offset of the data of each one and the end of the last one.
+    """
+    view = memoryview(buffer)
+    end = len(view)
+    position = 0
+    starts = []
+    while position + ACKNOWLEDGEMENT_LENGTH <= end:
+        length = int(bytes(view[position : position + ACKNOWLEDGEMENT_LENGTH]))
+        start = position + ACKNOWLEDGEMENT_LENGTH
+        response_end = start + length
+        if view[response_end - len(DELIMITER) : response_end] != DELIMITER:
+            response_end += len(DELIMITER)
+        if response_end > end:
+            break
+        starts.append(start)
+        position = response_end
+
+    return starts, position
+
+
+class DataBatch:
+    """
+    Many DATA responses decoded in a single pass into NumPy arrays.
+    headers is a vector of status header records, counts is an (N, 4) array of the
+    number of peaks in each channel and peaks is an (N, 4, max_peaks) float64 array of
+    wavelengths in nm, padded with NaN where a channel has fewer than max_peaks peaks.
+    """
+
+    __slots__ = ("headers", "counts", "peaks")
+
+    def __init__(self, headers: np.ndarray, counts: np.ndarray, peaks: np.ndarray):
+        self.headers = headers
+        self.counts = counts
+        self.peaks = peaks
+
+    def __len__(self):
+        return len(self.headers)
+
+    @classmethod
+    def decode(cls, buffer) -> Tuple["DataBatch", int]:
+        """
+        Decode every complete response in a buffer of back-to-back streamed responses.
+        Returns the batch and the number of bytes consumed, so that any trailing
+        partial response can be kept until the rest of it arrives.
+        """
+        starts, end = split_responses(buffer)
+        return cls.from_offsets(buffer, starts), end
+
+    @classmethod
+    def from_offsets(cls, buffer, starts: List[int]) -> "DataBatch":
+        """Gather the status headers and peaks of the responses at the given offsets."""
+        raw = np.frombuffer(buffer, np.uint8)
+        starts = np.asarray(starts, dtype=np.intp)
+
+        headers = raw[starts[:, None] + np.arange(STATUS_HEADER_LENGTH)]
+        headers = headers.view(STATUS_HEADER).reshape(len(starts))
+        counts = headers["num_peaks"].astype(np.intp)
+
+        # Position of every peak as if each channel were padded out to max_peaks
+        max_peaks = int(counts.max()) if counts.size else 0
+        cumulative_counts = np.cumsum(counts, axis=1) - counts
+        k = np.arange(max_peaks)
+        present = k < counts[:, :, None]
+        positions = (
+            starts[:, None, None]
+            + STATUS_HEADER_LENGTH
+            + 4 * (cumulative_counts[:, :, None] + k)
+        )
+
+        raw_peaks = raw[positions[present][:, None] + np.arange(4)].view("<u4").ravel()
+        granularity = np.broadcast_to(
+            headers["granularity"][:, None, None], present.shape
+        )
+
+        peaks = np.full(present.shape, np.nan)
+        peaks[present] = raw_peaks / granularity[present]
+
+        return cls(headers, counts, peaks)
@@ -0,0 +1,156 @@
+import mmap
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from struct import calcsize, pack_into, unpack_from
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .. import ROOT_DIR
+from .x30_protocol import NUM_CHANNELS, STATUS_HEADER, STATUS_HEADER_LENGTH
+
+SPECTRUM_DIR = os.path.join(ROOT_DIR, "var/spectra")
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+SPECTRUM_CAPACITY = 24 * 60  # Spectra in a file, a day of them once a minute
+SPECTRUM_INTERVAL = 60  # Seconds between capturing spectra
+FILE_HEADER = "<8sII"  # Magic, points per channel and capacity
+FILE_HEADER_LENGTH = calcsize(FILE_HEADER)
+MAGIC = b"SM130SPC"
+
+
+def spectrum_dtype(points: int) -> np.dtype:
+    """A GET_SPECTRUM response: the status header, then points levels per channel."""
+    return np.dtype(
+        [("header", STATUS_HEADER), ("levels", "<u2", (NUM_CHANNELS, points))]
+    )
+
+
+def spectrum_points(response_length: int) -> int:
+    """Points per channel in a GET_SPECTRUM response of response_length bytes."""
+    points, remainder = divmod(response_length - STATUS_HEADER_LENGTH, 2 * NUM_CHANNELS)
+    if points <= 0 or remainder:
+        raise ValueError(f"Not a spectrum of 4 channels: {response_length} bytes")
+    return points
+
+
+class SpectrumFile:
+    """
+    A preallocated, memory-mapped file of up to capacity full spectra, each stored as
+    its GET_SPECTRUM response at a fixed stride, with an index of the time every
+    spectrum was received in nanoseconds since the epoch.
+    The file is a header of its points per channel and capacity, then the index, then
+    the spectra. An unwritten index entry is zero, and each one is written after its
+    spectrum, so the spectra written are those before the first zero entry, even if the
+    writer stopped part way through one. Appending is a copy into the map, so capturing
+    spectra alongside streaming peaks costs little more than receiving them.
+    """
+
+    def __init__(
+        self, path: str, points: int = None, capacity: int = SPECTRUM_CAPACITY
+    ):
+        """Open the file at path, or create it for spectra of points per channel."""
+        self.path = path
+        if points is not None and not os.path.exists(path):
+            self.dtype = spectrum_dtype(points)
+            size = FILE_HEADER_LENGTH + capacity * (8 + self.dtype.itemsize)
+            with open(path, "w+b") as f:
+                f.truncate(size)
+                self.map = mmap.mmap(f.fileno(), 0)
+            pack_into(FILE_HEADER, self.map, 0, MAGIC, points, capacity)
+        else:
+            with open(path, "r+b") as f:
+                self.map = mmap.mmap(f.fileno(), 0)
+
+        magic, self.points, self.capacity = unpack_from(FILE_HEADER, self.map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a spectrum file")
+        if points is not None and points != self.points:
+            raise ValueError(
+                f"{path} holds spectra of {self.points} points, not {points}"
+            )
+        self.dtype = spectrum_dtype(self.points)
+
+        self.index = np.frombuffer(self.map, "<i8", self.capacity, FILE_HEADER_LENGTH)
+        self.spectra = np.frombuffer(
+            self.map, self.dtype, self.capacity, FILE_HEADER_LENGTH + 8 * self.capacity
+        )
+        self.count = self.written()
+
+    def written(self) -> int:
+        """Spectra written, found from the index so that a live file can be followed."""
+        unwritten = np.flatnonzero(self.index == 0)
+        return int(unwritten[0]) if len(unwritten) else self.capacity
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def full(self) -> bool:
+        return self.count == self.capacity
+
+    def append(self, response: bytes, received: Optional[int] = None):
+        """Append a GET_SPECTRUM response, received at the given time in nanoseconds."""
+        if self.full:
+            raise IndexError(f"{self.path} is full")
+        if len(response) != self.dtype.itemsize:
+            raise ValueError(
+                f"Spectrum of {len(response)} bytes, not {self.dtype.itemsize}"
+            )
+        offset = (
+            FILE_HEADER_LENGTH + 8 * self.capacity + self.count * self.dtype.itemsize
+        )
+        self.map[offset : offset + len(response)] = response
+        self.index[self.count] = time.time_ns() if received is None else received
+        self.count += 1
+
+    def read(
+        self, start: datetime = None, end: datetime = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return views of the receipt times, as datetime64[ns], and the spectra received
+        from start up to but not including end, or all of them.
+        """
+        self.count = self.written()
+        index = self.index[: self.count]
+        first = 0 if start is None else np.searchsorted(index, to_nanoseconds(start))
+        last = (
+            self.count if end is None else np.searchsorted(index, to_nanoseconds(end))
+        )
+        return index[first:last].view("datetime64[ns]"), self.spectra[first:last]
+
+    def wavelengths(self, spectrum: np.ndarray) -> np.ndarray:
+        """The wavelength in nm of each point of a spectrum, from its status header."""
+        header = spectrum["header"]
+        return (
+            np.linspace(
+                header["full_spectrum_start_wvl"],
+                header["full_spectrum_end_wvl"],
+                self.points,
+            )
+            / header["granularity"]
+        )
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.index = self.spectra = None
+        self.map.flush()
+        try:
+            self.map.close()
+        except BufferError:
+            pass  # Views of it are still in use, so it closes once they are gone
+
+
+def to_nanoseconds(timestamp: datetime) -> int:
+    """Nanoseconds since the epoch, taking naive datetimes to be in UTC."""
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return (timestamp - EPOCH) // timedelta(microseconds=1) * 1000
+
+
+def spectrum_path(directory: str, name, started: datetime) -> str:
+    return os.path.join(
+        directory, f"sm130-{name}-{started.strftime('%Y%m%dT%H%M%S%f')}.spectra"
+    )
@@ -0,0 +1,166 @@
+import asyncio
+import mmap
+import time
+from struct import unpack_from
+from typing import Iterator, Tuple
+
+import numpy as np
+
+from .. import logger
+from .x55_protocol import HEADER_LENGTH, PeakBatch, split_frames
+
+CAPTURE_BUFFER_SIZE = 2 ** 20  # bytes
+REPLAY_YIELD_BLOCKS = 100  # Blocks replayed as fast as possible between yielding
+
+# One entry per block of whole responses taken from the peak streaming port
+CAPTURE_INDEX = np.dtype(
+    [
+        ("offset", "<u8"),  # Of the block in the capture file
+        ("length", "<u4"),
+        ("received", "<i8"),  # Nanoseconds since the epoch when it was handed out
+    ]
+)
+
+
+def index_path(path: str) -> str:
+    return path + ".index"
+
+
+class CaptureWriter:
+    """
+    Append the raw framed responses from the peak streaming port to a capture file,
+    exactly as they were received, and the offset, length and time received of every
+    block of them to an index file alongside it.
+    Writes are buffered, so capturing costs little more than copying the bytes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.data = open(path, "ab", buffering=CAPTURE_BUFFER_SIZE)
+        self.index = open(index_path(path), "ab", buffering=CAPTURE_BUFFER_SIZE)
+        self.offset = self.data.tell()
+        self.entry = np.zeros(1, CAPTURE_INDEX)
+        self.blocks = 0
+
+    def write(self, block):
+        self.data.write(block)
+        self.entry["offset"] = self.offset
+        self.entry["length"] = len(block)
+        self.entry["received"] = time.time_ns()
+        self.index.write(self.entry.tobytes())
+        self.offset += len(block)
+        self.blocks += 1
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+        logger.info(
+            "Captured %d bytes in %d blocks to %s", self.offset, self.blocks, self.path
+        )
+
+
+class CaptureReader:
+    """A capture file, memory-mapped, and its index."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index = np.fromfile(index_path(path), CAPTURE_INDEX)
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+
+    def __len__(self):
+        return len(self.index)
+
+    def blocks(self) -> Iterator[Tuple[int, memoryview]]:
+        """Yield the time each block was received and a view of it."""
+        for offset, length, received in self.index.tolist():
+            yield received, self.view[offset : offset + length]
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            pass  # Views of it are still in use, so it closes once they are gone
+
+
+class ReplayConnection:
+    """
+    Stand in for a StreamingConnection to the peak streaming port, handing out the
+    responses in a capture file, either as fast as possible or with the cadence at which
+    they were originally received. Once the capture is exhausted every read raises
+    IncompleteReadError, just as if the instrument had closed the connection.
+    """
+
+    def __init__(self, name: str, path: str, realtime: bool = False):
+        self.name = name
+        self.path = path
+        self.realtime = realtime
+        self.reader = None
+        self.blocks = None
+        self.block = memoryview(b"")  # What is left of the current block
+        self.replayed = 0
+        self.received = 0  # Responses handed out
+        self.start = None  # When replaying started, and the first block was received
+
+    async def connect(self):
+        self.reader = CaptureReader(self.path)
+        self.blocks = self.reader.blocks()
+        logger.info(
+            "%s replaying %d blocks from %s", self.name, len(self.reader), self.path
+        )
+
+    async def disconnect(self):
+        self.block = memoryview(b"")
+        self.blocks = None
+        self.reader.close()
+        logger.info(
+            "%s replayed %d blocks from %s", self.name, self.replayed, self.path
+        )
+
+    async def next_block(self) -> memoryview:
+        """Wait for the next block of responses, as the original stream did if realtime."""
+        try:
+            received, block = next(self.blocks)
+        except StopIteration:
+            raise asyncio.IncompleteReadError(b"", None)
+
+        if self.start is None:
+            self.start = time.monotonic(), received
+        if self.realtime:
+            due = self.start[0] + (received - self.start[1]) / 10 ** 9
+            await asyncio.sleep(max(due - time.monotonic(), 0))
+        elif self.replayed % REPLAY_YIELD_BLOCKS == 0:
+            await asyncio.sleep(0)  # Let other tasks run
+
+        self.replayed += 1
+        return block
+
+    async def read(self) -> Tuple[bool, memoryview, memoryview]:
+        if not self.block:
+            self.block = await self.next_block()
+
+        status, message_size, content_size = unpack_from("<?xHI", self.block)
+        content_start = HEADER_LENGTH + message_size
+        content_end = content_start + content_size
+        message = self.block[HEADER_LENGTH:content_start]
+        content = self.block[content_start:content_end]
+        self.block = self.block[content_end:]
+        self.received += 1
+
+        return not status, message, content
+
+    async def read_batch(self) -> PeakBatch:
+        return PeakBatch.decode(await self.read_frames())[0]
+
+    async def read_frames(self) -> memoryview:
+        frames = self.block if self.block else await self.next_block()
+        self.block = memoryview(b"")
+        self.received += len(split_frames(frames)[0])
+        return frames
+
+    async def flush(self, timeout: float = 0.1) -> int:
+        discarded = len(self.block)
+        self.block = memoryview(b"")
+        return discarded
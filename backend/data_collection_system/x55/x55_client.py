@@ -1,20 +1,26 @@
 import asyncio
-import re
-import xml.etree.ElementTree as ET
-import string
 import pickle
 import os
-import threading
-import queue
+import socket
+import time
+from collections import deque
 from itertools import count
 from struct import unpack
-from enum import IntEnum
-from typing import List
-from ipaddress import IPv4Address
+from typing import List, Tuple
+from ipaddress import IPv4Address, ip_address
 from datetime import datetime
-from collections import defaultdict
 
-from .. import logger, Session, Base, Packages, ROOT_DIR
+from .. import logger, db, ROOT_DIR
+from ..configuration import SetupOptions, Configuration
+from ..pipeline import Pipeline
+from ..spool import Spool, spool_directory
+from ..writers import (
+    TableInsert,
+    BoundedQueue,
+    OverflowPolicy,
+    BatchPolicy,
+    DatabaseWriter,
+)
 from .x55_protocol import (
     Request,
     GetFirmwareVersion,
@@ -41,7 +47,8 @@ from .x55_protocol import (
     InstrumentName,
     Ready,
     DutChannelCount,
-    Peaks,
+    PeakFrame,
+    PeakBatch,
     PeakDataStreamingStatus,
     PeakDataStreamingDivider,
     PeakDataStreamingAvailableBuffer,
@@ -50,180 +57,74 @@ from .x55_protocol import (
     InstrumentUtcDateTime,
     NtpEnabled,
     NtpServer,
+    HEADER_LENGTH,
+    split_frames,
 )
+from .x55_framer import FrameProtocol
+from .x55_capture import CaptureWriter, ReplayConnection
+from .x55_monitor import StreamMonitor, MONITOR_INTERVAL
 
 HOST = "10.0.0.55"
 COMMAND_PORT = 51971
 PEAK_STREAMING_PORT = 51972
-HEADER_LENGTH = 8
-
-
-class SetupOptions(IntEnum):
-    BASEMENT_AND_FRAME = 0
-    STRONG_FLOOR = 1
-    BASEMENT = 2
-    FRAME = 3
-
-    def __str__(self):
-        return self._name_.replace("_", " ")
-
-
-class Configuration:
-    def __init__(self):
-        self.mapping = None  # For every table, for every channel, map an index to an ID
-        self.setup = None  # Store the current sensor setup
-        self.load(SetupOptions.BASEMENT_AND_FRAME)
-
-    @property
-    def packages(self):
-        """
-        Return the packages associated with the current sensor setup.
-        """
-        if self.setup == SetupOptions.BASEMENT_AND_FRAME:
-            return (
-                Packages.basement,
-                Packages.steel_frame,
-            )
-        if self.setup == SetupOptions.STRONG_FLOOR:
-            return (Packages.strong_floor,)
-        if self.setup == SetupOptions.BASEMENT:
-            return (Packages.basement,)
-        if self.setup == SetupOptions.FRAME:
-            return (Packages.steel_frame,)
-
-    def map(self, peaks: List[List[float]], table: Base):
-        """
-        Map the optical instrument output peaks array of arrays to UID: value pairs for the given database table.
-        To turn off the recording of individual sensors change its measurement_type to "off".
-        If a sensor can no longer be read at all by the optical instrument, remove its row from the metadata table entirely.
-        """
-        mapped_peaks = {}
-        for uid, metadata in self.mapping[table].items():
-            channel = metadata.channel
-            index = metadata.index
-            recording = metadata.recording
-            minimum_wavelength = metadata.minimum_wavelength
-            maximum_wavelength = metadata.maximum_wavelength
-
-            # Skip disabled sensors
-            if not recording:
-                continue
-
-            # Search peaks[channel] array for a matching sensor
-            # Readings may accidentally be dropped, but extra readings cannot be added, therefore
-            # the sensor's actual index can only be equal to or lower than the expected index
-            for measurement in peaks[channel][index::-1]:  # Start at the expected index
-                if minimum_wavelength < measurement < maximum_wavelength:
-                    mapped_peaks[uid] = measurement
-                    break
-                # Otherwise the sensor has been dropped or is out-of-band, so ignore
-
-        return mapped_peaks
-
-    def load(self, setup: SetupOptions):
-        """
-        Load a new configuration from database metadata tables.
-        """
-        self.setup = setup
-        self.mapping = {}  # {Basement: {"A1": row, ...}, ... }
-
-        # Load in metadata from tables to mapping
-        session = Session()
-        for package in self.packages:
-            self.mapping[package.values_table] = {
-                row.uid: row for row in session.query(package.metadata_table).all()
-            }
-        session.close()
-
-        logger.info("Loaded configuration from database")
-
-        return self.setup
-
-    def parse(self, config_file):
-        """
-        Parse and save a configuration to the database metadata tables.
-        Any sensor UIDs or names referenced in the file that exist will be updated,
-        but additional UIDs or names in the file will be ignored. It is therefore
-        safe to update just Basement metadata table from a combined config file, whilst
-        it is also safe to update both the Basement and Steel Frame metadata tables simultaneously.
-        """
-        session = Session()
-
-        root = ET.parse(config_file).getroot()
-
-        for package in self.packages:
-            # Data associated with a UID
-            for sensor in root.iter("SensorConfiguration"):
-                uid = re.search("[^_]{1,3}$", sensor.find("Name").text)[0]
-                reference_wavelength = sensor.find("Reference").text
-                minimum_wavelength = sensor.find("WavelengthMinimum").text
-                maximum_wavelength = sensor.find("WavelengthMaximum").text
-
-                channel = string.ascii_uppercase.index(uid[0])
-                index = int(uid[1:]) - 1
-
-                data = {
-                    "channel": channel,
-                    "index": index,
-                    "reference_wavelength": reference_wavelength,
-                    "minimum_wavelength": minimum_wavelength,
-                    "maximum_wavelength": maximum_wavelength,
-                }
-                if data:
-                    session.query(package.metadata_table).filter(
-                        package.metadata_table.uid == uid
-                    ).update(data)
-
-            # Data associated with a sensor name
-            for transducer in root.iter("Transducer"):
-                name = transducer.find("ID").text
-                coeffs = {}
-                for constant in transducer.iter("TransducerConstant"):
-                    constant_name = constant.find("Name").text
-                    constant_value = float(constant.find("Value").text)
-
-                    if constant_name.startswith("FBG") and constant_name.endswith("0"):
-                        uid = re.search("_([^;]*)_", constant_name)[1]
-                        session.query(package.metadata_table).filter(
-                            package.metadata_table.uid == uid
-                        ).update({"initial_wavelength": constant_value})
-
-                    else:
-                        # Handle edge cases caused by lack of formulas and differently named coefficients in Enlight
-                        if constant_name == "K":  # beta is sometimes called K
-                            constant_name = "beta"
-                        elif (
-                            constant_name == "CTEt"
-                        ):  # CTEt is in units 10^-6/C in Enlight
-                            constant_value /= 1e6
-                        elif constant_name == "St":  # Also record St in tmp sensor row
-                            sensor = (
-                                session.query(package.metadata_table)
-                                .filter(package.metadata_table.name == name)
-                                .first()
-                            )
-                            if sensor and sensor.type == "str":
-                                tmp_uid = sensor.corresponding_sensor
-                                session.query(package.metadata_table).filter(
-                                    package.metadata_table.uid == tmp_uid
-                                ).update({"coeffs": {"St": constant_value}})
-
-                        coeffs[constant_name] = constant_value
-
-                if coeffs:
-                    session.query(package.metadata_table).filter(
-                        package.metadata_table.name == name
-                    ).update({"coeffs": coeffs})
-
-        session.commit()
-        session.close()
-
-        logger.info("Uploaded new configuration file to database")
-
-        self.load(self.setup)  # Load the newly parsed config file
+READ_SIZE = 2 ** 20  # Upper limit on the bytes taken from the reader in one batch
+DRAIN_TIMEOUT = 0.1  # Seconds without data after which a stopped stream has ended
+DNS_TTL = 300  # Seconds for which a resolved hostname is cached
+
+# Seconds between refreshes of each status field by update_status, or None to fetch it
+# just once per connection, along with its request and response
+STATUS_FIELDS = {
+    "instrument_name": (None, GetInstrumentName, InstrumentName),
+    "firmware_version": (None, GetFirmwareVersion, FirmwareVersion),
+    "dut_channel_count": (None, GetDutChannelCount, DutChannelCount),
+    "available_laser_scan_speeds": (
+        None,
+        GetAvailableLaserScanSpeeds,
+        AvailableLaserScanSpeeds,
+    ),
+    "laser_scan_speed": (60, GetLaserScanSpeed, LaserScanSpeed),
+    "peak_data_streaming_divider": (
+        60,
+        GetPeakDataStreamingDivider,
+        PeakDataStreamingDivider,
+    ),
+    "ntp_enabled": (60, GetNtpEnabled, NtpEnabled),
+    "ntp_server": (60, GetNtpServer, NtpServer),
+    "is_ready": (1, IsReady, Ready),
+    "peak_data_streaming_status": (
+        1,
+        GetPeakDataStreamingStatus,
+        PeakDataStreamingStatus,
+    ),
+    "peak_data_streaming_available_buffer": (
+        1,
+        GetPeakDataStreamingAvailableBuffer,
+        PeakDataStreamingAvailableBuffer,
+    ),
+    "instrument_time": (1, GetInstrumentUtcDateTime, InstrumentUtcDateTime),
+}
+
+_resolved = {}  # Hostname to its address and when that expires
+
+
+async def resolve(hostname: str) -> IPv4Address:
+    """Resolve a hostname without blocking the event loop, caching it for DNS_TTL."""
+    address, expires = _resolved.get(hostname, (None, 0))
+    if time.monotonic() >= expires:
+        loop = asyncio.get_event_loop()
+        info = await loop.getaddrinfo(hostname, None, family=socket.AF_INET)
+        address = ip_address(info[0][4][0])
+        _resolved[hostname] = address, time.monotonic() + DNS_TTL
+    return address
 
 
 class Connection:
+    """
+    Connection to one of the instrument's ports. Requests can be pipelined: every request
+    is written as soon as it is made, with a future for its response appended to a FIFO,
+    and a single reader task resolves those futures in order as the responses arrive.
+    """
+
     def __init__(self, name: str, host: str, port: int):
         self.name = name
         self.host = host
@@ -231,6 +132,14 @@ class Connection:
         self.reader = None
         self.writer = None
         self.reading = asyncio.Condition()
+        self.buffer = bytearray()  # Partial responses left over from read_batch
+        self.pending = deque()  # Futures for the responses to requests, in order
+        self.responder = None  # Task reading responses into them
+
+    @property
+    def busy(self) -> bool:
+        """Whether any requests are waiting for their response."""
+        return bool(self.pending)
 
     async def connect(self):
         self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
@@ -254,9 +163,147 @@ class Connection:
 
             return status, message, content
 
+    async def read_batch(self) -> PeakBatch:
+        """
+        Decode every complete response already received, waiting for at least one.
+        Not to be mixed with read on the same connection, as any partial response
+        is held in self.buffer rather than left in the reader.
+        """
+        async with self.reading:
+            while True:
+                batch, consumed = PeakBatch.decode(self.buffer)
+                if consumed:
+                    del self.buffer[:consumed]
+                    return batch
+
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    raise asyncio.IncompleteReadError(bytes(self.buffer), None)
+                self.buffer += data
+
     async def execute(self, request: Request) -> bytes:
-        self.writer.write(request.serialize())
-        return await self.read()
+        return (await self.execute_many([request]))[0]
+
+    async def execute_many(self, requests: List[Request]) -> List[bytes]:
+        """
+        Write every request back-to-back and return their responses in order, so that
+        they take one round-trip rather than one each.
+        """
+        loop = asyncio.get_event_loop()
+        futures = [loop.create_future() for _ in requests]
+        self.pending.extend(futures)
+        self.writer.write(b"".join(request.serialize() for request in requests))
+        if self.responder is None or self.responder.done():
+            self.responder = asyncio.ensure_future(self._respond())
+        return await asyncio.gather(*futures)
+
+    async def _respond(self):
+        """Read responses into the pending futures until there are none left."""
+        while self.pending:
+            try:
+                response = await self.read()
+            except (asyncio.IncompleteReadError, OSError) as e:
+                while self.pending:
+                    future = self.pending.popleft()
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+            future = self.pending.popleft()
+            if not future.done():  # Its request may have been cancelled since
+                future.set_result(response)
+
+    async def flush(self, timeout: float = DRAIN_TIMEOUT) -> int:
+        """Discard received data until none arrives for timeout seconds."""
+        discarded = 0
+        while True:
+            try:
+                data = await asyncio.wait_for(self.reader.read(READ_SIZE), timeout)
+            except asyncio.TimeoutError:
+                break
+            if not data:
+                break
+            discarded += len(data)
+        return discarded
+
+
+class StreamingConnection(Connection):
+    """
+    Connection to the peak streaming port which frames responses with a FrameProtocol
+    rather than a StreamReader, avoiding a new bytes object for every header and response.
+    """
+
+    def __init__(self, name: str, host: str, port: int):
+        super().__init__(name, host, port)
+        self.transport = None
+        self.protocol = None
+        self.received = 0  # Responses handed out
+
+    async def connect(self):
+        loop = asyncio.get_event_loop()
+        self.transport, self.protocol = await loop.create_connection(
+            FrameProtocol, self.host, self.port
+        )
+        logger.info("%s connected to %s:%d", self.name, self.host, self.port)
+
+    async def disconnect(self):
+        if self.transport is not None:
+            self.transport.close()
+            logger.info("%s disconnected from %s:%d", self.name, self.host, self.port)
+
+    async def read(self) -> Tuple[bool, memoryview, memoryview]:
+        async with self.reading:
+            frame = await self.protocol.read()
+            self.received += 1
+            return frame
+
+    async def read_batch(self) -> PeakBatch:
+        async with self.reading:
+            while True:
+                batch, consumed = PeakBatch.decode(self.protocol.pending)
+                if consumed:
+                    self.protocol.consume(consumed)
+                    self.received += len(batch)
+                    return batch
+                await self.protocol.wait()
+
+    async def read_frames(self) -> memoryview:
+        """
+        Return every complete response already received, still framed and undecoded,
+        waiting for at least one. The view is only valid until the next await.
+        """
+        async with self.reading:
+            while True:
+                starts, end = split_frames(self.protocol.pending)
+                if end:
+                    frames = self.protocol.pending[:end]
+                    self.protocol.consume(end)
+                    self.received += len(starts)
+                    return frames
+                await self.protocol.wait()
+
+    async def wait_for_response(self, timeout: float = DRAIN_TIMEOUT) -> bool:
+        """
+        Wait up to timeout seconds for a complete response to be pending, returning
+        whether one was. Once it is, the next read returns without waiting.
+        """
+        while not self.protocol.complete:
+            try:
+                await asyncio.wait_for(self.protocol.wait(), timeout)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                return False
+        return True
+
+    async def flush(self, timeout: float = DRAIN_TIMEOUT) -> int:
+        discarded = 0
+        while True:
+            discarded += len(self.protocol.pending)
+            self.protocol.consume(len(self.protocol.pending))
+            try:
+                await asyncio.wait_for(self.protocol.wait(), timeout)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                break
+        return discarded
 
 
 class x55Client:
@@ -272,6 +319,8 @@ class x55Client:
 
         # Connection information
         self.host = HOST
+        self.command_port = COMMAND_PORT
+        self.peak_streaming_port = PEAK_STREAMING_PORT
         self.command = None
         self.peaks = None
         self.connected = False
@@ -293,16 +342,94 @@ class x55Client:
         self.instrument_time = None
         self.ntp_enabled = None
         self.ntp_server = None
+        self.status_updated = {}  # When each status field was last fetched
 
         # Recording and streaming toggles
         self.recording = False
         self.streaming = False
+        self.live_status = True  # Write the status file for the web server
 
         # Configuration setting
         self.configuration = Configuration()
 
-        # Database writing queue
-        self.queues = defaultdict(queue.SimpleQueue)
+        # Database writing queues, bounded to push back on streaming if writing falls behind
+        self.queues = {}
+        self.writers = []
+        self.queue_size = 100000  # rows
+        self.overflow_policy = OverflowPolicy.BLOCK
+        self.spool = False  # Spool rows to disk first, so none are lost if writes fail
+
+        # Capture file to append the raw stream to, and one to stream from instead
+        self.capture = None
+        self.replay = None
+        self.replay_realtime = False  # Replay at the original cadence, not flat out
+
+        # Decode and write in this many worker processes instead of threads, if not 0
+        self.pipeline_workers = 0
+        self.pipeline = None
+
+        # Raise the streaming divider while falling behind, rather than only warning
+        self.auto_throttle = True
+        self.monitor_interval = MONITOR_INTERVAL
+        self.monitor = None
+
+    @property
+    def pipeline_status(self):
+        if self.pipeline is None:
+            return None
+        status = self.pipeline.poll_status().values()
+        return "%d running, %d bytes behind" % (
+            sum(worker["running"] for worker in status),
+            max((worker["behind"] for worker in status), default=0),
+        )
+
+    @property
+    def spool_status(self):
+        if not self.spool:
+            return None
+        if self.pipeline is not None:
+            status = self.pipeline.poll_status().values()
+            depth = sum(worker["spooled"] for worker in status)
+            rate = sum(worker["replay_rate"] for worker in status)
+        else:
+            depth = sum(q.depth for q in self.queues.values())
+            rate = sum(q.replay_rate for q in self.queues.values())
+        return "%d rows behind, writing %.0f rows/s" % (depth, rate)
+
+    @property
+    def monitor_status(self):
+        if self.monitor is None:
+            return None
+        return str(self.monitor)
+
+    @property
+    def host_lag(self) -> float:
+        """Fraction of the host's queues in use, for whichever is furthest behind."""
+        if self.pipeline is not None and self.recording:
+            return max(
+                (
+                    max(
+                        worker["behind"] / self.pipeline.ring.size,
+                        worker["queued"] / (self.queue_size * len(worker["tables"])),
+                    )
+                    for worker in self.pipeline.poll_status().values()
+                ),
+                default=0,
+            )
+        return max(
+            (min(len(q) / self.queue_size, 1) for q in self.queues.values()),
+            default=0,
+        )
+
+    @property
+    def written_rows(self) -> int:
+        """Rows written to each table (or the least written to any one table)."""
+        if self.pipeline is not None:
+            status = self.pipeline.poll_status().values()
+            return sum(worker["written"] for worker in status) // max(
+                len(self.configuration.sensors), 1
+            )
+        return min((writer.written_rows for writer in self.writers), default=0)
 
     @property
     def effective_sampling_rate(self):
@@ -311,9 +438,10 @@ class x55Client:
         return self.laser_scan_speed // self.peak_data_streaming_divider
 
     async def connect(self):
-        self.command = Connection(self.name, self.host, COMMAND_PORT)
-        self.peaks = Connection(self.name, self.host, PEAK_STREAMING_PORT)
+        self.command = Connection(self.name, self.host, self.command_port)
+        self.peaks = StreamingConnection(self.name, self.host, self.peak_streaming_port)
         await self.command.connect()
+        self.status_updated.clear()  # Fetch even the static fields again
         self.connected = True
 
     async def disconnect(self):
@@ -321,67 +449,51 @@ class x55Client:
         await self.peaks.disconnect()
         self.connected = False
 
-    async def update_status(self):
-        self.instrument_name = InstrumentName(
-            await self.command.execute(GetInstrumentName())
-        ).content
-
-        self.firmware_version = FirmwareVersion(
-            await self.command.execute(GetFirmwareVersion())
-        ).content
-
-        self.is_ready = Ready(await self.command.execute(IsReady())).content
-
-        self.dut_channel_count = DutChannelCount(
-            await self.command.execute(GetDutChannelCount())
-        ).content
-
-        self.available_laser_scan_speeds = AvailableLaserScanSpeeds(
-            await self.command.execute(GetAvailableLaserScanSpeeds())
-        ).content
-
-        self.peak_data_streaming_status = PeakDataStreamingStatus(
-            await self.command.execute(GetPeakDataStreamingStatus())
-        ).content
-
-        self.laser_scan_speed = LaserScanSpeed(
-            await self.command.execute(GetLaserScanSpeed())
-        ).content
-
-        self.peak_data_streaming_divider = PeakDataStreamingDivider(
-            await self.command.execute(GetPeakDataStreamingDivider())
-        ).content
-
-        self.peak_data_streaming_available_buffer = PeakDataStreamingAvailableBuffer(
-            await self.command.execute(GetPeakDataStreamingAvailableBuffer())
-        ).content
-
-        self.instrument_time = InstrumentUtcDateTime(
-            await self.command.execute(GetInstrumentUtcDateTime())
-        ).content
+    async def update_status(self, force: bool = False) -> List[str]:
+        """
+        Fetch every status field that is due a refresh according to STATUS_FIELDS, or
+        every field if force, all in one round-trip. Returns the fields fetched.
+        """
+        now = time.monotonic()
+        due = [
+            field
+            for field, (interval, _, _) in STATUS_FIELDS.items()
+            if force
+            or field not in self.status_updated
+            or interval is not None
+            and now - self.status_updated[field] >= interval
+        ]
+        if not due:
+            return due
 
-        self.ntp_enabled = NtpEnabled(
-            await self.command.execute(GetNtpEnabled())
-        ).content
+        responses = await self.command.execute_many(
+            [STATUS_FIELDS[field][1]() for field in due]
+        )
+        for field, response in zip(due, responses):
+            setattr(self, field, STATUS_FIELDS[field][2](response).content)
+            self.status_updated[field] = now
 
-        self.ntp_server = NtpServer(await self.command.execute(GetNtpServer())).content
+        return due
 
     async def update_laser_scan_speed(self, laser_scan_speed: int) -> bool:
-        await self.command.execute(SetLaserScanSpeed(speed=laser_scan_speed))
-
-        self.laser_scan_speed = LaserScanSpeed(
-            await self.command.execute(GetLaserScanSpeed())
-        ).content
+        _, laser_scan_speed = await self.command.execute_many(
+            [SetLaserScanSpeed(speed=laser_scan_speed), GetLaserScanSpeed()]
+        )
+        self.laser_scan_speed = LaserScanSpeed(laser_scan_speed).content
+        self.status_updated["laser_scan_speed"] = time.monotonic()
 
         logger.info("Laser scan speed set to: %d", self.laser_scan_speed)
         return self.laser_scan_speed
 
     async def update_peak_data_streaming_divider(self, divider: int):
-        await self.command.execute(SetPeakDataStreamingDivider(divider=divider))
-
-        self.peak_data_streaming_divider = PeakDataStreamingDivider(
-            await self.command.execute(GetPeakDataStreamingDivider())
-        ).content
+        _, divider = await self.command.execute_many(
+            [
+                SetPeakDataStreamingDivider(divider=divider),
+                GetPeakDataStreamingDivider(),
+            ]
+        )
+        self.peak_data_streaming_divider = PeakDataStreamingDivider(divider).content
+        self.status_updated["peak_data_streaming_divider"] = time.monotonic()
 
         logger.info(
             "Peak data streaming divider set to: %d", self.peak_data_streaming_divider
@@ -392,50 +504,155 @@ class x55Client:
         return self.configuration.load(setup)
 
     async def update_ntp_server(self, address: IPv4Address):
-        await self.command.execute(SetNtpEnabled(enabled=False))
-        await self.command.execute(SetInstrumentUtcDateTime(dt=datetime.utcnow()))
-        await self.command.execute(SetNtpServer(address=address))
-        await self.command.execute(SetNtpEnabled(enabled=True))
-
-        self.ntp_server = NtpServer(await self.command.execute(GetNtpServer())).content
-        self.ntp_enabled = NtpEnabled(
-            await self.command.execute(GetNtpEnabled())
-        ).content
+        *_, ntp_server, ntp_enabled = await self.command.execute_many(
+            [
+                SetNtpEnabled(enabled=False),
+                SetInstrumentUtcDateTime(dt=datetime.utcnow()),
+                SetNtpServer(address=address),
+                SetNtpEnabled(enabled=True),
+                GetNtpServer(),
+                GetNtpEnabled(),
+            ]
+        )
+        self.ntp_server = NtpServer(ntp_server).content
+        self.ntp_enabled = NtpEnabled(ntp_enabled).content
+        now = time.monotonic()
+        self.status_updated["ntp_server"] = self.status_updated["ntp_enabled"] = now
 
         logger.info("Updated NTP server address to: %s", self.ntp_server)
         return self.ntp_server
 
-    async def stream(self):
-        await self.peaks.connect()
-        self.streaming = Response(
-            await self.command.execute(EnablePeakDataStreaming())
-        ).status
+    async def stream(
+        self,
+        batch: bool = False,
+        raw: bool = False,
+        drain: bool = False,
+        copy: bool = True,
+    ):
+        """
+        Stream peaks from the instrument, yielding a PeakFrame per response or, in batch
+        mode, a PeakBatch of every response that has arrived since the last one.
+        Each PeakFrame has its own copy of the response unless not copy, in which case
+        it is a view of the receive buffer that is only valid until the next await.
+        In raw mode, yield those responses still framed and undecoded instead, which are
+        likewise only valid until the next await.
+        If drain, then once streaming stops the responses still arriving from the
+        instrument are yielded too, rather than discarded.
+        If self.capture is a path, every response received is also appended to that
+        capture file, and if self.replay is a path, the responses in that capture file
+        are streamed instead of those from the instrument, until they run out.
+        While streaming from the instrument, a StreamMonitor throttles the stream if the
+        client falls behind.
+        """
+        monitoring = None
+
+        async def read():
+            if raw:
+                return await peaks.read_frames()
+            elif batch:
+                return await peaks.read_batch()
+            else:
+                status, message, content = await peaks.read()
+                return PeakFrame((status, message, bytes(content) if copy else content))
+
+        if self.replay is not None:
+            peaks = ReplayConnection(self.name, self.replay, self.replay_realtime)
+            await peaks.connect()
+            self.streaming = True
+        else:
+            peaks = self.peaks
+            await peaks.connect()
+            self.streaming = Response(
+                await self.command.execute(EnablePeakDataStreaming())
+            ).status
+            if self.capture is not None:
+                peaks.protocol.capture = CaptureWriter(self.capture)
+            self.monitor = StreamMonitor(
+                self, self.auto_throttle, self.monitor_interval
+            )
+            monitoring = asyncio.ensure_future(self.monitor.run())
         logger.info("%s started streaming", self.name)
 
-        while self.streaming:
-            yield Peaks(await self.peaks.read())
-
-        # Disconnect and clear out the remaining data from the buffer
-        await self.command.execute(DisablePeakDataStreaming())
-
-        buffer = bytes()
-        while True:
+        disabled = False  # Whether streaming has been disabled on the instrument
+        try:
             try:
-                data = await asyncio.wait_for(self.peaks.reader.read(), timeout=0.1)
-            except asyncio.TimeoutError:
-                break
-            buffer += data
+                while self.streaming:
+                    yield await read()
+            except asyncio.IncompleteReadError:
+                logger.info("%s reached the end of the stream", self.name)
+            self.streaming = False
+
+            if drain and self.replay is None:
+                await self._stop_monitor(monitoring)
+                await self.command.execute(DisablePeakDataStreaming())
+                disabled = True
+
+                # Take in whatever the instrument had sent or buffered before it stopped
+                start, received = time.monotonic(), peaks.received
+                while await peaks.wait_for_response():
+                    yield await read()
+                logger.info(
+                    "%s drained %d responses in %.3f s after streaming stopped",
+                    self.name,
+                    peaks.received - received,
+                    time.monotonic() - start,
+                )
+        finally:
+            # However the stream ends, even by the consumer raising or closing it early
+            self.streaming = False
+            if self.replay is not None:
+                await peaks.disconnect()
+            else:
+                await self._stop_streaming(peaks, monitoring, disabled)
+
+    async def _stop_monitor(self, monitoring: asyncio.Future):
+        """Stop monitoring, which restores the divider if it was throttled."""
+        if self.monitor is not None:
+            self.monitor.stop()
+            try:
+                await monitoring
+            finally:
+                self.monitor = None
 
-        await self.peaks.disconnect()
+    async def _stop_streaming(
+        self, peaks: StreamingConnection, monitoring: asyncio.Future, disabled: bool
+    ):
+        """
+        Stop monitoring and streaming, then disconnect from the peak streaming port.
+        Failures of the monitor or the command connection are logged rather than raised,
+        so that the peak streaming connection is still closed and any error already
+        raised by the stream is not replaced.
+        """
+        try:
+            try:
+                await self._stop_monitor(monitoring)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("%s stream monitor failed", self.name)
+            if not disabled:
+                await self.command.execute(DisablePeakDataStreaming())
+        except (OSError, asyncio.IncompleteReadError) as e:
+            logger.warning("%s could not stop streaming: %r", self.name, e)
+        finally:
+            if peaks.protocol.capture is not None:
+                peaks.protocol.capture.close()
+                peaks.protocol.capture = None
+
+            # Disconnect and clear out the remaining data from the buffer
+            unprocessed = await peaks.flush()
+            await peaks.disconnect()
 
         # Log the size of the unprocessed buffer
         logger.info(
             "%s stopped streaming with %d unproccessed bytes in the TCP buffer",
             self.name,
-            len(buffer),
+            unprocessed,
         )
 
     def set_live_status(self, live: bool):
+        if not self.live_status:
+            return
         status = {
             "live": live,
             "packages": self.configuration.packages,
@@ -444,52 +661,102 @@ class x55Client:
         with open(os.path.join(ROOT_DIR, "var/status.pickle"), "wb") as f:
             pickle.dump(status, f)
 
-    def database_writer(self, q):
-        session = Session()
+    async def record(self, batch: bool = False):
+        if self.pipeline_workers:
+            await self.record_pipeline()
+            return
 
-        rows = []
-
-        while self.recording or not q.empty():
-            try:
-                rows.append(q.get(block=True, timeout=0.1))
-            except queue.Empty:
-                continue
-
-            # Bulk INSERT and COMMIT every 0.1s
-            if len(rows) > 0.1 * self.effective_sampling_rate:
-                session.bulk_save_objects(rows)
-                session.commit()
-                rows = []
-
-        session.bulk_save_objects(rows)
-        session.commit()
-        session.close()
-
-    async def record(self):
         self.set_live_status(True)
+        self.configuration.unmatched_peaks.clear()
 
         self.recording = True
-        writer_threads = [
-            threading.Thread(target=self.database_writer, args=(self.queues[table],))
-            for table in self.configuration.mapping
+        self.queues = {
+            table: Spool(spool_directory(table), sensors.uids)
+            if self.spool
+            else BoundedQueue(self.queue_size, self.overflow_policy)
+            for table, sensors in self.configuration.sensors.items()
+        }
+        self.writers = [
+            DatabaseWriter(
+                db,
+                TableInsert(table, sensors.uids, db.dialect),
+                self.queues[table],
+                BatchPolicy(),
+            )
+            for table, sensors in self.configuration.sensors.items()
         ]
-        for writer_thread in writer_threads:
-            writer_thread.start()
+        for writer in self.writers:
+            writer.start()
 
         logger.info("Started writer threads")
 
-        async for response in self.stream():
-            for table in self.configuration.mapping:
-                peaks = self.configuration.map(response.content, table)
+        # Frames are copied into padded arrays straight away, before any await
+        stream = self.stream(batch, drain=True, copy=False)
+        try:
+            async for response in stream:
+                if batch:
+                    timestamps, peaks = response.datetimes, response.peaks
+                else:
+                    timestamps, peaks = (response.timestamp,), response.padded[None]
+
+                for table in self.queues:
+                    values = self.configuration.map(peaks, table)
+
+                    # Send the rows as column arrays to the database writer thread
+                    await self.queues[table].put_async((timestamps, values))
+        finally:
+            await stream.aclose()  # Stop streaming now, even on failure
+
+            # Toggle recording off and then wait for thread to finish, even on failure
+            self.recording = False
+            # Off the loop, so that other clients in it carry on while the writers finish
+            logger.info("Waiting for writer threads to join")
+            loop = asyncio.get_event_loop()
+            await asyncio.gather(
+                *(loop.run_in_executor(None, writer.stop) for writer in self.writers)
+            )
+            for writer in self.writers:
+                writer.queue.close()
+            logger.info("Writer threads joined")
 
-                # Send row to the database writer thread
-                self.queues[table].put(table(timestamp=response.timestamp, **peaks))
+        for table, unmatched_peaks in self.configuration.unmatched_peaks.items():
+            logger.info(
+                "%d unmatched peaks in %s", unmatched_peaks, table.__tablename__
+            )
 
-        # Toggle recording off and then wait for thread to finish
-        self.recording = False
-        logger.info("Waiting for writer threads to join")
-        for writer_thread in writer_threads:
-            writer_thread.join()
-        logger.info("Writer threads joined")
+        self.set_live_status(False)
+
+    async def record_pipeline(self):
+        """Record with decoding, mapping and writing in a Pipeline of worker processes."""
+        self.set_live_status(True)
+
+        self.recording = True
+        self.pipeline = Pipeline(
+            self.configuration.setup,
+            list(self.configuration.sensors),
+            self.pipeline_workers,
+            self.queue_size,
+            self.overflow_policy,
+            self.spool,
+        )
+        self.pipeline.start()
+
+        stream = self.stream(raw=True, drain=True)
+        try:
+            async for frames in stream:
+                await self.pipeline.put(frames)
+        finally:
+            await stream.aclose()
+            self.recording = False
+            logger.info("Waiting for pipeline workers to finish")
+            await self.pipeline.stop()
+            logger.info("Pipeline workers finished")
+
+        for status in self.pipeline.status.values():
+            logger.info(
+                "%d unmatched peaks in %s",
+                status["unmatched_peaks"],
+                ", ".join(status["tables"]),
+            )
 
         self.set_live_status(False)
@@ -0,0 +1,138 @@
+import asyncio
+from struct import unpack_from
+from typing import Tuple, Optional
+
+from .x55_protocol import HEADER_LENGTH
+
+BUFFER_SIZE = 2 ** 22  # bytes
+MINIMUM_RECEIVE_SIZE = 2 ** 16  # Compact the buffer if less than this is free at the end
+HIGH_WATER_MARK = 0.75  # Pause reading above this fraction of the buffer being pending
+LOW_WATER_MARK = 0.25  # and resume again below this one
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    """
+    Receive responses from the peak streaming port straight into a reusable buffer.
+    The socket writes into free space at the end of a single bytearray, responses are
+    framed by parsing the 8-byte header in place and are handed out as memoryviews, and
+    unconsumed bytes are moved back to the start of the buffer once the end is reached.
+    A handed out frame is only valid until the consumer next yields to the event loop,
+    so it must be decoded (or copied) before awaiting anything else.
+    """
+
+    def __init__(self, size: int = BUFFER_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First byte not yet handed out
+        self.end = 0  # End of the received bytes
+        self.transport = None
+        self.paused = False
+        self.closed = False
+        self.waiter = None
+        self.capture = None  # CaptureWriter for every complete response handed out
+
+    @property
+    def pending(self) -> memoryview:
+        """All received bytes that have not yet been handed out."""
+        return self.view[self.start : self.end]
+
+    @property
+    def complete(self) -> bool:
+        """Whether at least one complete response is pending."""
+        if self.end - self.start < HEADER_LENGTH:
+            return False
+        message_size, content_size = unpack_from("<HI", self.view, self.start + 2)
+        return self.end - self.start >= HEADER_LENGTH + message_size + content_size
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if len(self.buffer) - self.end < max(sizehint, MINIMUM_RECEIVE_SIZE):
+            self._compact()
+        return self.view[self.end :]
+
+    def buffer_updated(self, nbytes: int):
+        self.end += nbytes
+        pending = self.end - self.start
+        if not self.paused and pending > HIGH_WATER_MARK * len(self.buffer):
+            self.paused = True
+            self.transport.pause_reading()
+        self._wake()
+
+    def eof_received(self):
+        self.closed = True
+        self._wake()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self._wake()
+
+    def consume(self, nbytes: int):
+        """Mark nbytes of pending data as handed out."""
+        if self.capture is not None:
+            self.capture.write(self.view[self.start : self.start + nbytes])
+        self.start += nbytes
+        if self.start == self.end:  # Nothing is left, so start again from the front
+            self.start = self.end = 0
+        if self.paused and self.end - self.start < LOW_WATER_MARK * len(self.buffer):
+            self.paused = False
+            self.transport.resume_reading()
+
+    def next_frame(self) -> Optional[Tuple[bool, memoryview, memoryview]]:
+        """Return the next complete response if one has been received."""
+        if self.end - self.start < HEADER_LENGTH:
+            return None
+
+        status, message_size, content_size = unpack_from("<?xHI", self.view, self.start)
+        frame_length = HEADER_LENGTH + message_size + content_size
+        if self.end - self.start < frame_length:
+            if frame_length > len(self.buffer):
+                self._grow(frame_length)
+            return None
+
+        message_start = self.start + HEADER_LENGTH
+        content_start = message_start + message_size
+        message = self.view[message_start:content_start]
+        content = self.view[content_start : content_start + content_size]
+        self.consume(frame_length)
+
+        return not status, message, content
+
+    async def wait(self):
+        """Wait until more data has been received."""
+        if self.closed:
+            raise asyncio.IncompleteReadError(bytes(self.pending), None)
+        self.waiter = asyncio.get_event_loop().create_future()
+        try:
+            await self.waiter
+        finally:
+            self.waiter = None
+
+    async def read(self) -> Tuple[bool, memoryview, memoryview]:
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            await self.wait()
+
+    def _wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def _compact(self):
+        """Move the pending bytes to the start of the buffer."""
+        length = self.end - self.start
+        if length == len(self.buffer):
+            self._grow(2 * len(self.buffer))
+            return
+        self.view[:length] = self.view[self.start : self.end]
+        self.start, self.end = 0, length
+
+    def _grow(self, size: int):
+        """Replace the buffer with a larger one, leaving any handed out views intact."""
+        pending = self.pending
+        self.buffer = bytearray(max(size, 2 * len(self.buffer)))
+        self.view = memoryview(self.buffer)
+        self.view[: len(pending)] = pending
+        self.start, self.end = 0, len(pending)
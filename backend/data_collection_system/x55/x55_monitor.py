@@ -0,0 +1,191 @@
+import asyncio
+import time
+from typing import Optional
+
+from .. import logger
+from .x55_protocol import (
+    GetPeakDataStreamingAvailableBuffer,
+    GetPeakDataStreamingDivider,
+    PeakDataStreamingAvailableBuffer,
+    PeakDataStreamingDivider,
+)
+
+MONITOR_INTERVAL = 1  # Seconds between samples while streaming
+THROTTLE_LAG = 0.5  # Fraction of the buffer or queues in use above which to throttle
+RESTORE_LAG = 0.1  # and below which there is headroom to restore the divider
+THROTTLE_SAMPLES = 3  # Consecutive samples above THROTTLE_LAG before throttling
+RESTORE_SAMPLES = 10  # Consecutive samples below RESTORE_LAG before restoring
+
+
+class StreamMonitor:
+    """
+    Watch how far behind the client is falling while streaming, by sampling the si255's
+    available streaming buffer and the depth of the host's queues, and throttle the
+    stream before the instrument's buffer overflows.
+    Lag is the larger of the fraction of the instrument buffer in use and the fraction of
+    the host queues in use. Once it has stayed above THROTTLE_LAG for THROTTLE_SAMPLES
+    samples the divider is raised to the next of the client's divider options (or, with
+    auto_throttle off, a warning is logged instead), and once it has stayed below
+    RESTORE_LAG for RESTORE_SAMPLES samples it is lowered again, one option at a time,
+    back to the divider streaming started with. If the divider is set by anything else
+    while streaming, that becomes the divider to restore to instead.
+    """
+
+    def __init__(self, client, auto_throttle: bool = True, interval=MONITOR_INTERVAL):
+        self.client = client
+        self.auto_throttle = auto_throttle
+        self.interval = interval
+        self.dividers = sorted(client.divider_options)
+        self.stopping = asyncio.Event()
+
+        self.original_divider = None  # When streaming started
+        self.divider = None
+        self.instrument_lag = None
+        self.host_lag = None
+        self.lagging = 0  # Consecutive samples above THROTTLE_LAG
+        self.headroom = 0  # Consecutive samples below RESTORE_LAG
+
+        # Counts at the last sample, to measure rates with
+        self.last_sample = None
+        self.received = 0
+        self.written = 0
+        self.received_rate = None  # Responses per second
+        self.written_rate = None  # Rows per second, to each table
+
+    @property
+    def lag(self) -> Optional[float]:
+        if self.instrument_lag is None:
+            return None
+        return max(self.instrument_lag, self.host_lag)
+
+    def __str__(self):
+        if self.lag is None:
+            return "None"
+        throttled = (
+            f" (throttled from {self.original_divider})"
+            if self.divider != self.original_divider
+            else ""
+        )
+        return f"{self.lag:.0%} behind, divider {self.divider}{throttled}"
+
+    async def sample(self):
+        """Sample the instrument buffer, the host queues and the rates since last time."""
+        client = self.client
+        client.peak_data_streaming_available_buffer = PeakDataStreamingAvailableBuffer(
+            await client.command.execute(GetPeakDataStreamingAvailableBuffer())
+        ).content
+        self.instrument_lag = 1 - client.peak_data_streaming_available_buffer / 100
+        self.host_lag = client.host_lag
+
+        now = time.monotonic()
+        received, written = client.peaks.received, client.written_rows
+        if self.last_sample is not None:
+            elapsed = now - self.last_sample
+            self.received_rate = (received - self.received) / elapsed
+            self.written_rate = (written - self.written) / elapsed
+        self.last_sample, self.received, self.written = now, received, written
+
+    def decide(self, lag: float) -> Optional[int]:
+        """Return the divider to change to, if lag means that it should change."""
+        if lag > THROTTLE_LAG:
+            self.lagging += 1
+            self.headroom = 0
+        elif lag < RESTORE_LAG:
+            self.headroom += 1
+            self.lagging = 0
+        else:
+            self.lagging = self.headroom = 0
+
+        if self.lagging >= THROTTLE_SAMPLES:
+            self.lagging = 0
+            higher = [divider for divider in self.dividers if divider > self.divider]
+            return higher[0] if higher else self.divider
+
+        if self.headroom >= RESTORE_SAMPLES and self.divider > self.original_divider:
+            self.headroom = 0
+            # Straight back to the original divider if it isn't one of the options
+            return max(
+                (
+                    divider
+                    for divider in self.dividers
+                    if self.original_divider <= divider < self.divider
+                ),
+                default=self.original_divider,
+            )
+
+        return None
+
+    async def adjust(self, divider: int):
+        rates = (
+            "%.1f%% of the instrument buffer and %.1f%% of host queues in use, "
+            "receiving %.0f responses/s and writing %.0f rows/s"
+            % (
+                100 * self.instrument_lag,
+                100 * self.host_lag,
+                self.received_rate or 0,
+                self.written_rate or 0,
+            )
+        )
+
+        if divider == self.divider:
+            logger.warning(
+                "%s is falling behind at the highest divider of %d, with %s",
+                self.client.name,
+                divider,
+                rates,
+            )
+        elif divider > self.divider and not self.auto_throttle:
+            logger.warning(
+                "%s is falling behind, with %s, but auto-throttling is off",
+                self.client.name,
+                rates,
+            )
+        else:
+            logger.warning(
+                "%s %s the streaming divider from %d to %d, with %s",
+                self.client.name,
+                "raised" if divider > self.divider else "restored",
+                self.divider,
+                divider,
+                rates,
+            )
+            self.divider = await self.client.update_peak_data_streaming_divider(divider)
+            if self.client.recording:
+                self.client.set_live_status(True)  # Update the sampling rate
+
+    def sync(self):
+        """Start over from the client's divider if something else has changed it."""
+        divider = self.client.peak_data_streaming_divider
+        if divider is not None and divider != self.divider:
+            self.divider = self.original_divider = divider
+            self.lagging = self.headroom = 0
+
+    def stop(self):
+        self.stopping.set()
+
+    async def run(self):
+        """
+        Monitor the stream until stopped, then restore the original divider.
+        Stopping rather than cancelling never leaves a command half executed.
+        """
+        self.divider = self.original_divider = PeakDataStreamingDivider(
+            await self.client.command.execute(GetPeakDataStreamingDivider())
+        ).content
+        self.client.peak_data_streaming_divider = self.divider
+        while True:
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.interval)
+                break
+            except asyncio.TimeoutError:
+                pass
+            await self.sample()
+            self.sync()
+            divider = self.decide(self.lag)
+            if divider is not None:
+                await self.adjust(divider)
+
+        self.sync()
+        if self.divider != self.original_divider:
+            self.divider = await self.client.update_peak_data_streaming_divider(
+                self.original_divider
+            )
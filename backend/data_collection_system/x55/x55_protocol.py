@@ -1,41 +1,64 @@
 from datetime import datetime, timezone
 from typing import List, Tuple
 from itertools import accumulate
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
 from ipaddress import IPv4Address, ip_address
 
-from pydantic import BaseModel
+import numpy as np
+
+from ..codec import Message, bool_serializer, datetime_serializer, serializers
+
+
+HEADER_LENGTH = 8  # bytes
+NUM_CHANNELS = 16
+PEAKS_HEADER_LENGTH = 56  # bytes
+
+# Layout of the fixed-length header at the start of every #GetPeaks response
+PEAKS_HEADER = np.dtype(
+    [
+        ("header_length", "<u2"),
+        ("header_version", "<u2"),
+        ("reserved", "<u4"),
+        ("serial_number", "<u8"),
+        ("timestamp_seconds", "<u4"),
+        ("timestamp_nanoseconds", "<u4"),
+        ("num_peaks", "<u2", (NUM_CHANNELS,)),
+    ]
+)
 
 
 # Requests
-class Request(BaseModel):
+class Request(Message):
+    """
+    A request, serialized as a request option, a pad byte, the sizes of the command and
+    arguments, the command and then the space-separated arguments.
+    Everything but the arguments is compiled once per request type, and the whole
+    request once per request type without arguments, when the class is defined.
+    """
+
     _serializers = {
-        datetime: lambda x: x.strftime("%Y %m %d %H %M %S").encode("ascii"),
-        bool: lambda x: str(int(x)).encode("ascii"),
+        datetime: datetime_serializer("%Y %m %d %H %M %S"),
+        bool: bool_serializer,
     }
-    _default_serializer = lambda self, x: str(x).encode("ascii")
-
-    def serialize(self):
-        request_option = pack("<B", 0)
-        pad_byte = pack("<x")
 
-        command = b"#%b" % (self.__class__.__name__).encode("ascii")
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._command = b"#%b" % cls.__name__.encode("ascii")
+        cls._prefix = pack("<BxH", 0, len(cls._command))
+        cls._arguments = serializers(cls, Request._serializers)
+        cls._serialized = None
+        if not cls._arguments:
+            cls._serialized = cls._prefix + pack("<I", 0) + cls._command
+
+    def serialize(self) -> bytes:
+        if self._serialized is not None:
+            return self._serialized
         arguments = b" ".join(
-            [
-                self._serializers.get(
-                    self.__fields__[k].type_, self._default_serializer
-                )(v)
-                for k, v in self.dict().items()
-            ]
+            serialize(getattr(self, field)) for field, serialize in self._arguments
         )
-
-        command_size = pack("<H", len(command))
-        arguments_size = pack("<I", len(arguments))
-
-        request = b"".join(
-            (request_option, pad_byte, command_size, arguments_size, command, arguments)
+        return b"".join(
+            (self._prefix, pack("<I", len(arguments)), self._command, arguments)
         )
-        return request
 
 
 class GetFirmwareVersion(Request):
@@ -119,7 +142,11 @@ class GetNtpServer(Request):
 
 
 # Responses
-class Response(BaseModel):
+class Response(Message):
+    """
+    A response, with its content parsed into a plain value by the parse of its type.
+    """
+
     status: bool
     message: str
     content: bytes
@@ -127,12 +154,14 @@ class Response(BaseModel):
     def __init__(self, response: Tuple[bool, bytes, bytes]):
         status, message, content = response
         try:
-            super().__init__(status=status, message=message, **self.parse(content))
-        except:
+            self.status = status
+            self.message = bytes(message).decode("ascii")
+            self.content = self.parse(content)
+        except Exception:
             raise ValueError("Could not parse response")
 
     def parse(self, content: bytes):
-        return {"content": content}
+        return content
 
 
 class FirmwareVersion(Response):
@@ -141,7 +170,7 @@ class FirmwareVersion(Response):
     def parse(self, content: bytes):
         version = content.decode("ascii")
 
-        return {"content": version}
+        return version
 
 
 class InstrumentName(Response):
@@ -150,7 +179,7 @@ class InstrumentName(Response):
     def parse(self, content: bytes):
         name = content.decode("ascii")
 
-        return {"content": name}
+        return name
 
 
 class Ready(Response):
@@ -159,7 +188,7 @@ class Ready(Response):
     def parse(self, content: bytes):
         ready = unpack("<?", content)[0]
 
-        return {"content": ready}
+        return ready
 
 
 class DutChannelCount(Response):
@@ -168,7 +197,7 @@ class DutChannelCount(Response):
     def parse(self, content: bytes):
         count = unpack("<I", content)[0]
 
-        return {"content": count}
+        return count
 
 
 class Peaks(Response):
@@ -189,14 +218,12 @@ class Peaks(Response):
             (timestamp_seconds + (timestamp_nanoseconds * 10 ** -9)), timezone.utc
         )
         peaks = [
-            raw_peaks[cumulative_num_peaks[i] : cumulative_num_peaks[i + 1]]
+            list(raw_peaks[cumulative_num_peaks[i] : cumulative_num_peaks[i + 1]])
             for i in range(16)
         ]
 
-        return {
-            "timestamp": timestamp,
-            "content": peaks,
-        }
+        self.timestamp = timestamp
+        return peaks
 
 
 class PeakDataStreamingStatus(Response):
@@ -205,7 +232,7 @@ class PeakDataStreamingStatus(Response):
     def parse(self, content: bytes):
         status = bool(unpack("<I", content)[0])
 
-        return {"content": status}
+        return status
 
 
 class PeakDataStreamingDivider(Response):
@@ -214,7 +241,7 @@ class PeakDataStreamingDivider(Response):
     def parse(self, content: bytes):
         divider = unpack("<I", content)[0]
 
-        return {"content": divider}
+        return divider
 
 
 class PeakDataStreamingAvailableBuffer(Response):
@@ -223,7 +250,7 @@ class PeakDataStreamingAvailableBuffer(Response):
     def parse(self, content: bytes):
         availability = unpack("<I", content)[0]
 
-        return {"content": availability}
+        return availability
 
 
 class LaserScanSpeed(Response):
@@ -232,16 +259,16 @@ class LaserScanSpeed(Response):
     def parse(self, content: bytes):
         speed = unpack("<I", content)[0]
 
-        return {"content": speed}
+        return speed
 
 
 class AvailableLaserScanSpeeds(Response):
     content: List[int]
 
     def parse(self, content: bytes):
-        available_speeds = unpack("<" + (len(content) // 4) * "I", content)
+        available_speeds = list(unpack("<" + (len(content) // 4) * "I", content))
 
-        return {"content": available_speeds}
+        return available_speeds
 
 
 class InstrumentUtcDateTime(Response):
@@ -255,7 +282,7 @@ class InstrumentUtcDateTime(Response):
         minute = unpack("<H", content[8:10])[0]
         second = unpack("<H", content[10:12])[0]
 
-        return {"content": datetime(year, month, day, hour, minute, second)}
+        return datetime(year, month, day, hour, minute, second)
 
 
 class NtpEnabled(Response):
@@ -264,7 +291,7 @@ class NtpEnabled(Response):
     def parse(self, content: bytes):
         enabled = bool(unpack("<I", content)[0])
 
-        return {"content": enabled}
+        return enabled
 
 
 class NtpServer(Response):
@@ -273,4 +300,154 @@ class NtpServer(Response):
     def parse(self, content: bytes):
         address = ip_address(content.decode("ascii"))
 
-        return {"content": address}
+        return address
+
+
+class PeakFrame:
+    """
+    Lightweight, read-only view of a #GetPeaks response.
+    Unlike Peaks, nothing is unpacked into Python objects or validated: the header and
+    the peak wavelengths are NumPy views onto the original content bytes, so decoding
+    a frame costs a handful of array constructions regardless of the number of peaks.
+    """
+
+    __slots__ = ("status", "message", "header", "counts", "offsets", "peaks")
+
+    def __init__(self, response: Tuple[bool, bytes, bytes]):
+        status, message, content = response
+        try:
+            header = np.frombuffer(content, PEAKS_HEADER, count=1)[0]
+            counts = header["num_peaks"]
+            offsets = np.zeros(NUM_CHANNELS + 1, dtype=np.intp)
+            np.cumsum(counts, out=offsets[1:])
+            peaks = np.frombuffer(
+                content, "<f8", count=offsets[-1], offset=PEAKS_HEADER_LENGTH
+            )
+        except ValueError:
+            raise ValueError("Could not parse response")
+
+        self.status = status
+        self.message = bytes(message).decode("ascii")
+        self.header = header
+        self.counts = counts  # Number of peaks in each channel
+        self.offsets = offsets  # Start of each channel in peaks, plus the end
+        self.peaks = peaks  # All peaks in channel order
+
+    @property
+    def timestamp_ns(self) -> int:
+        """Instrument timestamp in integer nanoseconds since the epoch."""
+        return (
+            int(self.header["timestamp_seconds"]) * 10 ** 9
+            + int(self.header["timestamp_nanoseconds"])
+        )
+
+    @property
+    def timestamp(self) -> datetime:
+        return datetime.fromtimestamp(
+            int(self.header["timestamp_seconds"]), timezone.utc
+        ).replace(microsecond=int(self.header["timestamp_nanoseconds"]) // 1000)
+
+    def channel(self, channel: int) -> np.ndarray:
+        """Return the peaks of a single channel as a view by offset."""
+        return self.peaks[self.offsets[channel] : self.offsets[channel + 1]]
+
+    @property
+    def content(self) -> List[np.ndarray]:
+        """Per-channel views, indexable in the same way as Peaks.content."""
+        return [self.channel(i) for i in range(NUM_CHANNELS)]
+
+    @property
+    def padded(self) -> np.ndarray:
+        """Copy the peaks into a (16, max_peaks) array, padded with NaN as in PeakBatch."""
+        present = np.arange(self.counts.max()) < self.counts[:, None]
+        padded = np.full(present.shape, np.nan)
+        padded[present] = self.peaks
+        return padded
+
+
+def split_frames(buffer) -> Tuple[List[int], int]:
+    """
+    Find the complete responses in a buffer of back-to-back framed responses.
+    Returns the offset of the content of each one and the end of the last one.
+    """
+    view = memoryview(buffer)
+    end = len(view)
+    position = 0
+    starts = []
+    while position + HEADER_LENGTH <= end:
+        message_size, content_size = unpack_from("<HI", view, position + 2)
+        frame_end = position + HEADER_LENGTH + message_size + content_size
+        if frame_end > end:
+            break
+        starts.append(position + HEADER_LENGTH + message_size)
+        position = frame_end
+
+    return starts, position
+
+
+class PeakBatch:
+    """
+    Many #GetPeaks responses decoded in a single pass into NumPy arrays.
+    timestamps is an int64 vector of instrument timestamps in nanoseconds, counts is an
+    (N, 16) array of the number of peaks in each channel and peaks is an (N, 16, max_peaks)
+    float64 array, padded with NaN where a channel has fewer than max_peaks peaks.
+    """
+
+    __slots__ = ("timestamps", "counts", "peaks")
+
+    def __init__(self, timestamps: np.ndarray, counts: np.ndarray, peaks: np.ndarray):
+        self.timestamps = timestamps
+        self.counts = counts
+        self.peaks = peaks
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @property
+    def datetimes(self) -> List[datetime]:
+        return [
+            dt.replace(tzinfo=timezone.utc)
+            for dt in self.timestamps.astype("datetime64[ns]")
+            .astype("datetime64[us]")
+            .tolist()
+        ]
+
+    @classmethod
+    def decode(cls, buffer) -> Tuple["PeakBatch", int]:
+        """
+        Decode every complete response in a buffer of back-to-back framed responses.
+        Returns the batch and the number of bytes consumed, so that any trailing
+        partial response can be kept until the rest of it arrives.
+        """
+        starts, end = split_frames(buffer)
+        return cls.from_offsets(buffer, starts), end
+
+    @classmethod
+    def from_offsets(cls, buffer, starts: List[int]) -> "PeakBatch":
+        """Gather the headers and peaks of the #GetPeaks contents at the given offsets."""
+        raw = np.frombuffer(buffer, np.uint8)
+        starts = np.asarray(starts, dtype=np.intp)
+
+        headers = raw[starts[:, None] + np.arange(PEAKS_HEADER_LENGTH)]
+        headers = headers.view(PEAKS_HEADER).reshape(len(starts))
+        timestamps = headers["timestamp_seconds"].astype(np.int64) * 10 ** 9
+        timestamps += headers["timestamp_nanoseconds"]
+        counts = headers["num_peaks"].astype(np.intp)
+
+        # Position of every peak as if each channel were padded out to max_peaks
+        max_peaks = int(counts.max()) if counts.size else 0
+        cumulative_counts = np.cumsum(counts, axis=1) - counts
+        k = np.arange(max_peaks)
+        present = k < counts[:, :, None]
+        positions = (
+            starts[:, None, None]
+            + PEAKS_HEADER_LENGTH
+            + 8 * (cumulative_counts[:, :, None] + k)
+        )
+
+        peaks = np.full(present.shape, np.nan)
+        peaks[present] = (
+            raw[positions[present][:, None] + np.arange(8)].view("<f8").ravel()
+        )
+
+        return cls(timestamps, counts, peaks)
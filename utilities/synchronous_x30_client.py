@@ -1,37 +1,141 @@
+"""
+Synchronous client for Micron Optics x30 boxes, for scripted tests.
+Besides single commands it can poll #GET_DATA or #GET_UNBUFFERED_DATA at a fixed
+target rate, reporting the achieved rate and the jitter in latency and scheduling:
+    python utilities/synchronous_x30_client.py --rate 1000 --duration 10
+"""
+import argparse
 import socket
+import statistics
+import time
+from array import array
 
 HOST = "10.0.0.126"
 PORT = 1852
+BUFFER_SIZE = 2 ** 16  # Initial size of the receive buffer, grown to fit responses
+SPIN = 0.001  # Seconds before each deadline to stop sleeping and spin instead
 
 
 class Synchronousx30Client:
-    """Synchronous client to interact with Micron Optics x30 boxes."""
+    """
+    Synchronous client to interact with Micron Optics x30 boxes.
+    Responses are received with recv_into into one preallocated buffer, looping until
+    exactly the length prefix and then exactly the response have arrived, so a response
+    split over several TCP segments is never truncated. Only the copy of the response
+    handed back is allocated per read, and poll doesn't even make that.
+    """
 
     ACKNOWLEDGEMENT_LENGTH = 10
+    STATUS_HEADER_LENGTH = 88
 
     def __init__(self, host: str = HOST, port: int = PORT):
         self.host = host
         self.port = port
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
 
     def start(self):
         self.socket.connect((self.host, self.port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     def end(self):
         self.socket.close()
 
-    def read(self, command: bytes):
+    def recv_exactly(self, length: int) -> memoryview:
+        """Receive exactly length bytes into the start of the buffer."""
+        if length > len(self.buffer):
+            self.buffer = bytearray(length)
+            self.view = memoryview(self.buffer)
+        received = 0
+        while received < length:
+            n = self.socket.recv_into(self.view[received:length])
+            if not n:
+                raise ConnectionError(
+                    f"Connection closed with {received} of {length} bytes received"
+                )
+            received += n
+        return self.view[:length]
+
+    def read(self, command: bytes, copy: bool = True):
+        """
+        Send a command and return the status header and data of its response, as bytes,
+        or if not copy as views of the receive buffer that are only valid until the next
+        read.
+        """
         self.socket.sendall(command + b"\n")
-        message_length = int(self.socket.recv(self.ACKNOWLEDGEMENT_LENGTH))
-        message = self.socket.recv(message_length)
-        status_header = message[:88]
-        try:
-            data = message[89:]
-        except IndexError:
-            data = None
+        message_length = int(self.recv_exactly(self.ACKNOWLEDGEMENT_LENGTH))
+        message = self.recv_exactly(message_length)
+        status_header = message[: self.STATUS_HEADER_LENGTH]
+        data = message[self.STATUS_HEADER_LENGTH :]
+        if copy:
+            return bytes(status_header), bytes(data)
 
         return status_header, data
 
+    def poll(
+        self,
+        rate: float,
+        duration: float = None,
+        requests: int = None,
+        unbuffered: bool = False,
+        callback=None,
+    ) -> dict:
+        """
+        Poll #GET_DATA, or #GET_UNBUFFERED_DATA, at rate requests per second for
+        duration seconds or a number of requests, calling callback with every status
+        header and data, as views of the receive buffer that are only valid during the
+        call. Each request is sent at its own deadline rather than a period after the
+        last one, so that slow responses don't accumulate into drift. Sleeping stops
+        SPIN seconds before each deadline, which is then waited for by spinning.
+        A deadline that has already passed by a whole period is skipped and counted as
+        missed, rather than sending a burst of requests to catch up.
+        """
+        if duration is None and requests is None:
+            raise ValueError("Poll for a duration or a number of requests")
+        command = b"#GET_UNBUFFERED_DATA" if unbuffered else b"#GET_DATA"
+        period = 1 / rate
+        latencies = array("d")  # Seconds from sending each request to its response
+        lateness = array("d")  # Seconds each request was sent after its deadline
+        missed = 0
+
+        start = time.perf_counter()
+        slots = round(duration * rate) if duration is not None else float("inf")
+        slot = 0  # Of the next request, whose deadline is start + slot * period
+        while slot < slots and (requests is None or len(latencies) < requests):
+            deadline = start + slot * period
+            now = time.perf_counter()
+            if now - deadline > period:
+                skipped = int((now - deadline) / period)
+                missed += skipped
+                slot += skipped
+                continue
+            if deadline - now > SPIN:
+                time.sleep(deadline - now - SPIN)
+            while time.perf_counter() < deadline:
+                pass
+
+            sent = time.perf_counter()
+            status_header, data = self.read(command, copy=False)
+            latencies.append(time.perf_counter() - sent)
+            lateness.append(sent - deadline)
+            if callback is not None:
+                callback(status_header, data)
+            slot += 1
+
+        elapsed = time.perf_counter() - start
+        return {
+            "requests": len(latencies),
+            "missed": missed,
+            "elapsed": elapsed,
+            "target_rate": rate,
+            "rate": len(latencies) / elapsed,
+            "latency_mean": statistics.mean(latencies) if latencies else None,
+            "latency_max": max(latencies, default=None),
+            "latency_jitter": statistics.pstdev(latencies) if latencies else None,
+            "schedule_jitter": statistics.pstdev(lateness) if lateness else None,
+        }
+
     def get_data(self):
         return self.read(b"#GET_DATA")
 
@@ -67,3 +171,33 @@ class Synchronousx30Client:
 
     def reboot(self):
         return self.read(b"#REBOOT")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--rate", type=float, default=1000, help="Requests/s")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds")
+    parser.add_argument("--unbuffered", action="store_true")
+    args = parser.parse_args()
+
+    client = Synchronousx30Client(args.host, args.port)
+    client.start()
+    try:
+        stats = client.poll(args.rate, args.duration, unbuffered=args.unbuffered)
+    finally:
+        client.end()
+
+    print(
+        f"{stats['requests']} requests in {stats['elapsed']:.2f} s at "
+        f"{stats['rate']:.1f}/s of a target {stats['target_rate']:.1f}/s, "
+        f"{stats['missed']} deadlines missed"
+    )
+    if stats["requests"]:
+        print(
+            f"latency {1e6 * stats['latency_mean']:.0f} us mean, "
+            f"{1e6 * stats['latency_max']:.0f} us max, "
+            f"{1e6 * stats['latency_jitter']:.0f} us jitter; "
+            f"scheduling jitter {1e6 * stats['schedule_jitter']:.0f} us"
+        )